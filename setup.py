@@ -1,16 +1,32 @@
+import ast
+import os
+
 from setuptools import setup, find_packages
 
-long_description='Search shoutcast.com for radio stations (not for commercial use, see http://forums.winamp.com/showthread.php?threadid=295638). Use criteria to search for station names, genres or current songs, and filters to specify details. Keywords are used to search freely among station names, genres and current songs. With no criteria or keywords, %prog returns the current Top500 list. Stations can be sorted in different ways using sorters. Example: \'%prog -n 10 -g Rock -p "Depeche Mode" -b "=128"\' shows the top ten Rock 128kbps stations currently playing Depeche Mode.'
+def _package_info():
+    # __version__ and __description__ of the package, read without
+    # importing it
+    path = os.path.join(os.path.dirname(__file__), 'shoutcast_search',
+                        '__init__.py')
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    return dict((node.targets[0].id, ast.literal_eval(node.value))
+                for node in tree.body if isinstance(node, ast.Assign))
+
+info = _package_info()
+long_description = info['__description__'].replace('%(prog)s',
+                                                   'shoutcast-search')
 
 setup(
     name = 'shoutcast_search',
-    version = '0.4.1',
+    version = info['__version__'],
     url = 'http://github.com/halhen/shoutcast-search',
     author = 'Henrik Hallberg',
     author_email = 'halhen@k2h.se',
     license = 'GPL',
     packages = find_packages(),
-    install_requires = ['setuptools'],
+    python_requires = '>=3.8',
+    extras_require = {'msgpack': ['msgpack'], 'numpy': ['numpy']},
     description = 'Search shoutcast.com web radio stations',
     long_description = long_description,
     classifiers = [
@@ -20,3 +20,17 @@
 
 __version__ = '0.4.1'
 
+
+# Shown by shoutcast-search --help, and read by setup.py as the
+# long_description. Kept here so that starting up does not need to read the
+# package metadata.
+__description__ = (
+    'Search shoutcast.com for radio stations (not for commercial use, see '
+    'http://forums.winamp.com/showthread.php?threadid=295638). Use criteria '
+    'to search for station names, genres or current songs, and filters to '
+    'specify details. Keywords are used to search freely among station '
+    'names, genres and current songs. With no criteria or keywords, '
+    '%(prog)s returns the current Top500 list. Stations can be sorted in '
+    'different ways using sorters. Example: \'%(prog)s -n 10 -g Rock -p '
+    '"Depeche Mode" -b "=128"\' shows the top ten Rock 128kbps stations '
+    'currently playing Depeche Mode.')
@@ -0,0 +1,589 @@
+#
+#   aio.py - asyncio providers and searches
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' search() and filter_results() for asyncio programs, without a thread
+per request:
+
+    async with AsyncProvider() as provider:
+        stations = await async_search(genre=['Rock'], provider=provider,
+                                      timeout=5)
+        async for station in async_iter_search(['jazz'],
+                                               provider=provider):
+            ...
+
+An AsyncProvider makes its requests through an AsyncSession, keep-alive
+connections shared by all tasks using the provider, and with the retries,
+rate limit and directory of a Provider (Shoutcast by default). Responses
+are parsed while they arrive. Every call takes a timeout in seconds for
+all of its requests, and cancelling the task making a call closes its
+connections. Responses are not cached, and directories searched locally,
+like IcecastDirectory, are not supported.
+'''
+
+import asyncio
+import urllib.error
+import urllib.parse
+
+from shoutcast_search import transport
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import _count
+from shoutcast_search.shoutcast_search import _new_rows
+from shoutcast_search.shoutcast_search import _search_queries
+from shoutcast_search.shoutcast_search import _timer
+from shoutcast_search.shoutcast_search import compile_filter
+from shoutcast_search.shoutcast_search import filter_results
+from shoutcast_search.shoutcast_search import Provider
+
+_CHUNK_SIZE = transport._CHUNK_SIZE
+
+
+def _timed_out():
+    return urllib.error.URLError(TimeoutError('timed out'))
+
+
+class AsyncResponse(object):
+    ''' HTTP response of AsyncSession.urlopen(), read with await read().
+    Like transport.PooledResponse it decompresses gzip and deflate bodies
+    and hands its connection back to the session when closed after the body
+    was read completely; otherwise the connection is closed.
+    '''
+
+    def __init__(self, session, key, reader, writer, status, reason,
+                 headers, url, keep_alive, timeout, deadline):
+        self._session = session
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.url = url
+        self._keep_alive = keep_alive
+        self._timeout = timeout
+        self._deadline = deadline
+        self._chunked = 'chunked' in \
+            headers.get('Transfer-Encoding', '').lower()
+        self._length = None
+        if not self._chunked and headers.get('Content-Length'):
+            self._length = int(headers['Content-Length'])
+        if status in (204, 304) or 100 <= status < 200:
+            self._length = 0
+        self._chunk_left = 0
+        self._done = self._length == 0
+        self._decoder = None
+        encoding = headers.get('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            self._decoder = transport._Decoder(
+                'deflate' if encoding == 'deflate' else 'gzip')
+        self._buffer = b''
+        self._eof = False
+
+    async def _wait(self, awaitable):
+        ''' Await awaitable within the timeout, raising URLError for
+        network failures. '''
+        return await _wait(awaitable, self._timeout, self._deadline)
+
+    async def _read_raw(self, amt):
+        ''' Read up to amt bytes of the body as sent, b'' at its end. '''
+        reader = self._reader
+        if self._done:
+            return b''
+        if self._chunked:
+            if self._chunk_left == 0:
+                line = await self._wait(reader.readline())
+                try:
+                    size = int(line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    raise urllib.error.URLError(
+                        'invalid chunk size: {0!r}'.format(line))
+                if size == 0:
+                    while await self._wait(reader.readline()) not in \
+                            (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    self._done = True
+                    return b''
+                self._chunk_left = size
+            data = await self._wait(reader.read(min(amt, self._chunk_left)))
+            if not data:
+                raise urllib.error.URLError(ConnectionResetError(
+                    'connection closed within the response'))
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._wait(reader.readexactly(2))
+            return data
+        if self._length is not None:
+            data = await self._wait(reader.read(min(amt, self._length)))
+            if not data:
+                raise urllib.error.URLError(ConnectionResetError(
+                    'connection closed within the response'))
+            self._length -= len(data)
+            self._done = self._length == 0
+            return data
+        data = await self._wait(reader.read(amt))
+        if not data:
+            self._done = True
+            self._keep_alive = False
+        return data
+
+    async def read(self, amt=None):
+        ''' Return up to amt bytes of the body, all of it if amt is None,
+        and b'' at its end. '''
+        if amt is None:
+            chunks = []
+            while True:
+                data = await self.read(_CHUNK_SIZE)
+                if not data:
+                    return b''.join(chunks)
+                chunks.append(data)
+        try:
+            while not self._buffer and not self._eof:
+                data = await self._read_raw(max(amt, _CHUNK_SIZE))
+                if self._decoder is None:
+                    self._buffer = data
+                    self._eof = not data
+                elif data:
+                    self._buffer = self._decoder.decode(data)
+                else:
+                    self._buffer = self._decoder.flush()
+                    self._eof = True
+        except BaseException:
+            self._keep_alive = False
+            self.close()
+            raise
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        ''' Close the response. Safe to call from cancelled tasks, since it
+        does not wait. '''
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        reusable = self._keep_alive and self._done and \
+            not self._reader.at_eof()
+        self._session._release(self._key, self._reader, writer, reusable)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+async def _wait(awaitable, timeout, deadline=None):
+    ''' Await awaitable for at most timeout seconds, and not past deadline
+    (loop time), raising network failures and timeouts as URLError. '''
+    if deadline is not None:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise _timed_out()
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise _timed_out()
+    except asyncio.LimitOverrunError:
+        raise urllib.error.URLError('response headers too long')
+    except asyncio.IncompleteReadError:
+        raise urllib.error.URLError(ConnectionResetError(
+            'connection closed within the response'))
+    except urllib.error.URLError:
+        raise
+    except OSError as e:
+        raise urllib.error.URLError(e)
+
+
+class AsyncSession(object):
+    ''' Keep-alive HTTP(S) connections for asyncio, pooled per (scheme,
+    host, port) and shared by all tasks using the session.
+
+      maxsize - maximum number of idle connections kept per host.
+      timeout - seconds to wait for connecting and for every read.
+      compress - ask for gzip or deflate compressed responses.
+      limit - maximum number of requests in flight; more wait for one to
+              finish.
+
+    Close the session, or use it with async with, to close its idle
+    connections. Network failures are raised as urllib.error.URLError and
+    HTTP error codes as urllib.error.HTTPError, like HTTPConnectionPool
+    raises them.
+    '''
+
+    def __init__(self, maxsize=4, timeout=30, compress=True, limit=100):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.compress = compress
+        self.limit = limit
+        self._idle = {}
+        self._slots = None  # made in the event loop, when first needed
+
+    async def _connect(self, key, deadline):
+        scheme, host, port = key
+        ssl = None
+        if scheme == 'https':
+            import ssl as ssl_module
+            ssl = ssl_module.create_default_context()
+        return await _wait(asyncio.open_connection(
+            host, port or (443 if ssl else 80), ssl=ssl), self.timeout,
+            deadline)
+
+    def _release(self, key, reader, writer, reusable):
+        ''' Take back the connection of a closed response. '''
+        self._slots.release()
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.maxsize:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _request(self, key, request, url, deadline):
+        ''' Send request over an idle or a new connection and return the
+        response, trying again once if an idle connection turns out to have
+        been closed by the server. '''
+        import http.client
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await self._connect(key, deadline)
+            try:
+                writer.write(request)
+                head = await _wait(reader.readuntil(b'\r\n\r\n'),
+                                   self.timeout, deadline)
+                status_line, _, header_lines = head.partition(b'\r\n')
+                version, status, reason = (status_line.decode('latin-1')
+                                           .split(None, 2) + ['', ''])[:3]
+                if not version.startswith('HTTP/') or \
+                        not status.isdigit():
+                    raise urllib.error.URLError(
+                        'bad status line: {0!r}'.format(status_line))
+                headers = http.client.parse_headers(_Lines(header_lines))
+            except BaseException as e:
+                writer.close()
+                if reused and isinstance(e, urllib.error.URLError):
+                    continue
+                raise
+            connection = headers.get('Connection', '').lower()
+            keep_alive = 'close' not in connection and (
+                version != 'HTTP/1.0' or 'keep-alive' in connection)
+            return AsyncResponse(self, key, reader, writer, int(status),
+                                 reason.strip(), headers, url, keep_alive,
+                                 self.timeout, deadline)
+
+    async def urlopen(self, url, headers=None, redirects=5, timeout=None):
+        ''' GET url and return an AsyncResponse, usable with async with.
+        The response must be closed to free its connection. timeout is the
+        time in seconds the request may take in all, from connecting to
+        reading the end of the body. '''
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        headers = dict(headers or {})
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib.error.URLError('unknown url type: {0}'.format(
+                parts.scheme))
+        if self.compress and not any(name.lower() == 'accept-encoding'
+                                     for name in headers):
+            headers['Accept-Encoding'] = transport.ACCEPT_ENCODING
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        host = parts.hostname
+        if parts.port:
+            host = '{0}:{1:d}'.format(host, parts.port)
+        lines = ['GET {0} HTTP/1.1'.format(path), 'Host: ' + host]
+        lines.extend('{0}: {1}'.format(name, value)
+                     for name, value in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.limit)
+        await _wait(self._slots.acquire(), None, deadline)
+        try:
+            resp = await self._request(key, request, url, deadline)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        location = resp.headers.get('Location')
+        if resp.status in transport._REDIRECT_CODES and location and \
+                redirects > 0:
+            await resp.read()
+            resp.close()
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+            return await self.urlopen(urllib.parse.urljoin(url, location),
+                                      headers, redirects - 1, remaining)
+        if resp.status >= 400:
+            await resp.read()
+            resp.close()
+            raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                         resp.headers, None)
+        return resp
+
+    def close(self):
+        ''' Close all idle connections. '''
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer in conns:
+                writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class _Lines(object):
+    ''' The header lines of a response, for http.client.parse_headers. '''
+
+    def __init__(self, data):
+        self._lines = data.splitlines(True)
+
+    def readline(self, limit=-1):
+        return self._lines.pop(0) if self._lines else b''
+
+
+async def _aiter_attribs(resp, tag, counter):
+    ''' Like _iter_attribs, parsing the AsyncResponse resp while it is
+    read. '''
+    import xml.etree.ElementTree as ET
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    while True:
+        with _timer('download'):
+            data = await resp.read(_CHUNK_SIZE)
+        _count('bytes', len(data))
+        items = []
+        with _timer('parse'):
+            if data:
+                parser.feed(data)
+            else:
+                parser.close()
+            for event, elem in parser.read_events():
+                if root is None:
+                    root = elem
+                elif event == 'end' and elem.tag == tag:
+                    items.append(elem.attrib)
+                    root.clear()
+        _count(counter, len(items))
+        for item in items:
+            yield item
+        if not data:
+            return
+
+
+class AsyncProvider(object):
+    ''' Async version of the provider, Shoutcast() by default, using its
+    urls, headers, retries and rate limiter. The rate limiter is shared
+    with the provider, so that both are limited together.
+
+      session - AsyncSession for all requests. Pass one to share
+                connections between providers. By default a new one is
+                made from the provider's pool_size and timeout.
+    '''
+
+    def __init__(self, provider=None, session=None):
+        if provider is None:
+            from shoutcast_search.shoutcast_search import Shoutcast
+            provider = Shoutcast()
+        if getattr(type(provider), 'iter_search_results', None) is not \
+                Provider.iter_search_results:
+            raise ValueError('{0} directories are not supported'.format(
+                provider.name))
+        if session is None:
+            session = AsyncSession(provider.pool_size, provider.timeout)
+        self.provider = provider
+        self.session = session
+        self.name = provider.name
+
+    def url_by_id(self, index):
+        return self.provider.url_by_id(index)
+
+    async def _open(self, url, timeout=None):
+        ''' Like Provider._open, retrying and waiting for the rate limiter
+        without blocking the event loop. timeout limits the whole request,
+        retries included, further than the provider's deadline. '''
+        provider = self.provider
+        loop = asyncio.get_running_loop()
+        if timeout is None or timeout > provider.deadline:
+            timeout = provider.deadline
+        give_up = loop.time() + timeout
+        attempt = 0
+        while True:
+            if provider.limiter is not None:
+                wait = provider.limiter.reserve(give_up - loop.time())
+                if wait is None:
+                    raise urllib.error.URLError(
+                        'rate limited until past the deadline')
+                await asyncio.sleep(wait)
+            try:
+                _count('requests')
+                with _timer('request'):
+                    return await self.session.urlopen(
+                        url, provider.extra_headers,
+                        timeout=max(give_up - loop.time(), 0.001))
+            except OSError as e:
+                if attempt >= provider.retries or \
+                        not transport.is_retryable(e):
+                    raise
+                delay = transport.retry_after(e)
+                if delay is None:
+                    delay = transport.backoff_delay(attempt,
+                                                    provider.backoff,
+                                                    provider.max_backoff)
+                if loop.time() + delay >= give_up:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                _count('retries')
+
+    async def iter_search_results(self, params, limit=0, predicate=None,
+                                  timeout=None):
+        ''' Async iterator over the stations found with params, see
+        Provider.iter_search_results. '''
+        url = self.provider._build_search_url(params)
+        resp = await self._open(url, timeout)
+        async with resp:
+            count = 0
+            async for attrib in _aiter_attribs(resp, 'station', 'stations'):
+                station = Station.from_attrib(attrib)
+                if predicate is not None and not predicate(station):
+                    continue
+                yield station
+                count += 1
+                if count == limit:
+                    return
+
+    async def get_search_results(self, params, limit=0, predicate=None,
+                                 timeout=None):
+        ''' Return the list of stations found with params. '''
+        return [station async for station in self.iter_search_results(
+            params, limit, predicate, timeout)]
+
+    async def get_genres(self, timeout=None):
+        ''' Return the list of genres of the directory. '''
+        resp = await self._open(self.provider.genres_url, timeout)
+        async with resp:
+            return [attrib['name'] async for attrib in
+                    _aiter_attribs(resp, 'genre', 'genres')]
+
+    def station_text(self, station_info, format):
+        return self.provider.station_text(station_info, format)
+
+    def close(self):
+        self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+async def async_iter_search(search=[], station=[], genre=[], song=[],
+                            mime_type='', provider=None, max_workers=None,
+                            limit=0, predicate=None, failures=None,
+                            timeout=None):
+    ''' Async version of iter_search(), for an AsyncProvider. All keyword
+    requests are made at once, or max_workers at a time, and the stations
+    yielded in the order search() returns them. timeout is the time in
+    seconds all requests may take; a keyword whose request takes longer
+    fails like one whose connection fails. Requests still running are
+    cancelled when the iteration stops.
+    '''
+    assert provider is not None, 'Provider must be specified'
+    queries = _search_queries(search, station, genre, song, mime_type)
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    slots = asyncio.Semaphore(max_workers) if max_workers else None
+
+    async def fetch(params):
+        if slots is not None:
+            await slots.acquire()
+        try:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise _timed_out()
+            return await provider.get_search_results(params, limit,
+                                                     predicate, remaining)
+        except OSError as e:
+            if failures is None:
+                raise
+            failures.append((params.get('search') or params.get('genre'),
+                             e))
+            return []
+        finally:
+            if slots is not None:
+                slots.release()
+
+    tasks = [asyncio.ensure_future(fetch(params)) for params in queries]
+    try:
+        known_ids = set()  # ids found by earlier answers
+        count = 0
+        for task in tasks:
+            for row in _new_rows(await task, known_ids):
+                yield row
+                count += 1
+                if count == limit:
+                    return
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def async_search(search=[], station=[], genre=[], song=[],
+                       mime_type='', provider=None, max_workers=None,
+                       limit=0, predicate=None, failures=None, timeout=None):
+    ''' Async version of search(), for an AsyncProvider; see
+    async_iter_search. Returns a list of Station. '''
+    return [row async for row in async_iter_search(
+        search, station, genre, song, mime_type, provider, max_workers,
+        limit, predicate, failures, timeout)]
+
+
+async def async_filter_results(results, search=[], station=[], genre=[],
+                               song=[], bitrate_fn=None, listeners_fn=None,
+                               mime_type='', limit=0, randomize=False,
+                               sorters=[]):
+    ''' filter_results() for results given as an async iterable, e.g.
+    async_iter_search(), or a list. Stations are checked as they arrive, so
+    only matching ones are kept. '''
+    if not hasattr(results, '__aiter__'):
+        return filter_results(results, search, station, genre, song,
+                              bitrate_fn, listeners_fn, mime_type, limit,
+                              randomize, sorters)
+    predicate = compile_filter(search, station, genre, song, bitrate_fn,
+                               listeners_fn)
+    matches = []
+    async for row in results:
+        row = Station.coerce(row)
+        if predicate(row):
+            matches.append(row)
+    # Only ordering is left to do
+    return filter_results(matches, limit=limit, randomize=randomize,
+                          sorters=sorters)
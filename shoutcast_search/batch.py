@@ -0,0 +1,241 @@
+#
+#   batch.py - run many shoutcast-search searches with shared requests
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search --batch FILE" runs every search listed in FILE, one
+per line, either as shoutcast-search arguments:
+
+    -g Rock -b ">127" -n 10
+
+or as a JSON object mapping long option names to values, with the keywords
+in "keywords" and an optional "id" naming the search:
+
+    {"id": "rock", "genre": "Rock", "bitrate": ">127", "limit": 10}
+
+Blank lines and lines starting with # are skipped. Web service requests
+are planned for all searches at once: a request needed by several searches,
+e.g. for the same genre, is made only once, and the distinct requests run
+concurrently. For every search one JSON line is written, in file order:
+
+    {"id": "rock", "count": 10, "stations": [{"name": ..., "url": ...}]}
+    {"id": 3, "error": "invalid expression: x"}
+
+Searches without an id are named by their line number.
+'''
+
+import collections
+import functools
+import io
+import json
+import shlex
+
+from shoutcast_search.shoutcast_search import _ParserExit
+from shoutcast_search.shoutcast_search import _RequestParser
+from shoutcast_search.shoutcast_search import _build_parser
+from shoutcast_search.shoutcast_search import _expression_param
+from shoutcast_search.shoutcast_search import _fetch_all
+from shoutcast_search.shoutcast_search import _generate_list_sorters
+from shoutcast_search.shoutcast_search import _given_options
+from shoutcast_search.shoutcast_search import _merge_answers
+from shoutcast_search.shoutcast_search import _mime_type_param
+from shoutcast_search.shoutcast_search import _search_queries
+from shoutcast_search.shoutcast_search import filter_results
+from shoutcast_search.shoutcast_search import station_record
+
+
+# Destinations of the options a search of a batch may use
+BATCH_OPTIONS = frozenset([
+    'keywords', 'limit', 'random', 'genre', 'song', 'station', 'bitrate',
+    'listeners', 'codec', 'sort_rules'])
+
+
+@functools.lru_cache(maxsize=1)
+def _flags():
+    ''' Return the long options taking no value, e.g. --random. '''
+    return frozenset(option for action in _build_parser()._actions
+                     if action.nargs == 0
+                     for option in action.option_strings)
+
+
+def _json_argv(document):
+    ''' Return the command line for a search given as a JSON object.
+    Raises ValueError for flags given other values than true or false. '''
+    argv = []
+    for key, value in document.items():
+        if key in ('id', 'keywords'):
+            continue
+        option = '--' + key
+        for v in value if isinstance(value, list) else [value]:
+            if option in _flags() and not isinstance(v, bool):
+                raise ValueError('"{0}" must be true or false'.format(key))
+            if v is True:
+                argv.append(option)
+            elif v is not False and v is not None:
+                argv += [option, str(v)]
+    keywords = document.get('keywords', [])
+    if not isinstance(keywords, list):
+        keywords = [keywords]
+    return argv + ['--'] + [str(k) for k in keywords]
+
+
+class BatchSearch(object):
+    ''' One search of a batch: its parsed command line and the web service
+    requests it needs, or the error that makes it invalid. '''
+
+    def __init__(self, id, argv=None, error=None):
+        self.id = id
+        self.argv = argv
+        self.error = error
+        self.args = None
+        self.requests = []
+        if error is None:
+            self._parse()
+
+    def _parse(self):
+        o = _build_parser(_RequestParser)
+        o.prog = 'shoutcast-search'
+        o.output = io.StringIO()
+        o.errors = io.StringIO()
+        try:
+            args = o.parse_args(self.argv)
+            refused = [option for dest, option in
+                       _given_options(o, args).items()
+                       if dest not in BATCH_OPTIONS]
+            if refused:
+                o.error('only criteria, filters, sorters, --limit and '
+                        '--random are allowed in a batch, not {0}'.format(
+                            ', '.join(refused)))
+            self.bitrate = _expression_param(args.bitrate, o)
+            self.listeners = _expression_param(args.listeners, o)
+            self.mime_type = _mime_type_param(args.codec, o)
+            self.sorters = _generate_list_sorters(args.sort_rules, o)[0]
+        except _ParserExit as e:
+            # argparse writes the usage, then "prog: error: message"
+            lines = (o.errors.getvalue() + (e.message or '')).splitlines()
+            message = lines[-1] if lines else 'invalid search'
+            prefix = o.prog + ': error: '
+            if message.startswith(prefix):
+                message = message[len(prefix):]
+            self.error = message
+            return
+        self.args = args
+        self.requests = _search_queries(args.keywords, args.station,
+                                        args.genre, args.song, self.mime_type)
+
+    def record(self, answers, url_by_id):
+        ''' Return the JSON document for this search, given the answers to
+        its requests, station lists or the exceptions raised instead.
+        '''
+        if self.error is not None:
+            return {'id': self.id, 'error': self.error}
+        for answer in answers:
+            if isinstance(answer, Exception):
+                return {'id': self.id,
+                        'error': 'search failed: {0}'.format(answer)}
+        args = self.args
+        results = filter_results(_merge_answers(answers), args.keywords,
+                                 args.station, args.genre, args.song,
+                                 self.bitrate, self.listeners, self.mime_type,
+                                 args.limit, args.random and not self.sorters,
+                                 self.sorters)
+        return {'id': self.id,
+                'count': len(results),
+                'stations': [station_record(s, url_by_id) for s in results]}
+
+
+def read_queries(lines):
+    ''' Return a BatchSearch for every search in lines, an iterable of
+    strings such as a batch file.
+    '''
+    queries = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('{'):
+            try:
+                document = json.loads(line)
+                queries.append(BatchSearch(document.get('id', number),
+                                           _json_argv(document)))
+            except (ValueError, AttributeError) as e:
+                queries.append(BatchSearch(number, error=str(e)))
+            continue
+        try:
+            queries.append(BatchSearch(number, shlex.split(line)))
+        except ValueError as e:
+            queries.append(BatchSearch(number, error=str(e)))
+    return queries
+
+
+def _request_key(params):
+    return tuple(sorted(params.items()))
+
+
+def run_batch(queries, provider, out, max_workers=4):
+    ''' Run queries, a list of BatchSearch, with provider and write one JSON
+    line per search to out, in order. Returns the number of searches that
+    failed; a failed search is written with its error and does not stop
+    the others.
+
+    Every distinct request is made once, with up to max_workers at a time.
+    A search is written as soon as its requests are answered, and answers
+    no later search needs are let go.
+    '''
+    requests = collections.OrderedDict()
+    uses = collections.Counter()
+    for query in queries:
+        for params in query.requests:
+            requests.setdefault(_request_key(params), params)
+            uses[_request_key(params)] += 1
+
+    def fetch(params):
+        try:
+            return provider.get_search_results(params)
+        except Exception as e:  # reported by the searches needing it
+            return e
+
+    answers = {}
+    pending = collections.deque(queries)
+    failed = 0
+
+    def write_ready():
+        errors = 0
+        while pending:
+            keys = [_request_key(p) for p in pending[0].requests]
+            if not all(key in answers for key in keys):
+                break
+            query = pending.popleft()
+            try:
+                record = query.record([answers[k] for k in keys],
+                                      provider.url_by_id)
+            except Exception as e:  # reported, the other searches go on
+                record = {'id': query.id,
+                          'error': 'search failed: {0}'.format(e)}
+            out.write(json.dumps(record) + '\n')
+            errors += 'error' in record
+            for key in keys:
+                uses[key] -= 1
+                if not uses[key]:
+                    del answers[key]
+        return errors
+
+    failed += write_ready()  # invalid searches before the first request
+    fetched = _fetch_all(fetch, list(requests.values()), max_workers)
+    for key, answer in zip(requests, fetched):
+        answers[key] = answer
+        failed += write_ready()
+    return failed
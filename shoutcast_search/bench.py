@@ -0,0 +1,538 @@
+#
+#   bench.py - benchmarks for the shoutcast_search pipeline
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Run with: python -m shoutcast_search.bench [--size N] [--json] [NAME...]
+
+Most benchmarks time the current implementation against a copy of the
+implementation it replaced, on synthetic stations, and report the best of
+a few runs in seconds. fanout and parse search a FakeDirectory, a local
+HTTP server answering with synthetic stations after an injected delay;
+scale times filtering, sorting and output from 10000 up to --size
+stations; table times StationTable against filter_results, when numpy is
+installed.
+
+Save the results of one commit with --save FILE and check another against
+them with --compare FILE.
+'''
+
+import argparse
+import io
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import quoteattr
+
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import _Expression
+from shoutcast_search.shoutcast_search import _iter_attribs
+from shoutcast_search.shoutcast_search import _generate_list_sorters
+from shoutcast_search.shoutcast_search import _plan_sorters
+from shoutcast_search.shoutcast_search import Shoutcast
+from shoutcast_search.shoutcast_search import write_stations
+from shoutcast_search.shoutcast_search import compile_filter
+from shoutcast_search.shoutcast_search import filter_results
+from shoutcast_search.shoutcast_search import iter_search
+from shoutcast_search.shoutcast_search import search
+
+
+_WORDS = ('Rock', 'Pop', 'Jazz', 'Ambient', 'Chill', 'Dance', 'Trance',
+          'Radio', 'FM', 'Hits', 'Classic', 'Metal', 'Country', 'Blues',
+          'Lounge', 'Techno', 'Oldies', 'News', 'Talk', 'Top 40', 'Salad',
+          'Groove', 'Depeche Mode', 'Shantel', 'Polska', 'Balkan', 'Live')
+
+
+def iter_synthetic_stations(size, seed=0, first_id=0):
+    ''' Yield size station attribute dicts shaped like the web service's,
+    with ids counting from first_id. '''
+    rnd = random.Random(seed)
+    for index in range(first_id, first_id + size):
+        yield {
+            'name': ' '.join(rnd.sample(_WORDS, 4)) + ' ' + str(index),
+            'mt': rnd.choice(('audio/mpeg', 'audio/aacp')),
+            'id': str(index),
+            'br': str(rnd.choice((32, 64, 96, 128, 192, 256, 320))),
+            'genre': ' '.join(rnd.sample(_WORDS, 2)),
+            'ct': ' - '.join(rnd.sample(_WORDS, 2)),
+            'lc': str(int(rnd.paretovariate(1.2)) - 1)}
+
+
+def synthetic_stations(size, seed=0):
+    ''' Return size station attribute dicts shaped like the web service's. '''
+    return list(iter_synthetic_stations(size, seed))
+
+
+def station_xml(stations):
+    ''' Return stations, attribute dicts, as a web service answer. '''
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<stationlist>',
+             '<tunein base="/sbin/tunein-station.pls"></tunein>']
+    for attrib in stations:
+        lines.append('<station {0}></station>'.format(' '.join(
+            '{0}={1}'.format(key, quoteattr(value))
+            for key, value in attrib.items())))
+    lines.append('</stationlist>')
+    return '\n'.join(lines).encode('UTF-8')
+
+
+def best_of(fn, repeat=3):
+    ''' Best wall clock time of repeat calls to fn. '''
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+# Reference implementations, as they were before being optimized
+
+def legacy_filter(results, search=[], station=[], genre=[], song=[],
+                  bitrate_fn=lambda x: True, listeners_fn=lambda x: True):
+    keywords = search + station + genre + song
+    results = [r for r in results if bitrate_fn(r['br'])]
+    results = [r for r in results if listeners_fn(r['lc'])]
+    for s in station:
+        results = [r for r in results if s.upper() in r['name'].upper()]
+    for g in genre:
+        results = [r for r in results if g.upper() in r['genre'].upper()]
+    for s in song:
+        results = [r for r in results if s.upper() in r['ct'].upper()]
+    for k in keywords:
+        results = [r for r in results
+                   if k.upper() in '{0} {1} {2}'.format(r['name'], r['genre'],
+                                                        r['ct']).upper()]
+    return results
+
+
+def legacy_merge(answers):
+    results = []
+    known_ids = []
+    for rows in answers:
+        results += [row for row in rows if row['id'] not in known_ids]
+        known_ids = [row['id'] for row in results]
+    return results
+
+
+def legacy_order(results, pattern, limit=0):
+    results = sorted(results, key=lambda x: int(x['lc']), reverse=True)
+    for sorter in _generate_list_sorters(pattern)[0]:
+        results = sorter(results)
+    if limit > 0:
+        results = results[:limit]
+    return results
+
+
+def legacy_station_text(provider, station_info, format):
+    url = provider.url_by_id(station_info['id'])
+    replacements = {'%g': station_info['genre'],
+                    '%p': station_info['ct'],
+                    '%s': station_info['name'],
+                    '%b': station_info['br'],
+                    '%l': station_info['lc'],
+                    '%t': station_info['mt'],
+                    '%u': url,
+                    '%%': '%',
+                    '\\n': '\n',
+                    '\\t': '\t'}
+    resstr = format
+    for key, value in replacements.items():
+        resstr = resstr.replace(key, str(value))
+    return resstr
+
+
+class StaticProvider(object):
+    ''' Answers searches from a dict of keyword -> stations, no network '''
+
+    def __init__(self, answers):
+        self.answers = answers
+
+    def get_search_results(self, params):
+        return self.answers[params['search']]
+
+
+class _FakeDirectoryHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path != '/sbin/newxml.phtml':
+            self.send_error(404)
+            return
+        body = self.server.answer(query.get('search') or
+                                  query.get('genre', ''))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDirectory(ThreadingMixIn, HTTPServer):
+    ''' Local HTTP stand-in for the shoutcast web service, answering with
+    synthetic stations after latency seconds.
+
+    The Top500 genre lists size stations, any other search or genre
+    per_query stations, the same ones every time it is asked for. Use
+    provider() to search it.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, size=500, per_query=100, latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeDirectoryHandler)
+        self.size = size
+        self.per_query = per_query
+        self.latency = latency
+        self.answers = {}
+        self.providers = []  # closed by stop()
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def answer(self, query):
+        ''' Return the XML answer to a search or genre query. '''
+        with self.lock:
+            if query not in self.answers:
+                seed = zlib.crc32(query.encode('UTF-8'))
+                size = self.size if query == 'Top500' else self.per_query
+                self.answers[query] = station_xml(iter_synthetic_stations(
+                    size, seed, seed % 1000 * size))
+            return self.answers[query]
+
+    def provider(self):
+        ''' Return a Shoutcast provider asking this server, not rate
+        limited. '''
+        provider = Shoutcast()
+        provider.search_url = self.url + '/sbin/newxml.phtml?{0}'
+        provider.genres_url = self.url + '/sbin/newxml.phtml'
+        provider.limiter = None
+        self.providers.append(provider)
+        return provider
+
+    def stop(self):
+        for provider in self.providers:
+            provider.close()
+        self.shutdown()
+        self.server_close()
+
+
+# Benchmarks
+
+def bench_filter(size):
+    ''' filter_results criteria: multi-pass filter vs compiled predicate '''
+    raw = synthetic_stations(size)
+    stations = [Station.from_attrib(r) for r in raw]
+    criteria = {'search': ['radio', 'o'], 'genre': ['rock'], 'song': ['a'],
+                'station': ['r']}
+    many = {'search': ['r', 'o', 'a', 'd', 'i', 'e', 'n', 't']}
+
+    def legacy_listeners(x):
+        return int(x) > 2
+
+    def listeners(x):
+        return x > 2
+
+    def run_legacy(stations, criteria, listeners_fn):
+        return lambda: legacy_filter(stations, listeners_fn=listeners_fn,
+                                     **criteria)
+
+    def run_compiled(criteria, listeners_fn):
+        def run():
+            predicate = compile_filter(listeners_fn=listeners_fn, **criteria)
+            return [r for r in stations if predicate(r)]
+        return run
+
+    return {
+        'station_ingest': best_of(
+            lambda: [Station.from_attrib(r) for r in raw]),
+        'legacy': best_of(run_legacy(raw, criteria, legacy_listeners)),
+        'compiled': best_of(run_compiled(criteria, listeners)),
+        'legacy_8_keywords': best_of(run_legacy(raw, many, legacy_listeners)),
+        'compiled_8_keywords': best_of(run_compiled(many, listeners))}
+
+
+def bench_merge(size):
+    ''' search() keyword merge: list scans vs id set, at growing sizes.
+
+    Eight keywords each return size / 4 stations, half of them already
+    returned by the previous keyword.
+    '''
+    report = {}
+    for step in (8, 4, 2, 1):
+        total = size // step
+        per_keyword = max(total // 4, 1)
+        stations = [Station.from_attrib(r)
+                    for r in synthetic_stations(per_keyword * 5)]
+        answers = {}
+        for index in range(8):
+            start = index * per_keyword // 2
+            answers[str(index)] = stations[start:start + per_keyword]
+        keywords = sorted(answers)
+        provider = StaticProvider(answers)
+        report['legacy_{0}'.format(total)] = best_of(
+            lambda: legacy_merge(answers[k] for k in keywords), 1)
+        report['set_{0}'.format(total)] = best_of(
+            lambda: list(iter_search(keywords, provider=provider)))
+    return report
+
+
+def bench_sort(size):
+    ''' filter_results ordering: one sort per sorter vs planned stages '''
+    raw = synthetic_stations(size)
+    stations = [Station.from_attrib(r) for r in raw]
+
+    def run_planned(pattern, limit=0):
+        sorters = _generate_list_sorters(pattern)[0]
+
+        def run():
+            result = stations
+            for stage in _plan_sorters(sorters, False, limit):
+                result = stage(result)
+            return result
+        return run
+
+    report = {}
+    for pattern, limit in (('', 10), ('ln10', 0), ('^bln5', 0), ('bl', 0)):
+        name = '{0}{1}'.format(pattern or 'default', limit and
+                               ' -n {0}'.format(limit) or '')
+        report['legacy ' + name] = best_of(
+            lambda: legacy_order(raw, pattern, limit))
+        report['planned ' + name] = best_of(run_planned(pattern, limit))
+    return report
+
+
+def bench_format(size):
+    ''' Output: str.replace per code vs compiled template, buffered '''
+    raw = synthetic_stations(size)
+    stations = [Station.from_attrib(r) for r in raw]
+    provider = Shoutcast()
+    formats = (('url', '%u'),
+               ('verbose', '%s [%bkbps %t]\\n\\t%u\\n\\t%g, %l listeners'
+                           '\\n\\tNow playing: %p\\n'))
+
+    def run_legacy(format):
+        return lambda: io.StringIO().write('\n'.join(
+            legacy_station_text(provider, r, format) for r in raw))
+
+    def run_compiled(format):
+        return lambda: write_stations(stations, format, provider,
+                                      io.StringIO())
+
+    report = {}
+    for name, format in formats:
+        report['legacy ' + name] = best_of(run_legacy(format))
+        report['compiled ' + name] = best_of(run_compiled(format))
+    return report
+
+
+def bench_fanout(size, latency=0.05):
+    ''' search() over HTTP: eight keywords against a FakeDirectory
+    answering size stations per keyword after latency seconds, one request
+    at a time vs concurrently '''
+    directory = FakeDirectory(per_query=size, latency=latency)
+    try:
+        provider = directory.provider()
+        keywords = ['rock', 'pop', 'jazz', 'chill', 'dance', 'metal',
+                    'blues', 'talk']
+        report = {}
+        for jobs in (1, 4, 8):
+            report['jobs_{0}'.format(jobs)] = best_of(
+                lambda: search(keywords, provider=provider, max_workers=jobs))
+        return report
+    finally:
+        directory.stop()
+
+
+def bench_parse(size):
+    ''' Top500 answer of size stations: parsing it from memory vs
+    fetching and parsing it from a FakeDirectory '''
+    directory = FakeDirectory(size=size)
+    try:
+        provider = directory.provider()
+        body = directory.answer('Top500')
+        return {
+            'parse': best_of(lambda: [Station.from_attrib(a) for a in
+                                      _iter_attribs(io.BytesIO(body),
+                                                    'station')]),
+            'fetch_and_parse': best_of(
+                lambda: provider.get_search_results({'genre': 'Top500'}))}
+    finally:
+        directory.stop()
+
+
+def bench_scale(size):
+    ''' filter_results and output at ten times more stations per step,
+    from 10000 up to size '''
+    steps = []
+    step = 10000
+    while step < size:
+        steps.append(step)
+        step *= 10
+    steps.append(size)
+    stations = [Station.from_attrib(r) for r in
+                iter_synthetic_stations(size)]
+    provider = Shoutcast()
+    sorters = _generate_list_sorters('bl')[0]
+    report = {}
+    for step in steps:
+        part = stations[:step]
+        report['filter_{0}'.format(step)] = best_of(
+            lambda: filter_results(part, ['radio'], genre=['o'],
+                                   listeners_fn=lambda x: x > 0), 1)
+        report['sort_{0}'.format(step)] = best_of(
+            lambda: filter_results(part, sorters=sorters), 1)
+        report['top10_{0}'.format(step)] = best_of(
+            lambda: filter_results(part, limit=10), 1)
+        report['format_{0}'.format(step)] = best_of(
+            lambda: write_stations(part, '%s %b %l %u', provider,
+                                   io.StringIO()), 1)
+    return report
+
+
+def bench_table(size):
+    ''' filter_results vs StationTable on columns, if numpy is installed '''
+    try:
+        from shoutcast_search.table import StationTable
+    except ImportError:
+        return {}
+    stations = [Station.from_attrib(r) for r in
+                iter_synthetic_stations(size)]
+    table = StationTable.from_stations(stations)
+    bitrate_fn = _Expression('>', 64)
+    sorters = _generate_list_sorters('bl')[0]
+    report = {}
+    for name, criteria in (('filter', {'search': ['radio'],
+                                       'genre': ['o'],
+                                       'bitrate_fn': bitrate_fn}),
+                           ('sort', {'sorters': sorters}),
+                           ('top10', {'limit': 10})):
+        filters = dict((k, v) for k, v in criteria.items()
+                       if k not in ('sorters', 'limit'))
+        sorts = dict((k, v) for k, v in criteria.items()
+                     if k in ('sorters', 'limit'))
+        report['stations ' + name] = best_of(
+            lambda: filter_results(stations, **criteria), 1)
+        report['table ' + name] = best_of(
+            lambda: table.filter(**filters).order(**sorts), 1)
+    return report
+
+
+BENCHMARKS = [('filter', bench_filter, 100000),
+              ('merge', bench_merge, 20000),
+              ('sort', bench_sort, 100000),
+              ('format', bench_format, 100000),
+              ('fanout', bench_fanout, 500),
+              ('parse', bench_parse, 20000),
+              ('scale', bench_scale, 1000000),
+              ('table', bench_table, 100000)]
+
+
+def compare(baseline, report, threshold=1.2):
+    ''' Return [(benchmark, case, baseline seconds, seconds)] for the cases
+    of report taking more than threshold times their time in baseline, a
+    report of an earlier run. Cases missing from either are skipped. '''
+    slower = []
+    for name, result in sorted(report.items()):
+        before = baseline.get(name, {})
+        if before.get('size') != result['size']:
+            continue
+        for case, seconds in sorted(result['seconds'].items()):
+            old = before['seconds'].get(case)
+            if old and seconds > old * threshold:
+                slower.append((name, case, old, seconds))
+    return slower
+
+
+def main(argv=None):
+    o = argparse.ArgumentParser(description='Benchmark shoutcast_search.')
+    o.add_argument('names', nargs='*', action='store',
+                   help='benchmarks to run, default all: {0}'.format(
+                       ', '.join(name for name, fn, size in BENCHMARKS)))
+    o.add_argument('--size', dest='size', action='store', type=int,
+                   default=0, help='number of stations, default per benchmark')
+    o.add_argument('--json', dest='json', action='store_true', default=False,
+                   help='print results as JSON.')
+    o.add_argument('--save', dest='save', action='store', default=None,
+                   metavar='FILE', help='also write the results as JSON to '
+                   'FILE, e.g. to compare with later.')
+    o.add_argument('--compare', dest='compare', action='store',
+                   default=None, metavar='FILE',
+                   help=('compare with results saved before and exit with '
+                         'status 1 if a case got slower than THRESHOLD.'))
+    o.add_argument('--threshold', dest='threshold', action='store',
+                   type=float, default=1.2,
+                   help='slowdown counted as a regression, default 1.2.')
+    args = o.parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    names = set(name for name, fn, size in BENCHMARKS)
+    if set(args.names) - names:
+        o.error('unknown benchmark: {0}'.format(
+            ', '.join(sorted(set(args.names) - names))))
+
+    report = {}
+    for name, fn, size in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        size = args.size or size
+        report[name] = {'size': size, 'seconds': fn(size)}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print('Python {0} ({1})'.format(platform.python_version(),
+                                        platform.python_implementation()))
+        for name, result in report.items():
+            print('{0} ({1} stations)'.format(name, result['size']))
+            for case, seconds in result['seconds'].items():
+                print('  {0:<28} {1:10.4f}s'.format(case, seconds))
+    if baseline is not None:
+        slower = compare(baseline, report, args.threshold)
+        for name, case, old, seconds in slower:
+            print('{0} {1}: {2:.4f}s -> {3:.4f}s ({4:.2f}x)'.format(
+                name, case, old, seconds, seconds / old), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+    return report
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,283 @@
+#
+#   cache.py - on-disk cache for shoutcast_search web service responses
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import os
+import time
+
+from shoutcast_search.shoutcast_search import _count
+from shoutcast_search.shoutcast_search import _timer
+
+# Seconds a response is served without asking the server again
+DEFAULT_TTL = {'search': 60, 'genres': 24 * 60 * 60, 'tunein': 10 * 60}
+
+
+def default_cache_dir():
+    ''' $XDG_CACHE_HOME/shoutcast-search, usually ~/.cache/shoutcast-search '''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'shoutcast-search')
+
+
+class ResponseCache(object):
+    ''' Size-bounded LRU cache of web service responses, stored on disk.
+
+      directory - where to keep the cached responses.
+      ttl - dict mapping endpoint ('search', 'genres', or 'tunein' for the
+            playlists fetched by resolver) to the number of seconds a
+            response is used without contacting the server. Missing
+            endpoints use DEFAULT_TTL.
+      max_size - total number of bytes kept. The least recently used
+                 responses are removed first.
+      refresh - revalidate every response with the server, even if it is
+                still fresh.
+
+    Stale responses are revalidated with If-None-Match / If-Modified-Since
+    when the server sent an ETag or Last-Modified header, so an unchanged
+    response costs a 304 instead of a full download. Only http and https
+    URLs are cached.
+    '''
+
+    suffix = '.cache'
+
+    def __init__(self, directory=None, ttl=None, max_size=16 * 1024 * 1024,
+                 refresh=False):
+        self.directory = directory or default_cache_dir()
+        self.ttl = dict(DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+        self.max_size = max_size
+        self.refresh = refresh
+
+    def _path(self, url):
+        digest = hashlib.sha1(url.encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, digest + self.suffix)
+
+    def _open(self, path):
+        ''' Return (metadata, file) for a cache file, the file positioned
+        at the start of the body, or None. '''
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        try:
+            meta = json.loads(f.readline().decode('UTF-8'))
+            meta['fetched']
+        except (OSError, ValueError, KeyError, TypeError):
+            f.close()
+            return None
+        return meta, f
+
+    def _create(self, meta):
+        ''' Start a cache file in a temporary file. Returns (file, temporary
+        path), or (None, None) if it cannot be written, e.g. to a read only
+        directory; the response is then just not cached. '''
+        import tempfile
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        except OSError:
+            return None, None
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(json.dumps(meta).encode('UTF-8') + b'\n')
+        except OSError:
+            self._discard(f, tmp)
+            return None, None
+        return f, tmp
+
+    def _discard(self, f, tmp):
+        try:
+            f.close()
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    def _commit(self, f, tmp, path):
+        ''' Atomically put the temporary cache file tmp in place. '''
+        try:
+            f.close()
+            os.replace(tmp, path)
+        except OSError:
+            self._discard(f, tmp)
+
+    def _save(self, path, meta, body):
+        ''' Write a cache file with the body read from the file body. '''
+        import shutil
+        f, tmp = self._create(meta)
+        if f is None:
+            return
+        try:
+            shutil.copyfileobj(body, f)
+        except OSError:
+            self._discard(f, tmp)
+            return
+        self._commit(f, tmp, path)
+
+    def _touch(self, path):
+        ''' Mark path as recently used. '''
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        ''' List (mtime, size, path) of all cached responses. '''
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        ''' Remove all cached responses. '''
+        for mtime, size, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def urlopen(self, transport, url, headers=None, endpoint='search',
+                timeout=None, deadline=None):
+        ''' Return a file-like object with the response body for url,
+        either from the cache or fetched with transport.urlopen. Fetched
+        bodies are passed on as they are read, and cached once they were
+        read to their end. timeout and deadline are passed on to
+        transport.urlopen.
+
+        With metrics enabled, the fetch is timed as the request stage and
+        the cache's own work as the cache stage; cache_hits and
+        cache_revalidations count the answers given from the cache.
+        '''
+        if not url.startswith(('http://', 'https://')):
+            with _timer('request'):
+                return transport.urlopen(url, headers, timeout=timeout)
+
+        with _timer('cache'):
+            path = self._path(url)
+            entry = self._open(path)
+            headers = dict(headers or {})
+            if entry is not None:
+                meta, body = entry
+                age = time.time() - meta['fetched']
+                if not self.refresh and age < self.ttl.get(endpoint, 0):
+                    self._touch(path)
+                    _count('cache_hits')
+                    return body
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('last_modified'):
+                    headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            with _timer('request'):
+                resp = transport.urlopen(url, headers, timeout=timeout,
+                                         deadline=deadline)
+                status = getattr(resp, 'status', None) or 200
+                if status == 304 and entry is not None:
+                    with resp:
+                        resp.read()
+        except BaseException:
+            if entry is not None:
+                body.close()
+            raise
+        if status == 304 and entry is not None:
+            with _timer('cache'):
+                # The file stays readable when replaced
+                start = body.tell()
+                meta['fetched'] = time.time()
+                self._save(path, meta, body)
+                body.seek(start)
+                _count('cache_revalidations')
+                return body
+        if entry is not None:
+            body.close()
+
+        meta = {'url': url,
+                'fetched': time.time(),
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified')}
+        return _CachingResponse(self, resp, path, meta)
+
+
+class _CachingResponse(object):
+    ''' Response passing the body of resp on while writing it to a
+    temporary cache file, which is put in place once the body was read to
+    its end. Closed before, the response is not cached.
+    '''
+
+    def __init__(self, cache, resp, path, meta):
+        self._cache = cache
+        self._resp = resp
+        self._path = path
+        self.status = getattr(resp, 'status', None)
+        self.headers = resp.headers
+        self._file, self._tmp = cache._create(meta)
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._resp.read()
+        else:
+            data = self._resp.read(amt)
+        if self._file is not None:
+            try:
+                self._file.write(data)
+            except OSError:
+                self._cache._discard(self._file, self._tmp)
+                self._file = None
+                return data
+            if amt is None or (amt and not data):
+                self._cache._commit(self._file, self._tmp, self._path)
+                self._file = None
+                self._cache._evict()
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._cache._discard(self._file, self._tmp)
+            self._file = None
+        self._resp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,124 @@
+#
+#   changes.py - change feed between successive search results
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search --changes STATE ..." prints how the result of a search
+changed since the last run with the same STATE file, as JSON lines:
+
+    {"event": "add", "id": "17082", "station": {"name": ..., "url": ...}}
+    {"event": "change", "id": "3026", "fields": {"lc": 331, "ct": "..."}}
+    {"event": "remove", "id": "576919"}
+
+The first run adds every station. STATE keeps the fields of every station
+of the last result, keyed by id, as gzip compressed JSON.
+'''
+
+import gzip
+import json
+import os
+import tempfile
+
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import station_record
+
+# Fields compared between runs, in the order they are stored
+STATE_FIELDS = ('name', 'mt', 'br', 'genre', 'ct', 'lc', 'url')
+STATE_VERSION = 1
+
+
+def station_state(station, url_by_id):
+    ''' Return the list of STATE_FIELDS values of station. '''
+    station = Station.coerce(station)
+    return [station.name, station.mt, station.br, station.genre, station.ct,
+            station.lc, station.url or url_by_id(station.id)]
+
+
+def diff(previous, stations, url_by_id):
+    ''' Compare stations with previous, a dict of id -> station_state.
+
+    Returns (events, state): the events turning previous into stations,
+    and the state of stations. Stations are added or changed in the order
+    given, then stations no longer there are removed.
+    '''
+    events = []
+    state = {}
+    for station in map(Station.coerce, stations):
+        current = station_state(station, url_by_id)
+        state[station.id] = current
+        before = previous.get(station.id)
+        if before is None:
+            events.append({'event': 'add', 'id': station.id,
+                           'station': station_record(station, url_by_id)})
+        elif before != current:
+            fields = dict((name, value) for name, old, value
+                          in zip(STATE_FIELDS, before, current)
+                          if old != value)
+            events.append({'event': 'change', 'id': station.id,
+                           'fields': fields})
+    for id in previous:
+        if id not in state:
+            events.append({'event': 'remove', 'id': id})
+    return events, state
+
+
+class ChangeFeed(object):
+    ''' Search results kept in a state file, to be compared with the next
+    results. A missing or unreadable state file counts as no stations.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, 'rt', encoding='UTF-8') as f:
+                document = json.load(f)
+        except (OSError, EOFError, ValueError):
+            return {}
+        if document.get('version') != STATE_VERSION:
+            return {}
+        return document['stations']
+
+    def save(self):
+        ''' Atomically replace the state file. '''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+                    f.write(json.dumps({'version': STATE_VERSION,
+                                        'stations': self.state},
+                                       separators=(',', ':')).encode('UTF-8'))
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def update(self, stations, url_by_id):
+        ''' Return the events since the last update, and remember
+        stations, saving the state file. '''
+        events, self.state = diff(self.state, stations, url_by_id)
+        self.save()
+        return events
+
+    def write(self, stations, url_by_id, out):
+        ''' Update with stations and write the events as JSON lines to
+        out. Returns the number of events. '''
+        events = self.update(stations, url_by_id)
+        out.write(''.join(json.dumps(event) + '\n' for event in events))
+        return len(events)
@@ -0,0 +1,216 @@
+#
+#   crawler.py - page through every genre of the station directory
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search crawl FILE" lists every station of the directory:
+the Top500 and every genre of get_genres(), each paged through with the
+web service's limit=offset,count parameter, several genres at a time.
+Every station is written once, as a JSON line like --output ndjson writes.
+
+Stations go to FILE.part as they arrive, and FILE.checkpoint records how
+far every genre got. An interrupted crawl, or one whose requests failed,
+is resumed by running the same command again. Once every genre is done
+FILE.part is renamed to FILE, so FILE is always a complete crawl.
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+from xml.etree.ElementTree import ParseError
+
+from shoutcast_search.shoutcast_search import station_record
+
+CHECKPOINT_VERSION = 1
+
+
+def _save_json(path, document):
+    ''' Atomically replace path with document as JSON. '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(document, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class Crawler(object):
+    ''' Crawls provider into the JSON lines file path.
+
+      page_size - stations asked for per request.
+      max_workers - genres crawled at the same time.
+
+    offsets maps every genre to the offset of its next page, or None once
+    it is done; failures lists (genre, offset, error) of the pages that
+    could not be fetched or parsed in the last run().
+    '''
+
+    def __init__(self, provider, path, page_size=500, max_workers=4):
+        self.provider = provider
+        self.path = path
+        self.part_path = path + '.part'
+        self.checkpoint_path = path + '.checkpoint'
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.offsets = None
+        self.seen = set()
+        self.failures = []
+
+    def _load(self):
+        ''' Resume from the checkpoint, if any. Returns whether there was
+        one. '''
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if checkpoint.get('version') != CHECKPOINT_VERSION or \
+                checkpoint.get('page_size') != self.page_size:
+            return False
+        try:
+            with open(self.part_path, 'rb+') as f:
+                data = f.read()
+                # Drop a line cut short by the interruption
+                end = data.rfind(b'\n') + 1
+                f.truncate(end)
+        except OSError:
+            return False
+        for line in data[:end].splitlines():
+            self.seen.add(json.loads(line.decode('UTF-8'))['id'])
+        self.offsets = checkpoint['offsets']
+        return True
+
+    def _save(self):
+        _save_json(self.checkpoint_path, {'version': CHECKPOINT_VERSION,
+                                          'page_size': self.page_size,
+                                          'offsets': self.offsets})
+
+    def _fetch(self, genre, offset):
+        params = {'genre': genre,
+                  'limit': '{0:d},{1:d}'.format(offset, self.page_size)}
+        return self.provider.get_search_results(params)
+
+    def run(self, restart=False):
+        ''' Crawl, resuming an interrupted crawl unless restart is set.
+        Returns the number of stations written in total. When pages failed,
+        see failures, the crawl is left to be resumed. '''
+        self.failures = []
+        if restart or not self._load():
+            self.seen = set()
+            genres = ['Top500'] + [g for g in self.provider.get_genres()
+                                   if g != 'Top500']
+            self.offsets = dict((genre, 0) for genre in genres)
+            open(self.part_path, 'wb').close()
+            self._save()
+
+        pending = [g for g, offset in self.offsets.items()
+                   if offset is not None]
+        pending.reverse()  # popped from the end, in genre order
+        first_ids = {}  # genre -> id of its last page's first station
+        with open(self.part_path, 'a', encoding='UTF-8') as out, \
+                concurrent.futures.ThreadPoolExecutor(
+                    max(self.max_workers, 1)) as executor:
+            running = {}
+
+            def start_next():
+                while pending and len(running) < self.max_workers:
+                    genre = pending.pop()
+                    offset = self.offsets[genre]
+                    running[executor.submit(self._fetch, genre, offset)] = \
+                        (genre, offset)
+
+            start_next()
+            while running:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    genre, offset = running.pop(future)
+                    try:
+                        stations = future.result()
+                    except (OSError, ParseError) as e:
+                        self.failures.append((genre, offset, e))
+                        continue
+                    self._write(stations, out)
+                    # Stop at a short page, or when the offset is ignored
+                    # and the same page comes again
+                    first_id = stations[0]['id'] if stations else None
+                    if len(stations) < self.page_size or \
+                            first_ids.get(genre) == first_id:
+                        self.offsets[genre] = None
+                    else:
+                        first_ids[genre] = first_id
+                        self.offsets[genre] = offset + len(stations)
+                        pending.append(genre)
+                    out.flush()
+                    self._save()
+                start_next()
+
+        if not self.failures:
+            os.replace(self.part_path, self.path)
+            os.remove(self.checkpoint_path)
+        return len(self.seen)
+
+    def _write(self, stations, out):
+        url_by_id = self.provider.url_by_id
+        lines = []
+        for station in stations:
+            if station['id'] in self.seen:
+                continue
+            self.seen.add(station['id'])
+            lines.append(json.dumps(station_record(station, url_by_id)))
+        if lines:
+            out.write('\n'.join(lines) + '\n')
+
+
+def main(argv=None, provider=None):
+    ''' shoutcast-search crawl: write every station of the directory '''
+    o = argparse.ArgumentParser(
+        prog='shoutcast-search crawl',
+        description=('Write every station of the directory to FILE as JSON '
+                     'lines, paging through the Top500 and every genre. An '
+                     'interrupted crawl is resumed when run again.'))
+    o.add_argument('path', metavar='FILE', help='file to write.')
+    o.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=4, help='genres crawled at the same time.')
+    o.add_argument('--page-size', dest='page_size', action='store',
+                   type=int, default=500,
+                   help='stations asked for per request, default 500.')
+    o.add_argument('--restart', dest='restart', action='store_true',
+                   default=False,
+                   help='start over instead of resuming a crawl.')
+    args = o.parse_args(argv)
+    if args.jobs < 1 or args.page_size < 1:
+        o.error('JOBS and PAGE_SIZE must be at least 1')
+
+    if provider is None:
+        from shoutcast_search.shoutcast_search import Shoutcast
+        provider = Shoutcast()
+    crawler = Crawler(provider, args.path, args.page_size, args.jobs)
+    count = crawler.run(args.restart)
+    for genre, offset, error in crawler.failures:
+        sys.stderr.write('{0}: warning: {1} from {2:d} failed: {3}\n'.format(
+            o.prog, genre, offset, error))
+    if crawler.failures:
+        o.exit(1, '{0}: {1:d} page(s) failed, run again to resume\n'.format(
+            o.prog, len(crawler.failures)))
+    sys.stdout.write('{0:d} station(s) written to {1}\n'.format(
+        count, args.path))
+    return count
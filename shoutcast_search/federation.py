@@ -0,0 +1,183 @@
+#
+#   federation.py - search several station directories at once
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import heapq
+import queue
+import threading
+import time
+
+from shoutcast_search.shoutcast_search import Provider
+
+
+class FederatedProvider(Provider):
+    ''' Provider asking several providers in parallel and merging their
+    answers, for use with search() like any provider.
+
+      providers - the providers to ask, in order of preference.
+      timeout - seconds to wait for a provider's answer to one request.
+      timeouts - dict mapping provider names to their own timeout.
+      transport, limiter - see Provider, used for the requests the
+                           FederatedProvider makes itself, e.g. for
+                           tune-in playlists.
+
+    A provider that fails or does not answer in time is left out of the
+    answer, and (provider name, error) is appended to failures, which keeps
+    the last max_failures.
+
+    Stations are tagged with the 'directory' they come from and carry their
+    stream url. They are merged by listener count, highest first. Stations
+    with the same stream URL as a station with more listeners, or from an
+    earlier provider, are dropped, as are stations with the same name as
+    such a station of another provider: one provider may list several
+    stations of that name.
+    '''
+
+    name = 'federated'
+    max_failures = 100
+
+    def __init__(self, providers, timeout=10, timeouts=None, transport=None,
+                 limiter=None):
+        self.providers = list(providers)
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.failures = collections.deque(maxlen=self.max_failures)
+        self._lock = threading.Lock()
+        self._cache = None
+        Provider.__init__(self, transport, None, limiter)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        ''' The cache is shared by all providers. '''
+        self._cache = cache
+        for provider in self.providers:
+            provider.cache = cache
+
+    def _ask_all(self, ask):
+        ''' Call ask(provider) for every provider, each in its own thread,
+        and return [(provider, answer)] for those answering in time, in
+        provider order. Threads of late providers are left to finish in the
+        background; they do not keep the process from exiting.
+        '''
+        answers = queue.Queue()
+
+        def run(index, provider):
+            try:
+                answers.put((index, ask(provider), None))
+            except Exception as e:
+                answers.put((index, None, e))
+
+        start = time.monotonic()
+        deadlines = {}
+        for index, provider in enumerate(self.providers):
+            deadlines[index] = start + self.timeouts.get(provider.name,
+                                                         self.timeout)
+            thread = threading.Thread(target=run, args=(index, provider))
+            thread.daemon = True
+            thread.start()
+
+        results = {}
+        while deadlines:
+            now = time.monotonic()
+            for index in [i for i, d in deadlines.items() if d <= now]:
+                del deadlines[index]
+                self._failed(index, 'no answer within {0:g}s'.format(
+                    self.timeouts.get(self.providers[index].name,
+                                      self.timeout)))
+            if not deadlines:
+                break
+            try:
+                index, answer, error = answers.get(
+                    timeout=min(deadlines.values()) - now)
+            except queue.Empty:
+                continue
+            if index not in deadlines:
+                continue  # already given up on
+            del deadlines[index]
+            if error is not None:
+                self._failed(index, error)
+            else:
+                results[index] = answer
+        return [(self.providers[i], results[i]) for i in sorted(results)]
+
+    def _failed(self, index, error):
+        with self._lock:
+            self.failures.append((self.providers[index].name, error))
+
+    def iter_search_results(self, params, limit=0, predicate=None):
+        ''' See Provider.iter_search_results. Every provider is asked for
+        params; predicate is passed on to them.
+        '''
+        def ask(provider):
+            stations = []
+            for station in provider.iter_search_results(params, 0,
+                                                        predicate):
+                station.extra = dict(station.extra or {},
+                                     directory=provider.name)
+                station.url = station.url or provider.url_by_id(station.id)
+                stations.append(station)
+            stations.sort(key=lambda s: s.lc, reverse=True)
+            return stations
+
+        answers = [[(station, index) for station in stations]
+                   for index, (provider, stations)
+                   in enumerate(self._ask_all(ask))]
+        seen_urls = set()
+        seen_names = {}  # name -> index of the answer it was kept from
+        count = 0
+        for station, index in heapq.merge(*answers,
+                                          key=lambda pair: -pair[0].lc):
+            name = ' '.join(station.name.lower().split())
+            if station.url in seen_urls or \
+                    (name and seen_names.get(name, index) != index):
+                continue
+            seen_urls.add(station.url)
+            seen_names.setdefault(name, index)
+            yield station
+            count += 1
+            if count == limit:
+                return
+
+    def close(self):
+        ''' Close the idle connections of this provider, its resolver and
+        all providers. '''
+        Provider.close(self)
+        for provider in self.providers:
+            provider.close()
+
+    def url_by_id(self, index):
+        ''' Stations found by a FederatedProvider carry their url; others
+        are taken to come from the first provider.
+        '''
+        return self.providers[0].url_by_id(index)
+
+    def get_genres(self):
+        ''' Returns the genres of all providers, without duplicates. '''
+        genres = []
+        seen = set()
+        for provider, answer in self._ask_all(lambda p: p.get_genres()):
+            for genre in answer:
+                if genre.lower() not in seen:
+                    seen.add(genre.lower())
+                    genres.append(genre)
+        return genres
@@ -0,0 +1,175 @@
+#
+#   metrics.py - counters and stage timers for the search pipeline
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' Where the time of a search goes. Once a Metrics is enabled, providers
+and the pipeline functions of shoutcast_search report to it:
+
+    request  - connecting and waiting for the response headers
+    cache    - looking up and storing cached responses, see cache
+    download - reading and decompressing response bodies, from the network
+               or the cache, and writing fetched ones to the cache
+    parse    - parsing XML into stations and genres, downloads excluded
+    merge    - leaving out stations found by several requests
+    filter   - matching stations against the criteria and filters
+    sort     - shuffling, sorting and truncating
+    resolve  - fetching playlists and probing streams, see resolver
+    format   - formatting and writing stations
+
+and count requests, retries, cache hits and revalidations, bytes
+(decompressed), stations, genres, duplicates and matches. Stage times are
+summed over threads, so with concurrent requests they may add up to more
+than the wall clock time.
+
+"shoutcast-search --profile" prints them after a search,
+"shoutcast-search serve" exports them at /metrics.
+'''
+
+import threading
+import time
+
+from shoutcast_search import shoutcast_search
+
+STAGES = ('request', 'cache', 'download', 'parse', 'merge', 'filter',
+          'sort', 'resolve', 'format')
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Metrics(object):
+    ''' Thread safe counters and stage timers.
+
+      callback - optional function called as callback(kind, name, value)
+                 for every measurement, kind being 'count' or 'time'.
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.counters = {}
+        self.timers = {}  # name -> [calls, seconds]
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.callback is not None:
+            self.callback('count', name, n)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+        if self.callback is not None:
+            self.callback('time', name, seconds)
+
+    def timer(self, name):
+        ''' Return a context manager adding the time spent in it to the
+        stage name. '''
+        return _Timer(self, name)
+
+    def snapshot(self):
+        ''' Return {'counters': {name: n}, 'timers': {name: {'calls': n,
+        'seconds': s}}}, a copy of the measurements so far. '''
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timers': dict((name, {'calls': calls,
+                                           'seconds': seconds})
+                                   for name, (calls, seconds)
+                                   in self.timers.items())}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def _stages(self, timers):
+        return [name for name in STAGES if name in timers] + \
+            sorted(name for name in timers if name not in STAGES)
+
+    def report(self, wall=None):
+        ''' Return the measurements as a table for people, stages in
+        pipeline order. wall, the elapsed time, adds each stage's share. '''
+        snapshot = self.snapshot()
+        timers = snapshot['timers']
+        lines = ['{0:<10} {1:>8} {2:>11}{3}'.format(
+            'stage', 'calls', 'seconds', wall and '  share' or '')]
+        for name in self._stages(timers):
+            timer = timers[name]
+            share = ''
+            if wall:
+                share = ' {0:6.1%}'.format(timer['seconds'] / wall)
+            lines.append('{0:<10} {1:>8d} {2:11.6f}{3}'.format(
+                name, timer['calls'], timer['seconds'], share))
+        if wall:
+            lines.append('{0:<10} {1:>8} {2:11.6f}'.format('total', '',
+                                                           wall))
+        for name, n in sorted(snapshot['counters'].items()):
+            lines.append('{0:<10} {1:>8d}'.format(name, n))
+        return '\n'.join(lines) + '\n'
+
+    def prometheus(self, prefix='shoutcast_search'):
+        ''' Return the measurements in the Prometheus text format. '''
+        snapshot = self.snapshot()
+        timers = snapshot['timers']
+        lines = []
+        for name, n in sorted(snapshot['counters'].items()):
+            metric = '{0}_{1}_total'.format(prefix, name)
+            lines.append('# TYPE {0} counter'.format(metric))
+            lines.append('{0} {1:d}'.format(metric, n))
+        if timers:
+            lines.append('# TYPE {0}_stage_seconds_total counter'.format(
+                prefix))
+            for name in self._stages(timers):
+                lines.append('{0}_stage_seconds_total{{stage="{1}"}} '
+                             '{2!r}'.format(prefix, name,
+                                            timers[name]['seconds']))
+            lines.append('# TYPE {0}_stage_calls_total counter'.format(
+                prefix))
+            for name in self._stages(timers):
+                lines.append('{0}_stage_calls_total{{stage="{1}"}} '
+                             '{2:d}'.format(prefix, name,
+                                            timers[name]['calls']))
+        return '\n'.join(lines) + '\n'
+
+
+def enable(metrics=None):
+    ''' Make providers and pipeline functions report to metrics, a new
+    Metrics by default, and return it. '''
+    if metrics is None:
+        metrics = Metrics()
+    shoutcast_search._metrics = metrics
+    return metrics
+
+
+def disable():
+    ''' Stop reporting. '''
+    shoutcast_search._metrics = None
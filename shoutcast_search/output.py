@@ -0,0 +1,121 @@
+#
+#   output.py - machine readable output of stations
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search --output FORMAT ..." writes one record per station
+instead of formatted text, for other programs to read:
+
+    ndjson  - a JSON object per line, {"name": ..., "br": 128, "url": ...}
+    csv     - a header line, then the STATION_COLUMNS and extra fields of
+              every station
+    msgpack - a stream of MessagePack maps, needs the msgpack package
+
+Bitrate and listener count are numbers and every record carries the
+station's url. Records are written as the stations come, every
+flush_every records are flushed, so readers can start right away.
+'''
+
+import csv
+import importlib.util
+import io
+import itertools
+import json
+
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import station_record
+
+STATION_COLUMNS = Station.fields + ('url',)
+
+
+def write_ndjson(stations, url_by_id, out, flush_every=256):
+    ''' Write stations to out, a text stream, as JSON lines. Returns the
+    number of stations written. '''
+    count = 0
+    for count, station in enumerate(stations, 1):
+        out.write(json.dumps(station_record(station, url_by_id)) + '\n')
+        if count % flush_every == 0:
+            out.flush()
+    out.flush()
+    return count
+
+
+def write_csv(stations, url_by_id, out, flush_every=256):
+    ''' Write stations to out, a text stream, as CSV with a header line.
+    The columns are STATION_COLUMNS, then the extra fields of the first
+    station, such as 'stream' and 'alive' when streams are resolved. Other
+    stations leave the extra columns they lack empty, and extra fields the
+    first station lacks are left out. Returns the number of stations
+    written. '''
+    records = (station_record(station, url_by_id) for station in stations)
+    first = next(records, None)
+    columns = STATION_COLUMNS
+    if first is not None:
+        columns += tuple(key for key in first if key not in STATION_COLUMNS)
+        records = itertools.chain([first], records)
+    writer = csv.DictWriter(out, columns, restval='', extrasaction='ignore',
+                            lineterminator='\n')
+    writer.writeheader()
+    count = 0
+    for count, record in enumerate(records, 1):
+        writer.writerow(record)
+        if count % flush_every == 0:
+            out.flush()
+    out.flush()
+    return count
+
+
+def write_msgpack(stations, url_by_id, out, flush_every=256):
+    ''' Write stations to out, a binary stream, as MessagePack maps.
+    Returns the number of stations written. Raises ImportError if msgpack
+    is not installed. '''
+    import msgpack
+    packer = msgpack.Packer()
+    count = 0
+    for count, station in enumerate(stations, 1):
+        out.write(packer.pack(station_record(station, url_by_id)))
+        if count % flush_every == 0:
+            out.flush()
+    out.flush()
+    return count
+
+
+# Writers by --output name, and whether they write bytes
+WRITERS = {'ndjson': (write_ndjson, False),
+           'csv': (write_csv, False),
+           'msgpack': (write_msgpack, True)}
+
+
+def check_output(name, out=None):
+    ''' Return an error message if the writer name cannot be used, to
+    write to out if given, else None. '''
+    if WRITERS[name][1] and out is not None and \
+            isinstance(out, io.TextIOBase) and not hasattr(out, 'buffer'):
+        return '--output {0} writes bytes, not text'.format(name)
+    if name == 'msgpack' and importlib.util.find_spec('msgpack') is None:
+        return ('--output msgpack needs the msgpack package, install it '
+                'with "pip install msgpack"')
+    return None
+
+
+def write_output(name, stations, url_by_id, out):
+    ''' Write stations to out with the writer name. Bytes go to the binary
+    buffer of out, when it has one. Returns the number of stations. '''
+    writer, binary = WRITERS[name]
+    if binary:
+        out.flush()
+        out = getattr(out, 'buffer', out)
+    return writer(stations, url_by_id, out)
@@ -0,0 +1,215 @@
+#
+#   resolver.py - resolve tune-in playlists to streams and probe them
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' A station's url is usually a tune-in playlist (.pls or .m3u) listing
+the addresses of its streams. "shoutcast-search --resolve" fetches the
+playlists of the stations found, many at a time, and "--probe" connects to
+the first stream of each to see whether it is up. The format codes %U and
+%A print the stream and whether it is up, and --output records carry them
+as 'stream' and 'alive'.
+'''
+
+import collections
+import concurrent.futures
+import socket
+import threading
+import time
+import urllib.parse
+
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.transport import HTTPConnectionPool
+
+# Station urls with these endings are playlists, others streams
+PLAYLIST_SUFFIXES = ('.pls', '.m3u', '.m3u8')
+
+
+def parse_playlist(text):
+    ''' Return the stream urls listed by a .pls or .m3u playlist. '''
+    streams = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', '[')):
+            continue
+        key, sep, value = line.partition('=')
+        if sep and key.lower().startswith('file'):
+            line = value.strip()
+        elif sep and '://' not in key:
+            continue  # Title1=..., Length1=... or NumberOfEntries=...
+        if line.startswith(('http://', 'https://')):
+            streams.append(line)
+    return streams
+
+
+def is_playlist(url):
+    return urllib.parse.urlsplit(url).path.lower().endswith(
+        PLAYLIST_SUFFIXES)
+
+
+def probe(url, timeout=3):
+    ''' Connect to the stream url and return True if its server answers
+    the request with a 2xx or 3xx status line, as shoutcast ("ICY 200 OK")
+    and other HTTP servers do, within timeout seconds, else False. A raw
+    socket is used since http.client does not accept ICY answers.
+    '''
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == 'https'
+    try:
+        port = parts.port or (443 if https else 80)
+        host = parts.hostname
+        sock = socket.create_connection((host, port), timeout)
+    except (OSError, ValueError):
+        return False
+    try:
+        if https:
+            import ssl
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=host)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        sock.sendall('GET {0} HTTP/1.0\r\nHost: {1}\r\nIcy-MetaData: 0\r\n'
+                     'User-Agent: shoutcast-search\r\n\r\n'.format(
+                         path, parts.netloc).encode('latin-1'))
+        head = b''
+        while b'\n' not in head and len(head) < 1024:
+            data = sock.recv(1024)
+            if not data:
+                break
+            head += data
+    except (OSError, UnicodeError):
+        return False
+    finally:
+        sock.close()
+    status = head.split(b'\n', 1)[0].split()
+    return len(status) >= 2 and status[1][:1] in (b'2', b'3') and \
+        status[0].upper().startswith((b'ICY', b'HTTP/'))
+
+
+class Resolver(object):
+    ''' Resolves station urls to stream urls and probes streams, keeping
+    the answers for ttl seconds, failures for failure_ttl seconds.
+
+      transport - HTTPConnectionPool for the playlists, by default one of
+                  its own.
+      max_workers - playlists fetched and streams probed at a time.
+      timeout - seconds to wait for a playlist.
+      probe_timeout - seconds to wait for a stream to answer.
+      opener - function called as opener(url, timeout) to open a playlist,
+               e.g. one making the request with Provider._open. By default
+               transport.urlopen.
+      max_entries - playlists and streams kept each; the least recently
+                    used are dropped first.
+    '''
+
+    def __init__(self, transport=None, max_workers=16, timeout=5,
+                 probe_timeout=3, ttl=600, clock=time.monotonic,
+                 opener=None, failure_ttl=30, max_entries=10000):
+        if transport is None:
+            transport = HTTPConnectionPool(max_workers, timeout)
+        self.transport = transport
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.probe_timeout = probe_timeout
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.opener = opener
+        self._streams = collections.OrderedDict()  # url -> (expires, urls)
+        self._alive = collections.OrderedDict()  # stream -> (expires, bool)
+        self._lock = threading.Lock()
+
+    def _cached(self, cache, key):
+        with self._lock:
+            entry = cache.get(key)
+            if entry is not None and entry[0] > self.clock():
+                cache.move_to_end(key)
+                return entry[1]
+            cache.pop(key, None)
+        return None
+
+    def _keep(self, cache, key, value):
+        ttl = self.ttl if value else self.failure_ttl
+        with self._lock:
+            cache[key] = (self.clock() + ttl, value)
+            cache.move_to_end(key)
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+        return value
+
+    def _fetch(self, url):
+        if self.opener is not None:
+            return self.opener(url, self.timeout)
+        return self.transport.urlopen(url, timeout=self.timeout)
+
+    def streams(self, url):
+        ''' Return the stream urls of the station url: those listed by
+        the playlist, [url] if url is no playlist, or [] if the playlist
+        cannot be fetched. '''
+        if not is_playlist(url):
+            return [url]
+        streams = self._cached(self._streams, url)
+        if streams is not None:
+            return streams
+        try:
+            with self._fetch(url) as resp:
+                text = resp.read().decode('UTF-8', 'replace')
+            streams = parse_playlist(text)
+        except (OSError, ValueError):
+            streams = []
+        return self._keep(self._streams, url, streams)
+
+    def alive(self, stream, timeout=None):
+        ''' Return whether stream answers within timeout seconds, by
+        default probe_timeout, see probe(). '''
+        alive = self._cached(self._alive, stream)
+        if alive is None:
+            if timeout is None:
+                timeout = self.probe_timeout
+            alive = self._keep(self._alive, stream, probe(stream, timeout))
+        return alive
+
+    def resolve(self, url, check=False, probe_timeout=None):
+        ''' Return (first stream url or '', whether it is up) for the
+        station url; whether it is up is None unless check is set. '''
+        streams = self.streams(url)
+        stream = streams[0] if streams else ''
+        alive = None
+        if check:
+            alive = bool(stream) and self.alive(stream, probe_timeout)
+        return stream, alive
+
+    def resolve_all(self, stations, url_by_id, check=False,
+                    max_workers=None, probe_timeout=None):
+        ''' Resolve the urls of stations, probing the streams if check is
+        set, max_workers at a time. max_workers and probe_timeout default to
+        the resolver's. Returns the stations, with 'stream' and with check
+        'alive' set in their extra fields. '''
+        if max_workers is None:
+            max_workers = self.max_workers
+        stations = [Station.coerce(station) for station in stations]
+        urls = [s.url or url_by_id(s.id) for s in stations]
+        with concurrent.futures.ThreadPoolExecutor(
+                max(1, min(max_workers, len(urls)))) as pool:
+            answers = list(pool.map(
+                lambda url: self.resolve(url, check, probe_timeout), urls))
+        for station, (stream, alive) in zip(stations, answers):
+            extra = dict(station.extra or {}, stream=stream)
+            if check:
+                extra['alive'] = alive
+            station.extra = extra
+        return stations
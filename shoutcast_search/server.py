@@ -0,0 +1,357 @@
+#
+#   server.py - long running shoutcast-search server and its thin client
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search serve" keeps one provider, with its pooled connections
+and response cache, alive and answers command lines sent to it as JSON over
+HTTP, on a TCP port or a Unix socket:
+
+    POST /search  {"argv": ["-n", "10", "-g", "Rock"]}
+    ->            {"status": 0, "output": "...", "error": null,
+                   "warnings": ""}
+
+status, output and error are the exit status, standard output and error
+message the same command line would have given, warnings what it would
+have printed on standard error besides. Only criteria, filters, sorters
+and formats are served (see SERVED_OPTIONS); command lines with other
+options are refused with 400 Bad Request. With the environment
+variable SHOUTCAST_SEARCH_SERVER set to the server address (host:port or
+unix:/path/to/socket), shoutcast-search sends its command line there and
+only runs the search itself if the server cannot be reached or would
+refuse it.
+
+    GET /metrics
+
+answers the counters and stage timers of all searches so far (see
+shoutcast_search.metrics) in the Prometheus text format.
+'''
+
+import argparse
+import http.client
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from shoutcast_search import metrics
+from shoutcast_search.cache import ResponseCache
+from shoutcast_search.output import WRITERS
+from shoutcast_search.shoutcast_search import Shoutcast
+from shoutcast_search.shoutcast_search import _ParserExit
+from shoutcast_search.shoutcast_search import _RequestParser
+from shoutcast_search.shoutcast_search import _build_parser
+from shoutcast_search.shoutcast_search import _given_options
+from shoutcast_search.shoutcast_search import _run
+
+
+DEFAULT_ADDRESS = '127.0.0.1:8711'
+
+# Destinations of the options a served command line may use. The others
+# read or write files relative to the server, bypass or clear its cache,
+# tune its thread pools, choose other directories than its provider's or
+# keep running after the answer.
+SERVED_OPTIONS = frozenset([
+    'keywords', 'do_list_genres', 'limit', 'random', 'verbose', 'format',
+    'output', 'genre', 'song', 'station', 'bitrate', 'listeners', 'codec',
+    'sort_rules', 'resolve', 'probe', 'help'])
+
+
+def _parser(out):
+    o = _build_parser(_RequestParser)
+    o.prog = 'shoutcast-search'
+    o.output = out
+    o.errors = io.StringIO()
+    return o
+
+
+def _refusal(o, args):
+    ''' Return the error message refusing the options of args the server
+    does not run, None if there are none. '''
+    given = _given_options(o, args)
+    if 'watch' in given:
+        return '--watch runs until interrupted, run it without the server'
+    if args.output and WRITERS[args.output][1]:
+        return '--output {0} writes bytes, which the server cannot ' \
+            'answer'.format(args.output)
+    refused = [option for dest, option in given.items()
+               if dest not in SERVED_OPTIONS]
+    if not refused:
+        return None
+    return 'not allowed by the server: {0}'.format(', '.join(refused))
+
+
+def check(argv):
+    ''' Return the error message the server refuses the command line argv
+    with, None if it would run it. Invalid command lines are run, to tell
+    what is wrong with them. '''
+    o = _parser(io.StringIO())
+    try:
+        args = o.parse_args(argv)
+    except _ParserExit:
+        return None
+    return _refusal(o, args)
+
+
+def execute(provider, argv, warnings=None):
+    ''' Run the shoutcast-search command line argv with provider.
+    Returns (exit status, output, error message or None). Warnings are
+    written to warnings, a file-like object, if given. Command lines using
+    options besides SERVED_OPTIONS are refused with status 2.
+    '''
+    out = io.StringIO()
+    o = _parser(out)
+    try:
+        args = o.parse_args(argv)
+        refusal = _refusal(o, args)
+        if refusal is not None:
+            o.error(refusal)
+        status, message = _run(args, o, provider, out,
+                               warnings or io.StringIO())
+    except _ParserExit as e:
+        status = e.status
+        message = (o.errors.getvalue() + (e.message or '')) or None
+    return status, out.getvalue(), message
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, document):
+        body = json.dumps(document).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        elif self.path == '/metrics' and self.server.metrics is not None:
+            body = self.server.metrics.prometheus().encode('UTF-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/search':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            argv = json.loads(self.rfile.read(length).decode('UTF-8'))['argv']
+            if not all(isinstance(arg, str) for arg in argv):
+                raise ValueError(argv)
+        except (KeyError, TypeError, ValueError):
+            self._reply(400, {'error': 'expected {"argv": [...]}'})
+            return
+        refusal = check(argv)
+        if refusal is not None:
+            self._reply(400, {'error': refusal})
+            return
+        warnings = io.StringIO()
+        if self.server.metrics is not None:
+            self.server.metrics.count('searches')
+        status, output, error = execute(self.server.provider, argv, warnings)
+        self._reply(200, {'status': status, 'output': output,
+                          'error': error, 'warnings': warnings.getvalue()})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address and self.client_address[0])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SearchServer(socketserver.ThreadingMixIn, HTTPServer):
+    ''' Threaded HTTP server answering searches with one shared provider '''
+
+    daemon_threads = True
+
+    def __init__(self, address, provider, verbose=False, metrics=None):
+        HTTPServer.__init__(self, address, SearchHandler)
+        self.provider = provider
+        self.verbose = verbose
+        self.metrics = metrics
+
+
+class UnixSearchServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    ''' SearchServer listening on a Unix socket '''
+
+    daemon_threads = True
+
+    def __init__(self, path, provider, verbose=False, metrics=None):
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise FileExistsError('{0} exists and is not a socket'
+                                      .format(path))
+            os.remove(path)  # left over from an earlier run
+        socketserver.UnixStreamServer.__init__(self, path, SearchHandler)
+        self.provider = provider
+        self.verbose = verbose
+        self.metrics = metrics
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass  # already closed
+
+
+def make_server(address, provider, verbose=False, metrics=None):
+    ''' Return a server for address, 'host:port' or 'unix:/path'. With
+    metrics, a metrics.Metrics, it is served at /metrics. '''
+    if address.startswith('unix:'):
+        return UnixSearchServer(address[len('unix:'):], provider, verbose,
+                                metrics)
+    host, port = address.rsplit(':', 1)
+    return SearchServer((host, int(port)), provider, verbose, metrics)
+
+
+# Client
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost',
+                                            timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(address, argv, timeout=60):
+    ''' Run argv on the server at address.
+    Returns (exit status, output, error message or None). Raises OSError
+    or http.client.HTTPException if the server cannot be reached.
+    '''
+    document = _request(address, argv, timeout)
+    return document['status'], document['output'], document['error']
+
+
+def _request(address, argv, timeout=60):
+    ''' Like request, returning the whole answer document. '''
+    if address.startswith('unix:'):
+        conn = _UnixHTTPConnection(address[len('unix:'):], timeout)
+    else:
+        if '://' in address:
+            address = address.split('://', 1)[1]
+        conn = http.client.HTTPConnection(address.rstrip('/'),
+                                          timeout=timeout)
+    try:
+        conn.request('POST', '/search', json.dumps({'argv': argv}),
+                     {'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        document = json.loads(resp.read().decode('UTF-8'))
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise http.client.HTTPException(document.get('error'))
+    return document
+
+
+def forward(address, argv):
+    ''' Run argv on the server at address and print its answer like
+    shoutcast-search would, exiting with its status. Returns False, having
+    done nothing, if the server cannot be reached or argv uses options it
+    refuses; these are never sent.
+    '''
+    if check(argv) is not None:
+        return False
+    try:
+        document = _request(address, argv)
+        status = document['status']
+        output = document['output']
+        error = document['error']
+    except (OSError, http.client.HTTPException, ValueError, KeyError):
+        return False
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    sys.stderr.write(document.get('warnings') or '')
+    if error:
+        if status == 2:  # usage error, already formatted by argparse
+            sys.stderr.write(error)
+        else:
+            sys.stderr.write('{0}: {1}\n'.format(sys.argv[0], error))
+    if status:
+        sys.exit(status)
+    return True
+
+
+def main(argv=None, provider=None):
+    ''' shoutcast-search serve: answer searches until interrupted '''
+    o = argparse.ArgumentParser(
+        prog='shoutcast-search serve',
+        description=('Keep a warm provider and answer shoutcast-search '
+                     'command lines sent as JSON over HTTP. Point '
+                     'shoutcast-search at it with SHOUTCAST_SEARCH_SERVER.'))
+    o.add_argument('--listen', dest='address', action='store',
+                   default=DEFAULT_ADDRESS,
+                   help=('host:port or unix:/path/to/socket, default '
+                         '{0}.'.format(DEFAULT_ADDRESS)))
+    o.add_argument('--cache-dir', dest='cache_dir', action='store',
+                   default=None,
+                   help='cache directory, default ~/.cache/shoutcast-search.')
+    o.add_argument('--no-cache', dest='no_cache', action='store_true',
+                   default=False, help='do not cache responses on disk.')
+    o.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                   default=False, help='log requests.')
+    o.add_argument('--no-metrics', dest='no_metrics', action='store_true',
+                   default=False,
+                   help='do not measure searches, nor serve /metrics.')
+    args = o.parse_args(argv)
+
+    if provider is None:
+        provider = Shoutcast()
+    if not args.no_cache:
+        provider.cache = ResponseCache(args.cache_dir)
+    measured = None
+    if not args.no_metrics:
+        measured = metrics.enable()
+    try:
+        server = make_server(args.address, provider, args.verbose, measured)
+    except OSError as e:
+        provider.close()
+        if measured is not None:
+            metrics.disable()
+        o.error('cannot listen on {0}: {1}'.format(args.address, e))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+        provider.close()
+        if measured is not None:
+            metrics.disable()
@@ -20,14 +20,21 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+# Modules only needed once stations are fetched, parsed or shuffled
+# (xml.etree, random, concurrent.futures, the transport and the cache) are
+# imported where they are used, so that --help, usage errors and answers
+# from a running server start quickly.
 import argparse
+import functools
+import heapq
+import operator
+import os
 import re
-import random
 import sys
-import urllib.request
-import urllib.parse
-import urllib.error
-import xml.etree.ElementTree as ET
+import time
+from collections.abc import Mapping
+
+from shoutcast_search import __description__
 
 
 # Utility methods
@@ -35,13 +42,48 @@ def _from_UTF_8(inbytes):
     return str(inbytes, 'UTF-8')
 
 
+def _iter_attribs(source, tag):
+    ''' Incrementally parse XML from the file-like source and yield the
+    attribute dict of every tag element. Elements are dropped from the tree
+    as soon as they have been seen, so memory use does not grow with the
+    size of the document.
+    '''
+    import xml.etree.ElementTree as ET
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == tag:
+            yield elem.attrib
+            root.clear()
+
+
+def _iter_entries(source, tag):
+    ''' Like _iter_attribs, for documents listing the details as child
+    elements: yield a {child tag: child text} dict for every tag element.
+    '''
+    import xml.etree.ElementTree as ET
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == tag:
+            yield dict((child.tag, (child.text or '').strip())
+                       for child in elem)
+            root.clear()
+
+
 def get_egg_description():
-    import pkg_resources
-    dist = pkg_resources.get_distribution("shoutcast-search")
-    for line in dist.get_metadata(dist.PKG_INFO).splitlines():
-        if line.lower().startswith('description:'):
-            return line.split(':', 1)[1].strip()
-    return ''  # pragma: no cover
+    ''' Return the long description of the installed distribution, or the
+    one shipped with the module if it is not installed.
+    '''
+    from importlib import metadata
+    try:
+        dist = metadata.metadata('shoutcast_search')
+    except metadata.PackageNotFoundError:  # pragma: no cover
+        return __description__
+    description = dist.get('Description') or dist.get_payload() or ''
+    return description.strip() or __description__
 
 
 def _fail_exit(code, msg):
@@ -49,18 +91,132 @@ def _fail_exit(code, msg):
     sys.exit(code)
 
 
+# Instrumentation: a shoutcast_search.metrics.Metrics set by
+# metrics.enable(), or None when nothing is measured
+_metrics = None
+
+
+class _NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def _timer(stage):
+    ''' Return a context manager timing stage, if metrics are enabled. '''
+    metrics = _metrics
+    if metrics is None:
+        return _NO_TIMER
+    return metrics.timer(stage)
+
+
+def _count(name, n=1):
+    metrics = _metrics
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+class _MeteredResponse(object):
+    ''' Response counting the bytes read from it and timing the reads as
+    the download stage. seconds is the total time spent reading. '''
+
+    def __init__(self, response, metrics):
+        self._response = response
+        self._metrics = metrics
+        self.seconds = 0.0
+
+    def read(self, amt=None):
+        start = time.perf_counter()
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        self._metrics.add_time('download', elapsed)
+        self._metrics.count('bytes', len(data))
+        return data
+
+    def close(self):
+        self._response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _metered_parse(items, resp, counter='stations'):
+    ''' Yield from the iterator items, parsed from resp, timing the
+    parsing, less the time spent reading resp, and counting the items as
+    counter, if metrics are enabled. '''
+    metrics = _metrics
+    if metrics is None or not isinstance(resp, _MeteredResponse):
+        for item in items:
+            yield item
+        return
+    while True:
+        start = time.perf_counter()
+        read = resp.seconds
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            metrics.add_time('parse', time.perf_counter() - start -
+                             (resp.seconds - read))
+        metrics.count(counter)
+        yield item
+
+
+class _Expression(object):
+    ''' Comparison parsed from a [=><]NNN filter expression, e.g. '>500'.
+    op is '>', '<' or '==', or None to accept every value.
+    '''
+
+    def __init__(self, op=None, bound=None):
+        self.op = op
+        self.bound = bound
+
+    def __call__(self, x):
+        if self.op == '>':
+            return x > self.bound
+        elif self.op == '<':
+            return x < self.bound
+        elif self.op == '==':
+            return x == self.bound
+        return True
+
+
 def _expression_param(value, argparser):
     if not value:
-        return lambda x: True
-    if not re.compile('^[=><]?\d+$').match(value):
+        return _Expression()
+    if not re.compile(r'^[=><]?\d+$').match(value):
         argparser.error('invalid expression: {0}'.format(value))
 
-    if value[0] == '>':
-        return lambda x: int(x) > int(value.strip('>'))
-    elif value[0] == '<':
-        return lambda x: int(x) < int(value.strip('<'))
+    bound = int(value.lstrip('=><'))
+    if value[0] in '><':
+        return _Expression(value[0], bound)
     else:
-        return lambda x: int(x) == int(value.strip('='))
+        return _Expression('==', bound)
+
+
+def _mime_type_param(codec, argparser):
+    if not codec:
+        return ''
+    if codec.strip('"') not in ('mpeg', 'aacp'):
+        argparser.error('CODEC must be "mpeg", "aacp" or none')
+    return 'audio/' + codec.strip('"')
 
 
 def _generate_list_sorters(pattern='l', argparser=None):
@@ -87,20 +243,12 @@ def _generate_list_sorters(pattern='l', argparser=None):
 
     Default behaviour is 'l'
     '''
-    def _create_sorter(field, descending):
-        return lambda list: sorted(list, key=lambda a: int(a[field]),
-                                   reverse=descending)
-
     def _filter_description(fieldname, descending):
         descending_text = 'desc'
         if not descending:
             descending_text = 'asc'
         return '{0} {1}'.format(fieldname, descending_text)
 
-    def _random(list):
-        random.shuffle(list)
-        return list
-
     if argparser is None:
         argparser = argparse.ArgumentParser()
     sorters = []
@@ -115,15 +263,15 @@ def _generate_list_sorters(pattern='l', argparser=None):
         if char == '^':
             sort_descending = False
         elif char == 'b':
-            sorters.append(_create_sorter('br', sort_descending))
+            sorters.append(_SortBy('br', sort_descending))
             sorters_description.append(_filter_description('bitrate',
                                                            sort_descending))
         elif char == 'l':
-            sorters.append(_create_sorter('lc', sort_descending))
+            sorters.append(_SortBy('lc', sort_descending))
             sorters_description.append(_filter_description('listeners',
                                                            sort_descending))
         elif char == 'r':
-            sorters.append(_random)
+            sorters.append(_Shuffle())
             sorters_description.append('random order')
         elif char == 'n':
             number = ''
@@ -139,7 +287,7 @@ def _generate_list_sorters(pattern='l', argparser=None):
                 msg_missing_number = 'missing number for sorter n in "{0}"'
                 argparser.error(msg_missing_number.format(pattern))
             value = int(number)
-            sorters.append(lambda list: list[:value])
+            sorters.append(_Truncate(value))
             sorters_description.append('top {0}'.format(value))
         else:
             argparser.error('invalid sorter: {0}'.format(char))
@@ -152,36 +300,374 @@ def _generate_list_sorters(pattern='l', argparser=None):
     return (sorters, sorters_description)
 
 
+class _SortBy(object):
+    ''' Sorter: stable sort by an integer field '''
+
+    def __init__(self, field, descending=True):
+        self.field = field
+        self.descending = descending
+
+    def __call__(self, stations):
+        return sorted(stations, key=lambda a: int(a[self.field]),
+                      reverse=self.descending)
+
+
+class _Shuffle(object):
+    ''' Sorter: random order '''
+
+    def __call__(self, stations):
+        import random
+        random.shuffle(stations)
+        return stations
+
+
+class _Truncate(object):
+    ''' Sorter: keep the first count stations '''
+
+    def __init__(self, count):
+        self.count = count
+
+    def __call__(self, stations):
+        return stations[:self.count]
+
+
+def _sort_key(sorts):
+    ''' Return a key function giving the same order as applying the _SortBy
+    sorters in sorts one after the other, using a single stable sort.
+
+    The last sorter gives the primary key, earlier ones break ties. Fields
+    sorted again later are skipped, and descending fields are negated.
+    Keys of one or two fields, all there are, get their own closure, as
+    looping over the fields for every station doubles the sort time.
+    '''
+    terms = []  # (getter, sign)
+    fields = set()
+    for sort in reversed(sorts):
+        if sort.field in fields:
+            continue
+        fields.add(sort.field)
+        terms.append((operator.attrgetter(sort.field),
+                      -1 if sort.descending else 1))
+
+    if len(terms) == 1:
+        (get, sign), = terms
+        if sign > 0:
+            return get
+        return lambda r: -get(r)
+    if len(terms) == 2:
+        (get1, sign1), (get2, sign2) = terms
+        return lambda r: (sign1 * get1(r), sign2 * get2(r))
+    return lambda r: tuple([sign * get(r) for get, sign in terms])
+
+
+def _sort_stage(sorts, count=None):
+    ''' Return a function sorting by sorts and keeping the first count
+    (all if None) stations. A heap is used when only a small top is kept.
+    '''
+    key = _sort_key(sorts)
+
+    def stage(stations):
+        if count is None:
+            return sorted(stations, key=key)
+        if count * 8 <= len(stations):
+            return heapq.nsmallest(count, stations, key=key)
+        return sorted(stations, key=key)[:count]
+    return stage
+
+
+def _shuffle_stage(count=None):
+    def stage(stations):
+        import random
+        if count is not None and count < len(stations):
+            return random.sample(stations, count)
+        random.shuffle(stations)
+        return stations
+    return stage
+
+
+def _plan_sorters(sorters, randomize=False, limit=0):
+    ''' Turn the ordering done by filter_results into a list of stages,
+    functions taking and returning a list of Station.
+
+    Conceptually the list is shuffled (randomize) or sorted by listeners,
+    then passed through the sorters, then truncated to limit. For sorters
+    made by _generate_list_sorters the stages give the same result with
+    less work:
+      - consecutive sorts are fused into one multi-key sort,
+      - sorts directly followed by a shuffle are skipped,
+      - a sort or shuffle directly followed by truncation only selects the
+        top stations, with heapq or random.sample.
+    Other sorters are applied as given.
+    '''
+    first = _Shuffle() if randomize else _SortBy('lc')
+    ops = [first] + list(sorters)
+    if limit > 0:
+        ops.append(_Truncate(limit))
+    if not all(isinstance(op, (_SortBy, _Shuffle, _Truncate)) for op in ops):
+        return ops
+
+    stages = []
+    index = 0
+    while index < len(ops):
+        # A run of sorts and shuffles, and the truncations following it
+        run = []
+        while index < len(ops) and not isinstance(ops[index], _Truncate):
+            run.append(ops[index])
+            index += 1
+        count = None
+        while index < len(ops) and isinstance(ops[index], _Truncate):
+            if count is None or ops[index].count < count:
+                count = ops[index].count
+            index += 1
+
+        # A shuffle gives a uniformly random order whatever the order
+        # before it, so only the last shuffle of a run and what follows it
+        # matters.
+        shuffles = [i for i, op in enumerate(run) if isinstance(op, _Shuffle)]
+        if shuffles:
+            run = run[shuffles[-1]:]
+            if len(run) == 1:
+                stages.append(_shuffle_stage(count))
+                continue
+            stages.append(_shuffle_stage())
+            run = run[1:]
+        if run:
+            stages.append(_sort_stage(run, count))
+        elif count is not None:
+            stages.append(_Truncate(count))
+    return stages
+
+
+# Station record
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+# Fields kept as int, given as str by the mapping view of Station
+_NUMBER_FIELDS = frozenset(['br', 'lc'])
+
+
+class Station(Mapping):
+    """ A radio station as listed by the web service.
+
+    Bitrate ('br') and listener count ('lc') are parsed to int once, and the
+    upper case text searched by filter_results is computed once, when the
+    station is created. Stations can still be used as read-only dicts, e.g.
+    station['name'] or dict(station), like the attribute dicts they replace;
+    like those, station['br'] and station['lc'] are strings; the attributes
+    br and lc are the ints. Attributes the web service returns besides the
+    fields below are kept in extra. url is the stream URL for directories
+    that list it, empty if it is found with the provider's url_by_id.
+    """
+
+    fields = ('name', 'mt', 'id', 'br', 'genre', 'ct', 'lc')
+    __slots__ = fields + ('text', '_genre_at', '_ct_at', 'extra', 'url')
+
+    def __init__(self, name='', mt='', id='', br=0, genre='', ct='', lc=0,
+                 extra=None, url=''):
+        self.name = name
+        self.mt = mt
+        self.id = id
+        self.br = _to_int(br)
+        self.genre = genre
+        self.ct = ct
+        self.lc = _to_int(lc)
+        self.extra = extra or None
+        self.url = url
+        # text is 'NAME GENRE CT'; remember where genre and ct start so the
+        # single fields can be searched without slicing.
+        upper_name = name.upper()
+        upper_genre = genre.upper()
+        self._genre_at = len(upper_name) + 1
+        self._ct_at = self._genre_at + len(upper_genre) + 1
+        self.text = ' '.join((upper_name, upper_genre, ct.upper()))
+
+    @classmethod
+    def from_attrib(cls, attrib):
+        ''' Create a station from a dict of XML attributes. '''
+        fields = {}
+        extra = {}
+        for key, value in attrib.items():
+            if key in cls.fields:
+                fields[key] = value
+            else:
+                extra[key] = value
+        return cls(extra=extra, **fields)
+
+    @classmethod
+    def coerce(cls, station):
+        ''' Return station as a Station, converting dicts. '''
+        if isinstance(station, cls):
+            return station
+        return cls.from_attrib(station)
+
+    def name_contains(self, needle):
+        ''' Is the upper case needle part of the station name? '''
+        return self.text.find(needle, 0, self._genre_at - 1) != -1
+
+    def genre_contains(self, needle):
+        ''' Is the upper case needle part of the genre? '''
+        return self.text.find(needle, self._genre_at, self._ct_at - 1) != -1
+
+    def song_contains(self, needle):
+        ''' Is the upper case needle part of the current track? '''
+        return self.text.find(needle, self._ct_at) != -1
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            return str(value) if key in _NUMBER_FIELDS else value
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.fields:
+            yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return len(self.fields) + len(self.extra or ())
+
+    def __repr__(self):
+        return 'Station({0!r})'.format(dict(self))
+
+
 # Provider classes
 
 class Provider(object):
     """ A online radio database provider """
 
+    name = 'provider'
     search_url = ''
     by_id_url = ''
     genres_url = ''
     extra_headers = {}
+    pool_size = 4  # idle keep-alive connections kept per host
+    timeout = 30  # seconds
+    retries = 3  # times a failed request is made again
+    backoff = 0.5  # seconds, doubled for every retry, randomized
+    max_backoff = 10  # seconds
+    deadline = 60  # seconds a request may take, retries included
+    rate = None  # requests per second, None for no limit
+    burst = 4  # requests allowed at once by the rate limit
+    resolver = None  # a resolver.Resolver, made when first needed
+
+    def __init__(self, transport=None, cache=None, limiter=None):
+        '''
+          transport - HTTPConnectionPool used for all requests. Pass one to
+                      share connections between providers. By default a new
+                      pool is created from pool_size and timeout.
+          cache - optional ResponseCache for search and genre responses.
+          limiter - optional TokenBucket taken from before every request.
+                    By default one is created from rate and burst, if rate
+                    is set.
+        '''
+        if transport is None:
+            from shoutcast_search.transport import HTTPConnectionPool
+            transport = HTTPConnectionPool(self.pool_size, self.timeout)
+        if limiter is None and self.rate:
+            from shoutcast_search.transport import TokenBucket
+            limiter = TokenBucket(self.rate, self.burst)
+        self.transport = transport
+        self.cache = cache
+        self.limiter = limiter
 
     def _build_search_url(self, params):
         '''
         Return URL to search web service with appropriately encoded parameters.
           params - See urllib.urlencode
         '''
+        import urllib.parse
         return self.search_url.format(urllib.parse.urlencode(params))
 
+    def _open(self, url, endpoint='search', deadline=None):
+        '''
+        Open url through the cache, if any, and the pooled transport, sending
+        extra_headers. endpoint selects the cache TTL. deadline, in seconds,
+        replaces the provider's deadline for this request.
+
+        Every attempt waits for the rate limiter. Failures that may pass
+        (see transport.is_retryable) are retried up to retries times after
+        a randomized, exponentially growing pause, or the time asked for by
+        a Retry-After header, unless that would pass the deadline. The last
+        error is raised. Reading the response raises TimeoutError once the
+        deadline has passed.
+        '''
+        from shoutcast_search import transport
+        if deadline is None:
+            deadline = self.deadline
+        give_up = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            remaining = give_up - time.monotonic()
+            if self.limiter is not None and \
+                    not self.limiter.acquire(remaining):
+                from urllib.error import URLError
+                raise URLError('rate limited until past the deadline')
+            timeout = max(give_up - time.monotonic(), 0.001)
+            try:
+                _count('requests')
+                if self.cache is None:
+                    with _timer('request'):
+                        resp = self.transport.urlopen(
+                            url, self.extra_headers, timeout=timeout,
+                            deadline=give_up)
+                else:
+                    # Times the request and its own work apart
+                    resp = self.cache.urlopen(self.transport, url,
+                                              self.extra_headers, endpoint,
+                                              timeout, give_up)
+                metrics = _metrics
+                if metrics is not None:
+                    resp = _MeteredResponse(resp, metrics)
+                return resp
+            except OSError as e:
+                if attempt >= self.retries or not transport.is_retryable(e):
+                    raise
+                delay = transport.retry_after(e)
+                if delay is None:
+                    delay = transport.backoff_delay(attempt, self.backoff,
+                                                    self.max_backoff)
+                if time.monotonic() + delay >= give_up:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                _count('retries')
+
     def get_search_results(self, params):
         ''' Perform search against shoutcast.com web service.
             params - See urllib.urlencode and
                      http://forums.winamp.com/showthread.php?threadid=295638
         '''
-        req = urllib.request.Request(self._build_search_url(params))
-        for key, val in self.extra_headers.items():
-            req.add_header(key, val)  # add extra header information
-        with urllib.request.urlopen(req) as resp:
-            content = _from_UTF_8(resp.read())
-
-        root = ET.fromstring(content)
-        return [station.attrib for station in root.iter('station')]
+        return list(self.iter_search_results(params))
+
+    def iter_search_results(self, params, limit=0, predicate=None):
+        ''' Like get_search_results, but parse the response while it is
+        downloaded and yield one Station at a time.
+            limit - stop reading the response after this many stations.
+                    0 means unlimited.
+            predicate - function with the Station as argument. Only
+                        stations for which it returns True are yielded and
+                        counted against limit.
+        '''
+        with self._open(self._build_search_url(params)) as resp:
+            count = 0
+            stations = map(Station.from_attrib,
+                           _iter_attribs(resp, 'station'))
+            for station in _metered_parse(stations, resp):
+                if predicate is not None and not predicate(station):
+                    continue
+                yield station
+                count += 1
+                if count == limit:
+                    return
 
     def url_by_id(self, index):
         '''
@@ -194,36 +680,121 @@ class Provider(object):
         Returns a list of genres (listed by the shoutcast web service).
         Raises urllib2.URLError if network communication fails
         '''
-        req = urllib.request.Request(self.genres_url)
-        for key, val in self.extra_headers.items():
-            req.add_header(key, val)  # add extra header information
-        with urllib.request.urlopen(req) as resp:
-            content = _from_UTF_8(resp.read())
-        root = ET.fromstring(content)
-        return [genre.attrib['name'] for genre in root.iter('genre')]
+        with self._open(self.genres_url, 'genres') as resp:
+            genres = _iter_attribs(resp, 'genre')
+            return [attrib['name'] for attrib in
+                    _metered_parse(genres, resp, 'genres')]
 
     def station_text(self, station_info, format):
-        url = self.url_by_id(station_info['id'])
-
-        replacements = {'%g': station_info['genre'],
-                        '%p': station_info['ct'],
-                        '%s': station_info['name'],
-                        '%b': station_info['br'],
-                        '%l': station_info['lc'],
-                        '%t': station_info['mt'],
-                        '%u': url,
-                        '%%': '%',
-                        '\\n': '\n',
-                        '\\t': '\t'}
-        resstr = format
-        for key, value in replacements.items():
-            resstr = resstr.replace(key, str(value))
-        return resstr
+        '''
+        Return format with the codes (see compile_format) replaced by the
+        station's details.
+        '''
+        return compile_format(format)(Station.coerce(station_info),
+                                      self.url_by_id)
+
+    def close(self):
+        ''' Close the idle keep-alive connections of the transport and of
+        the resolver, if any. The provider can still be used; it connects
+        again when needed. '''
+        self.transport.clear()
+        if self.resolver is not None:
+            self.resolver.transport.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Output
+
+_FORMAT_TOKENS = re.compile(r'(%[gpsbltuUA%]|\\[nt])')
+_FORMAT_FIELDS = {'%g': 'r.genre', '%p': 'r.ct', '%s': 'r.name',
+                  '%b': 'str(r.br)', '%l': 'str(r.lc)', '%t': 'r.mt',
+                  '%u': '(r.url or url_by_id(r.id))',
+                  '%U': "(r.extra or {}).get('stream', '')",
+                  '%A': "ALIVE[(r.extra or {}).get('alive')]"}
+_ALIVE_TEXT = {True: 'up', False: 'down', None: ''}
+_FORMAT_ESCAPES = {'%%': '%', '\\n': '\n', '\\t': '\t'}
+
+
+@functools.lru_cache(maxsize=32)
+def compile_format(format):
+    ''' Compile a format string into a function taking a Station and a
+    url_by_id function and returning the formatted text. url_by_id is only
+    called for stations without a url.
+
+    Codes: %u - url, %g - genre, %p - current song, %s - station name,
+    %b - bitrate, %l - number of listeners, %t - MIME / codec, %% - %,
+    \\n - newline, \\t - tab. %U - stream url and %A - "up" or "down"
+    are empty unless set by shoutcast_search.resolver. The format is
+    scanned once, left to right, so replaced values are never interpreted
+    as codes. The function's codes attribute is the set of codes used.
+    '''
+    namespace = {'str': str, 'ALIVE': _ALIVE_TEXT}
+    parts = []
+    codes = set()
+    literal = ''
+    for token in _FORMAT_TOKENS.split(format):
+        if token in _FORMAT_FIELDS:
+            codes.add(token)
+            if literal:
+                namespace['v{0}'.format(len(namespace))] = literal
+                parts.append('v{0}'.format(len(namespace) - 1))
+                literal = ''
+            parts.append(_FORMAT_FIELDS[token])
+        else:
+            literal += _FORMAT_ESCAPES.get(token, token)
+    if literal:
+        namespace['v{0}'.format(len(namespace))] = literal
+        parts.append('v{0}'.format(len(namespace) - 1))
+    body = "''.join(({0},))".format(', '.join(parts)) if parts else "''"
+    text = eval('lambda r, url_by_id: ' + body, namespace)
+    text.codes = frozenset(codes)
+    return text
+
+
+def write_stations(stations, format, provider, out=None, batch_size=256):
+    ''' Write one formatted line per station to out (default stdout), in
+    batches of batch_size lines. Returns the number of stations written.
+    '''
+    if out is None:
+        out = sys.stdout
+    text = compile_format(format)
+    url_by_id = provider.url_by_id
+    count = 0
+    batch = []
+    for station in stations:
+        batch.append(text(Station.coerce(station), url_by_id))
+        if len(batch) == batch_size:
+            out.write('\n'.join(batch) + '\n')
+            count += len(batch)
+            batch = []
+    if batch or not count:
+        out.write('\n'.join(batch) + '\n')
+        count += len(batch)
+    return count
+
+
+def station_record(station, url_by_id):
+    ''' Return station as a dict of its fields, bitrate and listener count
+    as numbers, with its 'url' added, e.g. for JSON output.
+    '''
+    station = Station.coerce(station)
+    record = dict(station)
+    record['br'] = station.br
+    record['lc'] = station.lc
+    record['url'] = station.url or url_by_id(station.id)
+    return record
 
 
 class Shoutcast(Provider):
     """ Shoutcast radio directory """
 
+    name = 'shoutcast'
+    rate = 10  # requests per second
     search_url = 'http://yp.shoutcast.com/sbin/newxml.phtml?{0}'
     by_id_url = 'http://yp.shoutcast.com/sbin/tunein-station.pls?id={0}'
     genres_url = 'http://yp.shoutcast.com/sbin/newxml.phtml'
@@ -234,8 +805,82 @@ class Shoutcast(Provider):
                       'Chrome/21.0.1200.0 Iron/21.0.1200.0 Safari/537.1')}
 
 
+class IcecastDirectory(Provider):
+    """ Icecast stream directory, e.g. dir.xiph.org.
+
+    The directory is a single yp.xml document listing every stream, so it
+    is downloaded (once per cache lifetime, see ResponseCache) and searched
+    locally. Stations are identified by their stream URL. The Top500 are
+    the streams with the most listeners, if the directory counts them.
+    """
+
+    name = 'icecast'
+    search_url = 'http://dir.xiph.org/yp.xml'
+    by_id_url = '{0}'
+    genres_url = 'http://dir.xiph.org/yp.xml'
+    top_count = 500
+
+    # yp.xml element -> Station field
+    entry_fields = {'server_name': 'name', 'server_type': 'mt',
+                    'listen_url': 'id', 'bitrate': 'br', 'genre': 'genre',
+                    'current_song': 'ct', 'listeners': 'lc'}
+
+    def _iter_stations(self, url, endpoint='search'):
+        fields = self.entry_fields
+        with self._open(url, endpoint) as resp:
+            stations = (Station.from_attrib(dict(
+                (fields.get(key, key), value)
+                for key, value in entry.items()))
+                for entry in _iter_entries(resp, 'entry'))
+            for station in _metered_parse(stations, resp):
+                station.url = station.id
+                yield station
+
+    def _build_search_url(self, params):
+        return self.search_url
+
+    def iter_search_results(self, params, limit=0, predicate=None):
+        ''' See Provider.iter_search_results. Understands the parameters
+        sent by search(): search, genre and mt.
+        '''
+        stations = self._iter_stations(self._build_search_url(params))
+        if params.get('mt'):
+            stations = (s for s in stations if s.mt == params['mt'])
+        if params.get('search'):
+            needle = params['search'].upper()
+            stations = (s for s in stations if needle in s.text)
+        elif params.get('genre') == 'Top500':
+            stations = heapq.nlargest(self.top_count, stations,
+                                      key=lambda s: s.lc)
+        elif params.get('genre'):
+            needle = params['genre'].upper()
+            stations = (s for s in stations if s.genre_contains(needle))
+        count = 0
+        for station in stations:
+            if predicate is not None and not predicate(station):
+                continue
+            yield station
+            count += 1
+            if count == limit:
+                return
+
+    def get_genres(self):
+        '''
+        Returns the words the directory's streams use as genres.
+        '''
+        genres = set()
+        for station in self._iter_stations(self.genres_url, 'genres'):
+            genres.update(station.genre.split())
+        return sorted(genres, key=str.lower)
+
+
+# Providers selectable with --directory
+DIRECTORIES = {'shoutcast': Shoutcast, 'icecast': IcecastDirectory}
+
+
 def search(search=[], station=[], genre=[], song=[], mime_type='',
-           provider=None):
+           provider=None, max_workers=1, limit=0, predicate=None,
+           failures=None):
     ''' Search shoutcast.com for streams with given criteria.
 
     See http://forums.winamp.com/showthread.php?threadid=295638 for details
@@ -251,13 +896,21 @@ def search(search=[], station=[], genre=[], song=[], mime_type='',
       listeners_fn function with number of listeners as argument.
                    Should return True if station is a keeper.
       mime_type - filter stations by MIME type
-      limit - maximum number of stations returned. 0 means unlimited.
       randomize - should results be returned in random order? True / False
       sorters - a list of functions accepting the station list and returning
                 a modified one. Executed after randomization / sorting by
                 number of listeners.
-
-    Returns a list with one dict per station. Each dict contains:
+      max_workers - maximum number of keyword requests in flight at the same
+                    time. Results are merged in keyword order regardless.
+      limit - stop after this many stations, without downloading or parsing
+              more than needed. 0 means unlimited.
+      predicate - function with the Station as argument. Stations for
+                  which it returns False are skipped while parsing.
+      failures - optional list. If given, a keyword whose request fails
+                 with a network error is left out, and (keyword, error) is
+                 appended to failures, instead of failing the search.
+
+    Returns a list with one Station per station. Each Station contains:
       'name' - station name
       'mt' - mime type
       'id' - station id (used in URL)
@@ -267,6 +920,55 @@ def search(search=[], station=[], genre=[], song=[], mime_type='',
       'lc' - listener count
     '''
     assert provider is not None, 'Provider must be specified'
+    if not (search + station + genre + song):
+        # Perform search with empty keywords
+        params = _search_queries(mime_type=mime_type)[0]
+        return _search_fetch(provider, limit, predicate, failures)(params)
+    return list(iter_search(search, station, genre, song, mime_type,
+                            provider, max_workers, limit, predicate,
+                            failures))
+
+
+def iter_search(search=[], station=[], genre=[], song=[], mime_type='',
+                provider=None, max_workers=1, limit=0, predicate=None,
+                failures=None):
+    ''' Like search(), but yield the stations as the keyword answers arrive,
+    in the same order as search() returns them.
+    '''
+    assert provider is not None, 'Provider must be specified'
+    queries = _search_queries(search, station, genre, song, mime_type)
+    fetch = _search_fetch(provider, limit, predicate, failures)
+    answers = _fetch_all(fetch, queries, max_workers)
+    for count, row in enumerate(_merge_answers(answers), 1):
+        yield row
+        if count == limit:
+            return
+
+
+def _merge_answers(answers):
+    ''' Yield the stations of answers, an iterable of station lists, in
+    order, leaving out stations already found by an earlier answer.
+    '''
+    known_ids = set()  # ids found by earlier answers
+    for rows in answers:
+        for row in _new_rows(rows, known_ids):
+            yield row
+
+
+def _new_rows(rows, known_ids):
+    ''' Return the stations of rows whose ids are not in known_ids, and add
+    their ids. '''
+    with _timer('merge'):
+        new = [row for row in rows if row['id'] not in known_ids]
+        known_ids.update(row['id'] for row in new)
+    _count('duplicates', len(rows) - len(new))
+    return new
+
+
+def _search_queries(search=[], station=[], genre=[], song=[], mime_type=''):
+    ''' Return the web service parameters to search() with, one dict per
+    request.
+    '''
     opt_dict = {}
     keywords = search + station + genre + song
 
@@ -275,85 +977,231 @@ def search(search=[], station=[], genre=[], song=[], mime_type='',
 
     if not keywords:   # No content to search, use default
         opt_dict['genre'] = 'Top500'
+        return [opt_dict]
+
+    # Find everything applicable and filter ourselves, since the API
+    # is limited.
+    return [dict(opt_dict, search=k) for k in keywords]
+
 
-# Perform search with empty keywords
-        results = provider.get_search_results(opt_dict)
+def _search_fetch(provider, limit=0, predicate=None, failures=None):
+    ''' Return a function fetching the stations for one set of parameters
+    from provider. With a failures list, network errors are appended to it
+    and answered with no stations.
+    '''
+    if not limit and predicate is None:
+        fetch = provider.get_search_results
     else:
-        # Find everything applicable and filter ourselves, since the API
-        # is limited.
-        # Not very elegant, and quite slow with big queries.
-        # No problem with normal use, though.
-        results = []
-        known_ids = []  # "cache" found station ids to make code easier below
-        for k in keywords:
-            opt_dict.update({'search': k})
-            results += [row for row in provider.get_search_results(opt_dict)
-                        if row['id'] not in known_ids]
-            known_ids = [row['id'] for row in results]
+        def fetch(params):
+            return list(provider.iter_search_results(params, limit,
+                                                     predicate))
+    if failures is None:
+        return fetch
+
+    def tolerant_fetch(params):
+        try:
+            return fetch(params)
+        except OSError as e:  # urllib.error.URLError and socket errors
+            failures.append((params.get('search') or params.get('genre'), e))
+            return []
+    return tolerant_fetch
+
+
+def _fetch_all(fetch, queries, max_workers=1):
+    ''' Call fetch once per query and yield the answers in query order.
+
+    With max_workers > 1 up to that many calls run concurrently in a thread
+    pool; the first failure is raised when its answer is due. Otherwise the
+    calls are made one at a time. Either way no more calls are started
+    once the caller stops iterating.
+    '''
+    if max_workers <= 1 or len(queries) <= 1:
+        for q in queries:
+            yield fetch(q)
+        return
+    import concurrent.futures
+    workers = min(max_workers, len(queries))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(fetch, q) for q in queries]
+        try:
+            for index in range(len(futures)):
+                answer = futures[index].result()
+                futures[index] = None  # the caller may let go of it
+                yield answer
+        finally:
+            for future in futures:
+                if future is not None:
+                    future.cancel()
+
+
+# Filtering
+
+def compile_filter(search=[], station=[], genre=[], song=[],
+                   bitrate_fn=None, listeners_fn=None):
+    ''' Compile all filter criteria into one predicate taking a Station.
+
+    The criteria are ANDed, as in filter_results. Phrases are upper cased
+    once. Keyword checks already implied by a station, genre or song
+    phrase (since the searched text contains all three fields) and
+    duplicate phrases are dropped. The remaining checks run cheapest
+    first: numeric filters, then the longest, most selective, phrases.
+    '''
+    def _needles(phrases):
+        return sorted(set(p.upper() for p in phrases), key=len, reverse=True)
+
+    station, genre, song = _needles(station), _needles(genre), _needles(song)
+    implied = station + genre + song
+    keywords = [k for k in _needles(search + station + genre + song)
+                if not any(k in phrase for phrase in implied)]
+    # Drop keywords contained in a longer keyword; they match anyway
+    keywords = [k for i, k in enumerate(keywords)
+                if not any(k in longer for longer in keywords[:i])]
+
+    namespace = {}
+    checks = []
+
+    def _bind(value):
+        name = 'v{0}'.format(len(namespace))
+        namespace[name] = value
+        return name
+
+    for field, fn in (('br', bitrate_fn), ('lc', listeners_fn)):
+        if isinstance(fn, _Expression):
+            if fn.op is not None:  # inline the comparison
+                checks.append('r.{0} {1} {2:d}'.format(
+                    field, fn.op, fn.bound))
+        elif fn is not None:
+            checks.append('{0}(r.{1})'.format(_bind(fn), field))
+    for needle in station:
+        checks.append('r.text.find({0}, 0, r._genre_at - 1) != -1'.format(
+            _bind(needle)))
+    for needle in genre:
+        checks.append(('r.text.find({0}, r._genre_at, r._ct_at - 1) '
+                       '!= -1').format(_bind(needle)))
+    for needle in song:
+        checks.append('r.text.find({0}, r._ct_at) != -1'.format(
+            _bind(needle)))
+    for needle in keywords:
+        checks.append('{0} in r.text'.format(_bind(needle)))
+
+    source = 'lambda r: ' + (' and '.join(checks) or 'True')
+    return eval(source, namespace)
 
-    return results
 
 def filter_results(results, search=[], station=[], genre=[], song=[],
-                   bitrate_fn=lambda x: True, listeners_fn=lambda x: True,
-                   mime_type='', limit=0, randomize=False, sorters=[]):
-    keywords = search + station + genre + song
-    # Filter for bitrate
-    results = [r for r in results if bitrate_fn(r['br'])]
-    # Filter by listeners
-    results = [r for r in results if listeners_fn(r['lc'])]
-
-    # Now filter all the stations we've got. AND all criteria. Not super fast,
-    # but OK for normal use
-    for s in station:
-        results = [r for r in results if s.upper() in r['name'].upper()]
-    for g in genre:
-        results = [r for r in results if g.upper() in r['genre'].upper()]
-    for s in song:
-        results = [r for r in results if s.upper() in r['ct'].upper()]
-    for k in keywords:
-        results = [r for r in results
-                   if k.upper() in '{0} {1} {2}'.format(r['name'], r['genre'],
-                                                        r['ct']).upper()]
-    if randomize:
-        random.shuffle(results)
-    else:
-        # Sort by listener count
-        results.sort(key=lambda x: int(x['lc']), reverse=True)
+                   bitrate_fn=None, listeners_fn=None, mime_type='', limit=0,
+                   randomize=False, sorters=[]):
+    ''' Filter, sort and truncate stations returned by search().
 
-    for m in sorters:
-        results = m(results)
+    All criteria are ANDed and checked in a single pass over the results,
+    see compile_filter. bitrate_fn and listeners_fn may be None to accept
+    any value. Returns a list of Station.
+    '''
+    with _timer('filter'):
+        predicate = compile_filter(search, station, genre, song, bitrate_fn,
+                                   listeners_fn)
+        results = [r for r in map(Station.coerce, results) if predicate(r)]
+    _count('matches', len(results))
 
-    if limit > 0:
-        results = results[:limit]
+    # Shuffle or sort by listener count, apply sorters and truncate
+    with _timer('sort'):
+        for stage in _plan_sorters(sorters, randomize, limit):
+            results = stage(results)
 
     return results
 
 
-def main():
-    provider = Shoutcast()
-    o = argparse.ArgumentParser(description=get_egg_description())
+class _ParserExit(SystemExit):
+    ''' Raised by _RequestParser instead of exiting; a SystemExit, so that
+    _run lets it pass like it would let argparse exit. '''
+
+    def __init__(self, status, message):
+        SystemExit.__init__(self, status)
+        self.status = status
+        self.message = message
+
+
+class _RequestParser(argparse.ArgumentParser):
+    ''' Argument parser collecting its messages in its output and errors
+    attributes, file-like objects set by the caller, and raising _ParserExit
+    instead of exiting, for command lines not given to the process itself.
+    '''
+
+    def _print_message(self, message, file=None):
+        if message:
+            if file is sys.stderr:
+                self.errors.write(message)
+            else:
+                self.output.write(message)
+
+    def exit(self, status=0, message=None):
+        raise _ParserExit(status, message)
+
+
+def _build_parser(parser_class=argparse.ArgumentParser):
+    ''' Return the command line parser of main(). '''
+    o = parser_class(description=__description__)
     o.add_argument('keywords', nargs='*', action='store',
                    help='Keywords to search')
     o.add_argument('--list-genres', dest='do_list_genres', action='store_true',
                    default=False, help='list available genres and exit')
+    o.add_argument('--clear-cache', dest='do_clear_cache',
+                   action='store_true', default=False,
+                   help='remove all cached responses and exit')
+    o.add_argument('--batch', dest='batch', action='store', default=None,
+                   metavar='FILE',
+                   help=('run every search in FILE ("-" for standard input) '
+                         'and print one JSON line per search. Each line '
+                         'holds the criteria, filters and sorters of one '
+                         'search, as arguments or as a JSON object, e.g. '
+                         '{"genre": "Rock", "bitrate": ">127"}. Failed '
+                         'searches are printed with their error.'))
+    o.add_argument('--changes', dest='changes', action='store', default=None,
+                   metavar='STATE',
+                   help=('print how the stations found changed since the '
+                         'last search with the same STATE file, as JSON '
+                         'lines of added, changed and removed stations.'))
+    o.add_argument('--watch', dest='watch', action='store', type=float,
+                   default=None, metavar='SECONDS',
+                   help=('search again and again, about every SECONDS, and '
+                         'print stations as JSON lines when they start '
+                         'matching, e.g. when a song starts playing. The '
+                         'pause adapts to how often the results change.'))
     o.add_argument('-n', '--limit', dest='limit', action='store',
                    type=int,
                    default=0, help='maximum number of stations.')
     o.add_argument('-r', '--random', dest='random', action='store_true',
                    default=False,
                    help='sort stations randomly unless --sort is given.')
+    o.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=4,
+                   help=('maximum number of concurrent requests when '
+                         'searching for several keywords or criteria.'))
     o.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                    default=False,
                    help='verbose output, useful for getting search right.')
+    o.add_argument('--profile', dest='profile', action='store_true',
+                   default=False,
+                   help=('print where the time went to standard error: '
+                         'requests, the cache, downloading, parsing, '
+                         'filtering, sorting and formatting, and counts of '
+                         'requests, bytes and stations.'))
     fmt = o.add_argument_group('Format',
                                ('Specifies how the found stations should be '
                                 'printed. Codes: %u - url, %g - genre, '
                                 '%p - current song, %s - station name, '
                                 '%b - bitrate, %l - number of listeners, '
-                                '%t - MIME / codec, %% - %, \n - newline, '
-                                '\t - tab'))
+                                '%t - MIME / codec, %U - stream url, '
+                                '%A - stream up or down, %% - %, '
+                                '\n - newline, \t - tab'))
     fmt.add_argument('-f', '--format', dest='format', action='store',
                      default='', help='results formatting.')
+    fmt.add_argument('--output', dest='output', action='store',
+                     default=None, choices=('ndjson', 'csv', 'msgpack'),
+                     help=('write one record per station instead of text: '
+                           'JSON lines, CSV or MessagePack, with bitrate and '
+                           'listeners as numbers and the station url. '
+                           'msgpack needs the msgpack package.'))
     o.add_argument_group(fmt)
     p = o.add_argument_group('Criteria')
     p.add_argument('-g', '--genre', dest='genre', action='append',
@@ -400,16 +1248,135 @@ def main():
                          '"r" to randomize order, "n<integer>" to truncate '
                          'list.'))
 
-    args = o.parse_args()
-
+    y = o.add_argument_group('Directories',
+                             ('Search other station directories, alone or '
+                              'together with shoutcast.com. The stations of '
+                              'several directories are merged by number of '
+                              'listeners, leaving out stations listed twice.'))
+    y.add_argument('--directory', dest='directories', action='append',
+                   default=[], choices=sorted(DIRECTORIES),
+                   help='directory to search, can be repeated, default '
+                        'shoutcast.')
+    y.add_argument('--directory-timeout', dest='directory_timeout',
+                   action='store', type=float, default=10, metavar='SECONDS',
+                   help=('seconds to wait for each directory when searching '
+                         'several, default 10. Late directories are left '
+                         'out with a warning.'))
+
+    r = o.add_argument_group('Streams',
+                             ('Station urls are tune-in playlists. Fetch '
+                              'them to find the streams, and check whether '
+                              'the streams are up. Implied by the %U and %A '
+                              'format codes.'))
+    r.add_argument('--resolve', dest='resolve', action='store_true',
+                   default=False,
+                   help='find the stream url of every station found.')
+    r.add_argument('--probe', dest='probe', action='store_true',
+                   default=False,
+                   help='also connect to every stream to see if it is up.')
+    r.add_argument('--probe-timeout', dest='probe_timeout', action='store',
+                   type=float, default=3, metavar='SECONDS',
+                   help='seconds to wait for a stream, default 3.')
+    r.add_argument('--resolve-jobs', dest='resolve_jobs', action='store',
+                   type=int, default=16, metavar='JOBS',
+                   help=('playlists fetched and streams probed at the same '
+                         'time, default 16.'))
+
+    d = o.add_argument_group('Offline',
+                             ('Search a local snapshot of the directory '
+                              'instead of the web service. Create or update '
+                              'the snapshot with "%(prog)s snapshot".'))
+    d.add_argument('--offline', dest='offline', action='store_true',
+                   default=False, help='search the snapshot.')
+    d.add_argument('--snapshot-db', dest='snapshot_db', action='store',
+                   default=None,
+                   help=('snapshot database, default '
+                         '~/.cache/shoutcast-search/snapshot.db.'))
+
+    c = o.add_argument_group('Cache',
+                             ('Responses are cached on disk. Searches are '
+                              'reused for a minute and the genre list for a '
+                              'day before the server is asked again.'))
+    c.add_argument('--cache-dir', dest='cache_dir', action='store',
+                   default=None,
+                   help='cache directory, default ~/.cache/shoutcast-search.')
+    c.add_argument('--no-cache', dest='no_cache', action='store_true',
+                   default=False, help='neither read nor write the cache.')
+    c.add_argument('--refresh-cache', dest='refresh_cache',
+                   action='store_true', default=False,
+                   help='revalidate cached responses with the server.')
+
+    return o
+
+
+# Destinations of the options that do not apply to the searches of a batch
+_NOT_WITH_BATCH = frozenset([
+    'keywords', 'do_list_genres', 'do_clear_cache', 'watch', 'changes',
+    'limit', 'random', 'verbose', 'format', 'output', 'genre', 'song',
+    'station', 'bitrate', 'listeners', 'codec', 'sort_rules', 'resolve',
+    'probe', 'probe_timeout', 'resolve_jobs', 'offline', 'snapshot_db'])
+
+# Destinations of the options --watch does not apply, it prints JSON lines
+_NOT_WITH_WATCH = frozenset([
+    'changes', 'format', 'output', 'resolve', 'probe', 'probe_timeout',
+    'resolve_jobs'])
+
+# Destinations of the options --changes does not apply, it prints JSON lines
+_NOT_WITH_CHANGES = frozenset([
+    'format', 'output', 'resolve', 'probe', 'probe_timeout', 'resolve_jobs'])
+
+
+def _given_options(o, args):
+    ''' Return the options of o that args sets to other values than their
+    defaults, as a dict from destination to option string. '''
+    given = {}
+    for action in o._actions:
+        value = getattr(args, action.dest, action.default)
+        if value != action.default and value != []:  # [] - no keywords
+            given[action.dest] = action.option_strings[-1] \
+                if action.option_strings else action.dest
+    return given
+
+
+def _refuse_combined(o, args, option, dests):
+    ''' Report option, set in args, combined with any of the options of o
+    with destinations in dests with o.error(). '''
+    combined = [given for dest, given in _given_options(o, args).items()
+                if dest in dests]
+    if combined:
+        o.error('{0} cannot be combined with {1}'.format(
+            option, ', '.join(combined)))
+
+
+def _run(args, o, provider, out, err=None):
+    ''' Run the command line parsed by o into args, printing to out and
+    warnings to err (default stderr).
+
+    Returns (exit status, error message or None). Invalid arguments are
+    reported with o.error().
+    '''
+    if err is None:
+        err = sys.stderr
     try:
+        if args.batch:
+            _refuse_combined(o, args, '--batch', _NOT_WITH_BATCH)
+        if args.watch is not None:
+            _refuse_combined(o, args, '--watch', _NOT_WITH_WATCH)
+        if args.changes:
+            _refuse_combined(o, args, '--changes', _NOT_WITH_CHANGES)
+
+        if args.do_clear_cache:
+            from shoutcast_search.cache import ResponseCache
+            ResponseCache(args.cache_dir).clear()
+            return 0, None
+
         if args.do_list_genres:
             genres = provider.get_genres()
-            print('\n'.join(genres))
+            print('\n'.join(genres), file=out)
             if genres:
-                return
+                return 0, None
             else:  # pragma: no cover
-                sys.exit(4)
+                return 4, None
 
         p_keywords = args.keywords
         p_verbose = args.verbose
@@ -419,6 +1386,38 @@ def main():
         p_song = args.song
         p_sort_rules = args.sort_rules
         p_limit = args.limit
+        p_jobs = args.jobs
+        if p_jobs < 1:
+            o.error('JOBS must be at least 1')
+        if args.watch is not None and args.watch <= 0:
+            o.error('SECONDS must be positive')
+        if args.resolve_jobs < 1:
+            o.error('JOBS must be at least 1')
+        if args.output:
+            if args.format or args.verbose:
+                o.error('--output cannot be combined with --format or '
+                        '--verbose')
+            from shoutcast_search.output import check_output
+            message = check_output(args.output, out)
+            if message:
+                o.error(message)
+
+        if args.batch:
+            from shoutcast_search import batch
+            try:
+                if args.batch == '-':
+                    queries = batch.read_queries(sys.stdin)
+                else:
+                    with open(args.batch) as f:
+                        queries = batch.read_queries(f)
+            except OSError as e:
+                o.error('cannot read {0}: {1}'.format(args.batch,
+                                                      e.strerror))
+            failed = batch.run_batch(queries, provider, out, p_jobs)
+            if failed:
+                return 1, '{0:d} of {1:d} searches failed'.format(
+                    failed, len(queries))
+            return 0, None
         p_bitrate = _expression_param(args.bitrate, o)
         p_listeners = _expression_param(args.listeners, o)
 
@@ -429,56 +1428,222 @@ def main():
         if args.format:
             p_format = args.format
 
-        p_mime_type = ''
-        if args.codec:
-            if args.codec.strip('"') not in ('mpeg', 'aacp'):
-                o.error('CODEC must be "mpeg", "aacp" or none')
-            p_mime_type = 'audio/' + args.codec.strip('"')
+        p_mime_type = _mime_type_param(args.codec, o)
 
         sorters, sorters_description = _generate_list_sorters(p_sort_rules, o)
         if sorters:
             p_random = False  # Start with sorted list when using sorters
 
         if p_verbose:   # Print information about query to help debug
-            print('Search summary')
-            print('-' * 30)
-            print(' Keywords: {0}'.format(', '.join(p_keywords)))
-            print('   Genres: {0}'.format(', '.join(p_genre)))
-            print('  Playing: {0}'.format(', '.join(p_song)))
-            print(' Stations: {0}'.format(', '.join(p_station)))
+            print('Search summary', file=out)
+            print('-' * 30, file=out)
+            print(' Keywords: {0}'.format(', '.join(p_keywords)),
+                  file=out)
+            print('   Genres: {0}'.format(', '.join(p_genre)), file=out)
+            print('  Playing: {0}'.format(', '.join(p_song)), file=out)
+            print(' Stations: {0}'.format(', '.join(p_station)), file=out)
             bitrate_str = args.bitrate or ''
-            print('  Bitrate: {0}'.format(bitrate_str))
+            print('  Bitrate: {0}'.format(bitrate_str), file=out)
             listeners_str = args.listeners or ''
-            print('Listeners: {0}'.format(listeners_str))
-            print('     Type: {0}'.format(args.codec))
+            print('Listeners: {0}'.format(listeners_str), file=out)
+            print('     Type: {0}'.format(args.codec), file=out)
             if p_random:
                 order_str = 'random'
             elif p_sort_rules:
                 order_str = 'by sorters'
             else:
                 order_str = 'by no listeners'
-            print('    Order: {0}'.format(order_str))
-            print('   Sorter: {0}'.format(' | '.join(sorters_description)))
+            print('    Order: {0}'.format(order_str), file=out)
+            print('   Sorter: {0}'.format(' | '.join(sorters_description)),
+                  file=out)
             limit_str = str(p_limit) or ''
-            print('    Limit: {0}'.format(limit_str))
-            print('   Format: {0}'.format(p_format))
-            print('')
-
-        results = search(p_keywords, p_station, p_genre, p_song, p_mime_type,
-                         provider)
-        results = filter_results(results, p_keywords, p_station, p_genre,
-                                 p_song, p_bitrate, p_listeners, p_mime_type,
-                                 p_limit, p_random, sorters)
-
-        print('\n'.join(provider.station_text(el, p_format) for el in results))
+            print('    Limit: {0}'.format(limit_str), file=out)
+            print('   Format: {0}'.format(p_format), file=out)
+            print('', file=out)
+
+        if args.offline:
+            from shoutcast_search.snapshot import Snapshot
+            from shoutcast_search.snapshot import default_snapshot_path
+            snapshot_path = args.snapshot_db or default_snapshot_path()
+            if not os.path.exists(snapshot_path):
+                o.error('no snapshot in {0}, create it with '
+                        '"{1} snapshot"'.format(snapshot_path, o.prog))
+
+        def find():
+            ''' Search once, printing warnings to err. Returns (stations,
+            error message or None, whether some directories did not answer).
+            '''
+            incomplete = False
+            if args.offline:
+                snapshot = Snapshot(snapshot_path)
+                try:
+                    results = snapshot.search(p_keywords, p_station, p_genre,
+                                              p_song, p_mime_type, p_bitrate,
+                                              p_listeners)
+                finally:
+                    snapshot.close()
+            else:
+                failures = []
+                results = search(p_keywords, p_station, p_genre, p_song,
+                                 p_mime_type, provider, p_jobs,
+                                 failures=failures)
+                for keyword, error in failures:
+                    print('{0}: warning: search for "{1}" failed: '
+                          '{2}'.format(o.prog, keyword, error), file=err)
+                # Directories left out by a FederatedProvider
+                provider_failures = getattr(provider, 'failures', None)
+                incomplete = bool(provider_failures)
+                while provider_failures:
+                    name, error = provider_failures.popleft()
+                    print('{0}: warning: {1}: {2}'.format(o.prog, name,
+                                                          error), file=err)
+                if failures and not results:
+                    return [], 'network error: {0}'.format(
+                        failures[-1][1]), incomplete
+            results = filter_results(results, p_keywords, p_station, p_genre,
+                                     p_song, p_bitrate, p_listeners,
+                                     p_mime_type, p_limit, p_random, sorters)
+            return results, None, incomplete
+
+        if args.watch:
+            from shoutcast_search.watch import Watcher
+            watcher = Watcher(find, args.watch)
+            watcher.run(provider.url_by_id, out)
+            return 0, None
+
+        results, message, incomplete = find()
+        if message:
+            return 1, message
+
+        if args.changes:
+            if incomplete:
+                # Missing stations would be reported as removed
+                return 1, 'some directories failed, {0} not updated'.format(
+                    args.changes)
+            from shoutcast_search.changes import ChangeFeed
+            ChangeFeed(args.changes).write(results, provider.url_by_id, out)
+            return 0, None
+
+        codes = compile_format(p_format).codes
+        probe = args.probe or '%A' in codes
+        if args.resolve or probe or '%U' in codes:
+            results = _resolve(provider, results, probe, args.resolve_jobs,
+                               args.probe_timeout)
+
+        with _timer('format'):
+            if args.output:
+                from shoutcast_search.output import write_output
+                write_output(args.output, results, provider.url_by_id, out)
+            else:
+                write_stations(results, p_format, provider, out)
         if p_verbose:
-            print('\n{0:d} station(s) found.'.format(len(results)))
+            print('\n{0:d} station(s) found.'.format(len(results)),
+                  file=out)
         if not results:
-            _fail_exit(4, 'no station found\n')
-    except urllib.error.URLError as e:  # pragma: no cover
-        _fail_exit(1, 'network error: {0}'.format(e))
+            return 4, 'no station found\n'
+    except OSError as e:  # urllib.error.URLError, timeouts, socket errors
+        return 1, 'network error: {0}'.format(e)
     except Exception as e:  # pragma: no cover
-        _fail_exit(3, 'unknown error: {0}'.format(e))
+        return 3, 'unknown error: {0}'.format(e)
+    return 0, None
+
+
+def _resolve(provider, stations, probe, max_workers, probe_timeout):
+    ''' Set the 'stream' of stations, and 'alive' if probe is set, with
+    the resolver kept by provider, so that a long running provider keeps
+    the resolved playlists. '''
+    resolver = getattr(provider, 'resolver', None)
+    if resolver is None:
+        from shoutcast_search.resolver import Resolver
+
+        def open_playlist(url, timeout):
+            # Playlists are requests to the provider like any other: rate
+            # limited, retried and cached
+            return provider._open(url, 'tunein', timeout)
+
+        transport = getattr(provider, 'transport', None)
+        opener = open_playlist if transport is not None else None
+        resolver = Resolver(transport, opener=opener)
+        provider.resolver = resolver
+    with _timer('resolve'):
+        return resolver.resolve_all(stations, provider.url_by_id, probe,
+                                    max_workers, probe_timeout)
+
+
+def _make_provider(directories=[], timeout=10):
+    ''' Return the provider searching the named DIRECTORIES, by default
+    shoutcast.com. Several directories are searched with a
+    FederatedProvider, waiting timeout seconds for each.
+    '''
+    names = []
+    for name in directories or ['shoutcast']:
+        if name not in names:
+            names.append(name)
+    if len(names) == 1:
+        return DIRECTORIES[names[0]]()
+    from shoutcast_search.federation import FederatedProvider
+    return FederatedProvider([DIRECTORIES[name]() for name in names],
+                             timeout)
+
+
+def main(provider=None, argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'snapshot':
+        from shoutcast_search import snapshot
+        snapshot.main(argv[1:], provider)
+        return
+    if argv and argv[0] == 'serve':
+        from shoutcast_search import server
+        server.main(argv[1:], provider)
+        return
+    if argv and argv[0] == 'crawl':
+        from shoutcast_search import crawler
+        crawler.main(argv[1:], provider)
+        return
+    if provider is None and os.environ.get('SHOUTCAST_SEARCH_SERVER'):
+        # Let a running "shoutcast-search serve" do the work. Command lines
+        # it refuses, e.g. with --watch or --profile, are run here without
+        # asking it
+        from shoutcast_search import server
+        if server.forward(os.environ['SHOUTCAST_SEARCH_SERVER'], argv):
+            return
+
+    o = _build_parser()
+    args = o.parse_args(argv)
+    if provider is not None:
+        _main(args, o, provider)
+        return
+    with _make_provider(args.directories, args.directory_timeout) as provider:
+        _main(args, o, provider)
+
+
+def _main(args, o, provider):
+    ''' Run the parsed command line of main() with provider. '''
+    if not args.no_cache:
+        # Watching revalidates every response, at the cost of a 304 when
+        # nothing changed
+        from shoutcast_search.cache import ResponseCache
+        provider.cache = ResponseCache(args.cache_dir,
+                                       refresh=args.refresh_cache or
+                                       bool(args.watch))
+
+    if args.profile:
+        from shoutcast_search import metrics
+        measured = metrics.enable()
+        start = time.perf_counter()
+        try:
+            code, message = _run(args, o, provider, sys.stdout)
+        finally:
+            metrics.disable()
+            sys.stdout.flush()
+            sys.stderr.write(measured.report(time.perf_counter() - start))
+    else:
+        code, message = _run(args, o, provider, sys.stdout)
+    if code and message:
+        _fail_exit(code, message)
+    elif code:
+        sys.exit(code)
 
 
 if __name__ == '__main__':  # pragma: no cover
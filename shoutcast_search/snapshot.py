@@ -0,0 +1,204 @@
+#
+#   snapshot.py - local, searchable copy of the shoutcast station directory
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from shoutcast_search.cache import default_cache_dir
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import _Expression
+from shoutcast_search.shoutcast_search import _fetch_all
+from shoutcast_search.shoutcast_search import compile_filter
+
+
+def default_snapshot_path():
+    return os.path.join(default_cache_dir(), 'snapshot.db')
+
+
+def _fts_phrase(text):
+    return '"{0}"'.format(text.replace('"', '""'))
+
+
+class Snapshot(object):
+    ''' Stations crawled from a provider into a local SQLite database.
+
+    Station names, genres and current tracks are indexed with an FTS5
+    trigram index, so substring searches are answered from the index. The
+    index holds the text upper cased by Python, matching the case
+    insensitive comparison done by filter_results. Bitrate, listener and
+    MIME type filters are SQL conditions on indexed columns. Without FTS5
+    support in the sqlite3 module, text criteria are checked in Python.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or default_snapshot_path()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.fts = True
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS stations ('
+                            'id TEXT PRIMARY KEY, name TEXT, mt TEXT, '
+                            'br INTEGER, genre TEXT, ct TEXT, lc INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS stations_br '
+                            'ON stations (br)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS stations_lc '
+                            'ON stations (lc)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS stations_mt '
+                            'ON stations (mt)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                            'key TEXT PRIMARY KEY, value TEXT)')
+            try:
+                self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                                "stations_fts USING fts5(name, genre, ct, "
+                                "tokenize='trigram case_sensitive 1')")
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM stations').fetchone()[0]
+
+    @property
+    def crawled(self):
+        ''' Time of the last crawl, in seconds since the epoch, or None. '''
+        row = self.db.execute("SELECT value FROM meta "
+                              "WHERE key = 'crawled'").fetchone()
+        return float(row[0]) if row else None
+
+    def store(self, stations):
+        ''' Replace the stored stations with stations (an iterable of
+        Station or station dicts). Returns the number of stations stored.
+        '''
+        def rows():
+            for s in map(Station.coerce, stations):
+                yield (s.id, s.name, s.mt, s.br, s.genre, s.ct, s.lc)
+
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM stations')
+            self.db.executemany('INSERT OR REPLACE INTO stations '
+                                '(id, name, mt, br, genre, ct, lc) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows())
+            if self.fts:
+                # SQLite's upper() only knows ASCII, use Python's instead
+                self.db.create_function('py_upper', 1, str.upper)
+                self.db.execute('DELETE FROM stations_fts')
+                self.db.execute('INSERT INTO stations_fts '
+                                '(rowid, name, genre, ct) '
+                                'SELECT rowid, py_upper(name), '
+                                'py_upper(genre), py_upper(ct) '
+                                'FROM stations')
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                            "VALUES ('crawled', ?)", (str(time.time()),))
+        return len(self)
+
+    def crawl(self, provider, max_workers=4):
+        ''' Fetch the Top500 and every genre listed by provider, and store
+        the stations found. Returns the number of unique stations.
+        '''
+        queries = [{'genre': 'Top500'}]
+        queries += [{'genre': genre} for genre in provider.get_genres()]
+
+        def stations():
+            seen = set()
+            for rows in _fetch_all(provider.get_search_results, queries,
+                                   max_workers):
+                for row in rows:
+                    if row['id'] not in seen:
+                        seen.add(row['id'])
+                        yield row
+        return self.store(stations())
+
+    def search(self, search=[], station=[], genre=[], song=[], mime_type='',
+               bitrate_fn=None, listeners_fn=None):
+        ''' Return the stored stations matching all criteria, as a list of
+        Station. Arguments are those of search() and filter_results().
+        '''
+        where = []
+        args = []
+        if mime_type:
+            where.append('s.mt = ?')
+            args.append(mime_type)
+        for field, fn in (('br', bitrate_fn), ('lc', listeners_fn)):
+            if isinstance(fn, _Expression) and fn.op is not None:
+                where.append('s.{0} {1} ?'.format(field, fn.op))
+                args.append(fn.bound)
+
+        # The trigram index finds phrases of at least three characters.
+        # Keywords with a space are left out since they may span fields.
+        terms = []
+        if self.fts:
+            for column, phrases in (('name', station), ('genre', genre),
+                                    ('ct', song)):
+                terms += ['{0} : {1}'.format(column, _fts_phrase(p))
+                          for p in map(str.upper, phrases) if len(p) >= 3]
+            terms += [_fts_phrase(k) for k in map(str.upper, search)
+                      if len(k) >= 3 and ' ' not in k]
+        if terms:
+            where.append('s.rowid IN (SELECT rowid FROM stations_fts '
+                         'WHERE stations_fts MATCH ?)')
+            args.append(' AND '.join(terms))
+
+        sql = 'SELECT s.name, s.mt, s.id, s.br, s.genre, s.ct, s.lc ' \
+              'FROM stations s'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            rows = self.db.execute(sql, args).fetchall()
+
+        predicate = compile_filter(search, station, genre, song, bitrate_fn,
+                                   listeners_fn)
+        stations = (Station(*row) for row in rows)
+        return [s for s in stations if predicate(s)]
+
+
+def main(argv=None, provider=None):
+    ''' shoutcast-search snapshot: crawl the directory into a snapshot '''
+    from shoutcast_search.shoutcast_search import Shoutcast
+
+    o = argparse.ArgumentParser(
+        prog='shoutcast-search snapshot',
+        description=('Crawl the Top500 and every genre into a local '
+                     'database, searchable with shoutcast-search --offline.'))
+    o.add_argument('--snapshot-db', dest='snapshot_db', action='store',
+                   default=None,
+                   help=('snapshot database, default '
+                         '~/.cache/shoutcast-search/snapshot.db.'))
+    o.add_argument('-j', '--jobs', dest='jobs', action='store', type=int,
+                   default=4, help='maximum number of concurrent requests.')
+    args = o.parse_args(argv)
+
+    if provider is None:
+        provider = Shoutcast()
+    snapshot = Snapshot(args.snapshot_db)
+    try:
+        count = snapshot.crawl(provider, max(args.jobs, 1))
+    finally:
+        snapshot.close()
+    sys.stdout.write('{0:d} station(s) stored in {1}\n'.format(
+        count, snapshot.path))
+    return count
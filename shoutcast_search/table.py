@@ -0,0 +1,309 @@
+#
+#   table.py - columnar station table for filtering and sorting in bulk
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' StationTable keeps many stations as NumPy arrays, one per field, to
+filter and sort them a column at a time instead of a station at a time:
+
+    table = StationTable.from_stations(snapshot.search())
+    table.save('stations.table')
+    ...
+    table = StationTable.load('stations.table')  # memory mapped
+    top = table.filter(genre=['rock'], bitrate_fn=_expression_param('>127',
+                       parser)).order(limit=10)
+    write_stations(top.to_stations(), '%s', provider)
+
+filter() and order() give the same stations in the same order as
+filter_results() and its sorters, except that shuffles use NumPy's random
+generator. A saved table is a directory of .npy files, loaded memory mapped
+so that processes loading the same table share its pages. Needs numpy
+("pip install numpy").
+'''
+
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError('shoutcast_search.table needs numpy, install it with '
+                      '"pip install numpy"')
+
+from shoutcast_search.shoutcast_search import Station
+from shoutcast_search.shoutcast_search import _Expression
+from shoutcast_search.shoutcast_search import _Shuffle
+from shoutcast_search.shoutcast_search import _SortBy
+from shoutcast_search.shoutcast_search import _Truncate
+
+TABLE_VERSION = 1
+
+# Arrays of a table; mt and genre are codes into the table's categories
+COLUMNS = ('id', 'name', 'ct', 'url', 'br', 'lc', 'mt', 'genre', 'text',
+           'genre_at', 'ct_at')
+
+
+def _codes(values):
+    ''' Return (codes, categories) for a list of strings. '''
+    index = {}
+    codes = numpy.fromiter((index.setdefault(v, len(index)) for v in values),
+                           numpy.int32, len(values))
+    return codes, sorted(index, key=index.get)
+
+
+def _strings(values):
+    return numpy.array(values, dtype=str) if values else \
+        numpy.zeros(0, dtype='U1')
+
+
+class StationTable(object):
+    ''' Stations as columns: int64 arrays br and lc, categorical mt and
+    genre (int32 codes into mt_categories and genre_categories), and string
+    arrays id, name, ct and url. text, genre_at and ct_at hold the upper
+    case text searched by the filters, laid out as in Station. Extra fields
+    are not kept.
+    '''
+
+    def __init__(self, columns, mt_categories, genre_categories):
+        self.columns = columns
+        self.mt_categories = list(mt_categories)
+        self.genre_categories = list(genre_categories)
+
+    @classmethod
+    def from_stations(cls, stations):
+        ''' Build a table from an iterable of Station or station dicts. '''
+        stations = [Station.coerce(s) for s in stations]
+        mt, mt_categories = _codes([s.mt for s in stations])
+        genre, genre_categories = _codes([s.genre for s in stations])
+        size = len(stations)
+        columns = {
+            'id': _strings([s.id for s in stations]),
+            'name': _strings([s.name for s in stations]),
+            'ct': _strings([s.ct for s in stations]),
+            'url': _strings([s.url for s in stations]),
+            'br': numpy.fromiter((s.br for s in stations), numpy.int64,
+                                 size),
+            'lc': numpy.fromiter((s.lc for s in stations), numpy.int64,
+                                 size),
+            'mt': mt,
+            'genre': genre,
+            'text': _strings([s.text for s in stations]),
+            'genre_at': numpy.fromiter((s._genre_at for s in stations),
+                                       numpy.int32, size),
+            'ct_at': numpy.fromiter((s._ct_at for s in stations),
+                                    numpy.int32, size)}
+        return cls(columns, mt_categories, genre_categories)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def take(self, indices):
+        ''' Return a table of the stations at indices, in that order. '''
+        return StationTable(dict((name, column[indices]) for name, column
+                                 in self.columns.items()),
+                            self.mt_categories, self.genre_categories)
+
+    def to_stations(self):
+        ''' Return the stations as a list of Station. '''
+        c = self.columns
+        mt_categories = self.mt_categories
+        genre_categories = self.genre_categories
+        return [Station(name, mt_categories[mt], id, br,
+                        genre_categories[genre], ct, lc, url=url)
+                for name, mt, id, br, genre, ct, lc, url in zip(
+                    c['name'].tolist(), c['mt'].tolist(), c['id'].tolist(),
+                    c['br'].tolist(), c['genre'].tolist(), c['ct'].tolist(),
+                    c['lc'].tolist(), c['url'].tolist())]
+
+    # Filtering
+
+    def _number_mask(self, field, fn):
+        column = self.columns[field]
+        if isinstance(fn, _Expression):
+            if fn.op == '>':
+                return column > fn.bound
+            elif fn.op == '<':
+                return column < fn.bound
+            elif fn.op == '==':
+                return column == fn.bound
+            return None
+        return numpy.fromiter(map(fn, column.tolist()), bool, len(column))
+
+    def _text_mask(self, needle, start=0, end=None):
+        return numpy.char.find(self.columns['text'], needle, start,
+                               end) != -1
+
+    def mask(self, search=[], station=[], genre=[], song=[],
+             bitrate_fn=None, listeners_fn=None, mime_type=''):
+        ''' Return a bool array telling which stations match all criteria,
+        the arguments of filter_results(), and mime_type. '''
+        c = self.columns
+        mask = numpy.ones(len(self), dtype=bool)
+        if mime_type:
+            if mime_type not in self.mt_categories:
+                return numpy.zeros(len(self), dtype=bool)
+            mask &= c['mt'] == self.mt_categories.index(mime_type)
+        for field, fn in (('br', bitrate_fn), ('lc', listeners_fn)):
+            if fn is not None:
+                matches = self._number_mask(field, fn)
+                if matches is not None:
+                    mask &= matches
+        for needle in set(p.upper() for p in genre):
+            # Look at every genre once, then at its code per station
+            found = numpy.array([needle in g.upper()
+                                 for g in self.genre_categories], dtype=bool)
+            mask &= found[c['genre']]
+        for needle in set(p.upper() for p in station):
+            mask &= self._text_mask(needle, 0, c['genre_at'] - 1)
+        for needle in set(p.upper() for p in song):
+            mask &= self._text_mask(needle, c['ct_at'])
+        # Phrases matched in a field are in text too; check the rest
+        for needle in set(k.upper() for k in search):
+            mask &= self._text_mask(needle)
+        return mask
+
+    def filter(self, search=[], station=[], genre=[], song=[],
+               bitrate_fn=None, listeners_fn=None, mime_type=''):
+        ''' Return a table of the stations matching all criteria, see
+        mask(). '''
+        return self.take(numpy.flatnonzero(self.mask(
+            search, station, genre, song, bitrate_fn, listeners_fn,
+            mime_type)))
+
+    # Ordering
+
+    def _sort_keys(self, sorts, indices):
+        ''' Return the keys of a stable lexsort giving the order of the
+        _SortBy sorters in sorts applied one after the other, as _sort_key
+        does. '''
+        keys = []
+        fields = set()
+        for sort in reversed(sorts):
+            if sort.field in fields:
+                continue
+            fields.add(sort.field)
+            column = self.columns[sort.field][indices]
+            keys.insert(0, -column if sort.descending else column)
+        return keys
+
+    def _sorted(self, sorts, indices, count=None):
+        ''' Return indices sorted by sorts, only the first count (all if
+        None). A single key is partitioned when only a small top is kept.
+        '''
+        keys = self._sort_keys(sorts, indices)
+        if count is None or len(keys) > 1 or count * 8 > len(indices):
+            return indices[numpy.lexsort(keys)][:count]
+        if count == 0:
+            return indices[:0]
+        key = keys[0]
+        kth = numpy.partition(key, count - 1)[count - 1]
+        # Keys equal to the kth are taken in their order, like a stable
+        # sort takes them
+        below = numpy.flatnonzero(key < kth)
+        ties = numpy.flatnonzero(key == kth)[:count - len(below)]
+        chosen = numpy.concatenate((below, ties))
+        chosen.sort()
+        return indices[chosen[numpy.argsort(key[chosen], kind='stable')]]
+
+    def order(self, sorters=[], randomize=False, limit=0, rng=None):
+        ''' Return the table shuffled (randomize) or sorted by listeners,
+        passed through sorters and truncated to limit, like filter_results()
+        orders stations. Sorters made by _generate_list_sorters run as
+        argsort and argpartition on the columns, planned like _plan_sorters
+        plans them; other sorters are applied to to_stations(). rng is the
+        numpy.random.Generator used to shuffle.
+        '''
+        ops = [_Shuffle() if randomize else _SortBy('lc')] + list(sorters)
+        if limit > 0:
+            ops.append(_Truncate(limit))
+        if not all(isinstance(op, (_SortBy, _Shuffle, _Truncate))
+                   for op in ops):
+            stations = self.to_stations()
+            for op in ops:
+                stations = op(stations)
+            return StationTable.from_stations(stations)
+        if rng is None:
+            rng = numpy.random.default_rng()
+
+        indices = numpy.arange(len(self))
+        index = 0
+        while index < len(ops):
+            # A run of sorts and shuffles, and the truncations following it
+            run = []
+            while index < len(ops) and not isinstance(ops[index], _Truncate):
+                run.append(ops[index])
+                index += 1
+            count = None
+            while index < len(ops) and isinstance(ops[index], _Truncate):
+                if count is None or ops[index].count < count:
+                    count = ops[index].count
+                index += 1
+
+            # Only the last shuffle of a run and the sorts after it matter
+            shuffles = [i for i, op in enumerate(run)
+                        if isinstance(op, _Shuffle)]
+            if shuffles:
+                run = run[shuffles[-1] + 1:]
+                indices = rng.permutation(indices)
+            if run:
+                indices = self._sorted(run, indices, count)
+            elif count is not None:
+                indices = indices[:count]
+        return self.take(indices)
+
+    # Persistence
+
+    def save(self, path):
+        ''' Write the table to the directory path, replacing it. '''
+        path = os.path.abspath(path)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+        try:
+            for name in COLUMNS:
+                numpy.save(os.path.join(tmp, name + '.npy'),
+                           self.columns[name])
+            with open(os.path.join(tmp, 'table.json'), 'w') as f:
+                json.dump({'version': TABLE_VERSION, 'size': len(self),
+                           'mt': self.mt_categories,
+                           'genre': self.genre_categories}, f)
+            if os.path.exists(path):
+                old = tempfile.mkdtemp(dir=os.path.dirname(path))
+                os.replace(path, os.path.join(old, 'table'))
+                os.replace(tmp, path)
+                shutil.rmtree(old)
+            else:
+                os.replace(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        ''' Load a table saved with save(), memory mapped unless mmap is
+        false. Raises ValueError for other directories. '''
+        try:
+            with open(os.path.join(path, 'table.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise ValueError('no station table in {0}'.format(path))
+        if meta.get('version') != TABLE_VERSION:
+            raise ValueError('unknown station table version in {0}'.format(
+                path))
+        columns = dict((name, numpy.load(os.path.join(path, name + '.npy'),
+                                         mmap_mode='r' if mmap else None))
+                       for name in COLUMNS)
+        return cls(columns, meta['mt'], meta['genre'])
@@ -1,18 +1,66 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import gzip
 import io
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from os.path import dirname, join
+from socketserver import ThreadingMixIn
 from unittest import TestCase
+from unittest import skipUnless
 
+from shoutcast_search import aio
+from shoutcast_search import batch
+from shoutcast_search import changes
+from shoutcast_search import crawler
+from shoutcast_search import bench
+from shoutcast_search.cache import ResponseCache
+from shoutcast_search.snapshot import Snapshot
+from shoutcast_search import metrics
+from shoutcast_search import output
+from shoutcast_search import resolver
+from shoutcast_search import server
+from shoutcast_search import transport
+from shoutcast_search.federation import FederatedProvider
+from shoutcast_search.watch import Watcher
+from shoutcast_search.shoutcast_search import IcecastDirectory
 from shoutcast_search.shoutcast_search import Provider
+from shoutcast_search.shoutcast_search import Station
 from shoutcast_search.shoutcast_search import _expression_param
+from shoutcast_search.shoutcast_search import _Expression
 from shoutcast_search.shoutcast_search import _from_UTF_8
 from shoutcast_search.shoutcast_search import _fail_exit
 from shoutcast_search.shoutcast_search import get_egg_description
 from shoutcast_search.shoutcast_search import _generate_list_sorters
+from shoutcast_search.shoutcast_search import _plan_sorters
+from shoutcast_search.shoutcast_search import _resolve
 from shoutcast_search.shoutcast_search import main
 from shoutcast_search.shoutcast_search import search
+from shoutcast_search.shoutcast_search import iter_search
 from shoutcast_search.shoutcast_search import filter_results
+from shoutcast_search.shoutcast_search import compile_filter
+from shoutcast_search.shoutcast_search import compile_format
+from shoutcast_search.shoutcast_search import write_stations
+from shoutcast_search.shoutcast_search import station_record
+from shoutcast_search.transport import HTTPConnectionPool
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    from shoutcast_search import table
+except ImportError:
+    table = None
 
 
 class DummyParser(object):
@@ -30,6 +78,110 @@ class TestProvider(Provider):
     extra_headers = {'a': 'b'}
 
 
+class IcecastTestProvider(IcecastDirectory):
+
+    search_url = 'file://' + join(dirname(__file__), 'test_data', 'yp.xml')
+    genres_url = search_url
+
+
+def _read_test_data(name):
+    with open(join(dirname(__file__), 'test_data', name), 'rb') as f:
+        return f.read()
+
+
+class DirectoryHandler(BaseHTTPRequestHandler):
+    """ Serves the test_data files over keep-alive HTTP/1.1 """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/search'):
+            body = _read_test_data('search.xml')
+        elif self.path.startswith('/genres'):
+            body = _read_test_data('genres.xml')
+        else:
+            body = b'not found'
+            self.send_response(404)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.server.accept_encodings.append(
+            self.headers.get('Accept-Encoding'))
+        encoding = self.server.encoding
+        if encoding and encoding.split('-')[0] in \
+                self.headers.get('Accept-Encoding', ''):
+            body = _compress(body, encoding)
+        else:
+            encoding = None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('ETag', '"v1"')
+        if encoding:
+            self.send_header('Content-Encoding', encoding.split('-')[0])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _compress(body, encoding):
+    ''' Encode body as 'gzip', 'deflate' or 'deflate-raw', deflate
+    without zlib header as some servers send it. '''
+    if encoding == 'gzip':
+        return gzip.compress(body)
+    if encoding == 'deflate':
+        return zlib.compress(body)
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class DirectoryServer(ThreadingMixIn, HTTPServer):
+    """ Local HTTP stand-in for the shoutcast web service """
+
+    daemon_threads = True
+
+    def __init__(self, handler=DirectoryHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.connections = 0
+        self.requests = []
+        self.accept_encodings = []
+        self.encoding = None  # Content-Encoding of the answers
+        self.providers = []  # closed by stop()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        for provider in self.providers:
+            provider.close()
+        self.shutdown()
+        self.server_close()
+
+
+class HTTPTestProvider(Provider):
+
+    def __init__(self, server, transport=None):
+        self.search_url = server.url + '/search?{0}'
+        self.by_id_url = server.url + '/tunein?id={0}'
+        self.genres_url = server.url + '/genres'
+        Provider.__init__(self, transport)
+        server.providers.append(self)
+
+
 def redirect_stdout():
     sys.stderr = stdout = io.StringIO()
     return stdout
@@ -121,6 +273,48 @@ class UtilityTestCase(TestCase):
         self.assertEqual(stations, [{'br': '1'}, {'br': '2'}])
         self.assertEqual(sorters_description, ['bitrate asc', 'top 2'])
 
+    def test_generate_list_sorters_nn(self):
+        sorters, sorters_description = _generate_list_sorters('n3n1')
+        self.assertEqual(sorters[0]([{'br': '1'}, {'br': '2'}]),
+                         [{'br': '1'}, {'br': '2'}])
+        self.assertEqual(sorters_description, ['top 3', 'top 1'])
+
+    def test_plan_sorters_equivalent(self):
+        stations = [Station.from_attrib(r)
+                    for r in bench.synthetic_stations(300)]
+        for pattern in ('', 'l', 'b', '^b', 'ln10', 'bl', '^bn5l', 'n50^bn9',
+                        'lbl^b', '^blb', 'n0', 'bn400', 'bn0l'):
+            for limit in (0, 1, 7, 1000):
+                sorters = _generate_list_sorters(pattern)[0]
+                expected = sorted(stations, key=lambda a: a.lc, reverse=True)
+                for sorter in sorters:
+                    expected = sorter(expected)
+                if limit:
+                    expected = expected[:limit]
+                result = list(stations)
+                for stage in _plan_sorters(sorters, False, limit):
+                    result = stage(result)
+                self.assertEqual([r.id for r in result],
+                                 [r.id for r in expected], pattern)
+
+    def test_plan_sorters_fused(self):
+        self.assertEqual(len(_plan_sorters([], False, 10)), 1)
+        sorters = _generate_list_sorters('ln10')[0]
+        self.assertEqual(len(_plan_sorters(sorters)), 1)
+        sorters = _generate_list_sorters('^bln5r')[0]
+        self.assertEqual(len(_plan_sorters(sorters)), 2)
+        self.assertEqual(len(_plan_sorters(_generate_list_sorters('lr')[0],
+                                           False, 3)), 1)
+
+    def test_plan_sorters_random(self):
+        stations = [Station(id=str(i), lc=i) for i in range(100)]
+        sorters = _generate_list_sorters('ln10r')[0]
+        result = list(stations)
+        for stage in _plan_sorters(sorters, False, 5):
+            result = stage(result)
+        self.assertEqual(len(result), 5)
+        self.assertTrue(all(r.lc >= 90 for r in result))
+
     def test_search_mt(self):
         provider = TestProvider()
         provider.get_search_results = lambda opt_dict: opt_dict
@@ -133,6 +327,49 @@ class UtilityTestCase(TestCase):
         self.assertEqual(search(mime_type='mp3', provider=provider),
                          {'mt': 'mp3', 'genre': 'Top500'})
 
+    def test_search_keywords_merge(self):
+        provider = TestProvider()
+        answers = {'a': [{'id': '1'}, {'id': '2'}],
+                   'b': [{'id': '2'}, {'id': '3'}],
+                   'c': [{'id': '4'}, {'id': '1'}]}
+        provider.get_search_results = lambda opt: answers[opt['search']]
+        result = search(['a', 'b'], genre=['c'], provider=provider)
+        self.assertEqual([r['id'] for r in result], ['1', '2', '3', '4'])
+
+    def test_search_concurrent(self):
+        provider = TestProvider()
+        barrier = threading.Barrier(3, timeout=5)
+
+        def get_search_results(opt_dict):
+            barrier.wait()  # only passes if all three run at the same time
+            return [{'id': opt_dict['search']}, {'id': 'shared'}]
+        provider.get_search_results = get_search_results
+        result = search(['a', 'b'], song=['c'], provider=provider,
+                        max_workers=3)
+        self.assertEqual([r['id'] for r in result],
+                         ['a', 'shared', 'b', 'c'])
+
+    def test_search_same_as_legacy_merge(self):
+        answers = {'a': [{'id': '1'}, {'id': '1'}, {'id': '2'}],
+                   'b': [{'id': '3'}, {'id': '2'}, {'id': '3'}],
+                   'c': [{'id': '1'}, {'id': '4'}]}
+        provider = bench.StaticProvider(answers)
+        self.assertEqual(search(['a', 'b', 'c'], provider=provider),
+                         bench.legacy_merge(answers[k] for k in 'abc'))
+
+    def test_iter_search_streams(self):
+        provider = TestProvider()
+        fetched = []
+
+        def get_search_results(opt_dict):
+            fetched.append(opt_dict['search'])
+            return [{'id': opt_dict['search']}]
+        provider.get_search_results = get_search_results
+        stations = iter_search(['a', 'b'], provider=provider)
+        self.assertEqual(next(stations)['id'], 'a')
+        self.assertEqual(fetched, ['a'])
+        self.assertEqual([r['id'] for r in stations], ['b'])
+
     dummy_result = [{'br': 128, 'lc':10, 'name':'TestStation1',
                      'genre': 'Dub', 'ct':'foo'},
                     {'br': 256, 'lc':15, 'name':'TestStation2',
@@ -170,6 +407,160 @@ class UtilityTestCase(TestCase):
         result =filter_results(self.dummy_result, randomize=True)
         self.assertEqual(len(result), 3)
 
+
+class StationTestCase(TestCase):
+
+    attrib = {'name': 'Groove Salad', 'mt': 'audio/mpeg', 'id': '42',
+              'br': '128', 'genre': 'Ambient Chill', 'ct': 'Bonobo - Kiara',
+              'lc': '310', 'logo': 'x.png'}
+
+    def test_from_attrib(self):
+        station = Station.from_attrib(self.attrib)
+        self.assertEqual(station.br, 128)
+        self.assertEqual(station['lc'], '310')  # str, like the attributes
+        self.assertEqual(station['logo'], 'x.png')
+        self.assertEqual(station.get('missing', 'x'), 'x')
+        self.assertEqual(len(station), 8)
+        self.assertEqual(dict(station), self.attrib)
+        self.assertEqual(station_record(station, str)['lc'], 310)
+
+    def test_invalid_numbers(self):
+        station = Station.from_attrib({'br': '', 'lc': 'n/a'})
+        self.assertEqual((station.br, station.lc), (0, 0))
+
+    def test_contains(self):
+        station = Station.from_attrib(self.attrib)
+        self.assertTrue(station.name_contains('SALAD'))
+        self.assertFalse(station.name_contains('AMBIENT'))
+        self.assertTrue(station.genre_contains('AMBIENT CHILL'))
+        self.assertFalse(station.genre_contains('BONOBO'))
+        self.assertTrue(station.song_contains('KIARA'))
+        self.assertFalse(station.song_contains('CHILL'))
+        self.assertIn('SALAD AMBIENT', station.text)
+
+    def test_coerce(self):
+        station = Station.from_attrib(self.attrib)
+        self.assertIs(Station.coerce(station), station)
+        self.assertEqual(Station.coerce(self.attrib), station)
+
+    def test_search_results(self):
+        stations = TestProvider().get_search_results({})
+        self.assertTrue(all(isinstance(s, Station) for s in stations))
+        self.assertEqual(stations[0].lc, 455)
+
+
+class FilterTestCase(TestCase):
+
+    criteria = [{},
+                {'search': ['radio']},
+                {'search': ['rock', 'o', 'ROCK'], 'genre': ['rock']},
+                {'station': ['groove s'], 'song': ['mode']},
+                {'genre': ['pop', 'op'], 'song': ['a', 'live'],
+                 'search': ['e', 'li', 'z']},
+                {'search': ['pop rock'], 'station': ['fm 1']},
+                {'search': ['x' * 50]}]
+
+    def test_compile_filter_equivalent(self):
+        raw = bench.synthetic_stations(500)
+        stations = [Station.from_attrib(r) for r in raw]
+        for criteria in self.criteria:
+            expected = [r['id'] for r in bench.legacy_filter(raw, **criteria)]
+            predicate = compile_filter(**criteria)
+            self.assertEqual([r.id for r in stations if predicate(r)],
+                             expected)
+
+    def test_compile_filter_numeric(self):
+        predicate = compile_filter(bitrate_fn=lambda x: x >= 128,
+                                   listeners_fn=lambda x: x > 0)
+        self.assertTrue(predicate(Station(br='128', lc='1')))
+        self.assertFalse(predicate(Station(br='128', lc='0')))
+        self.assertFalse(predicate(Station(br='64', lc='9')))
+
+    def test_bench_filter(self):
+        sys.stdout = io.StringIO()
+        try:
+            report = bench.main(['--size', '200', '--json', 'filter'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(report['filter']['size'], 200)
+        self.assertIn('compiled', report['filter']['seconds'])
+
+    def test_bench_sort(self):
+        sys.stdout = io.StringIO()
+        try:
+            report = bench.main(['--size', '50', 'sort'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertIn('planned ln10', report['sort']['seconds'])
+
+    def test_bench_format(self):
+        sys.stdout = io.StringIO()
+        try:
+            report = bench.main(['--size', '20', 'format'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertIn('compiled verbose', report['format']['seconds'])
+
+    def test_bench_merge(self):
+        sys.stdout = io.StringIO()
+        try:
+            report = bench.main(['--size', '40', 'merge'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(sorted(report['merge']['seconds']),
+                         ['legacy_10', 'legacy_20', 'legacy_40', 'legacy_5',
+                          'set_10', 'set_20', 'set_40', 'set_5'])
+
+    def test_fake_directory(self):
+        directory = bench.FakeDirectory(size=30, per_query=7)
+        try:
+            provider = directory.provider()
+            self.assertEqual(len(provider.get_search_results(
+                {'genre': 'Top500'})), 30)
+            rock = provider.get_search_results({'search': 'rock'})
+            self.assertEqual(len(rock), 7)
+            self.assertEqual(provider.get_search_results({'search': 'rock'}),
+                             rock)
+        finally:
+            directory.stop()
+        report = bench.bench_fanout(5, latency=0)
+        self.assertEqual(sorted(report), ['jobs_1', 'jobs_4', 'jobs_8'])
+
+    def test_bench_scale(self):
+        sys.stdout = io.StringIO()
+        try:
+            report = bench.main(['--size', '50', '--json', 'parse', 'scale'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertIn('fetch_and_parse', report['parse']['seconds'])
+        self.assertEqual(sorted(report['scale']['seconds']),
+                         ['filter_50', 'format_50', 'sort_50', 'top10_50'])
+
+    def test_bench_compare(self):
+        baseline = {'sort': {'size': 10, 'seconds': {'a': 1.0, 'b': 1.0}},
+                    'format': {'size': 5, 'seconds': {'a': 1.0}}}
+        report = {'sort': {'size': 10, 'seconds': {'a': 1.1, 'b': 2.0,
+                                                   'c': 9.0}},
+                  'format': {'size': 6, 'seconds': {'a': 9.0}}}
+        self.assertEqual(bench.compare(baseline, report),
+                         [('sort', 'b', 1.0, 2.0)])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = join(directory, 'baseline.json')
+        with open(path, 'w') as f:
+            json.dump({'sort': {'size': 50,
+                                'seconds': {'planned bl': 1e-9}}}, f)
+        sys.stdout = io.StringIO()
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                bench.main(['--size', '50', '--compare', path, 'sort'])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        self.assertIn('sort planned bl:', stderr.getvalue())
+
+
 class ProviderTestCase(TestCase):
 
     def _make_one(self):
@@ -187,6 +578,1650 @@ class ProviderTestCase(TestCase):
         self.assertEqual(len(provider.get_genres()), 19)
 
 
+class IcecastTestCase(TestCase):
+
+    def test_search(self):
+        provider = IcecastTestProvider()
+        stations = provider.get_search_results({'search': 'polska'})
+        self.assertEqual([s.name for s in stations], ['Polska Jazz Club'])
+        station = stations[0]
+        self.assertEqual(station.url,
+                         'http://stream.example.org:8000/jazz.ogg')
+        self.assertEqual((station.br, station.lc), (0, 3000))
+        self.assertEqual(station['samplerate'], '44100')
+        self.assertEqual(provider.station_text(station, '%u'), station.url)
+
+    def test_top_and_genre(self):
+        provider = IcecastTestProvider()
+        top = provider.get_search_results({'genre': 'Top500'})
+        self.assertEqual([s.lc for s in top], [3000, 12, 7])
+        chill = provider.get_search_results({'genre': 'chill',
+                                             'mt': 'audio/mpeg'})
+        self.assertEqual([s.name for s in chill], ['Groove Salad Mirror'])
+        self.assertEqual(provider.get_genres()[:3],
+                         ['Ambient', 'Chill', 'Hrvatska'])
+
+
+class TuneInTestProvider(TestProvider):
+    """ TestProvider giving every station its own URL """
+
+    by_id_url = 'http://example.org/tunein-station.pls?id={0}'
+
+
+class FederationTestCase(TestCase):
+
+    def test_merge(self):
+        provider = FederatedProvider([TuneInTestProvider(),
+                                      IcecastTestProvider()])
+        stations = provider.get_search_results({'search': 'polska'})
+        listeners = [s.lc for s in stations]
+        self.assertEqual(listeners[0], 3000)
+        self.assertEqual(stations[0]['directory'], 'icecast')
+        self.assertEqual(listeners, sorted(listeners, reverse=True))
+        # Radio Banovina is listed by both, shoutcast's has more listeners
+        stations = search(['banovina'], provider=provider)
+        banovina = [s for s in stations if s.name == 'Radio Banovina']
+        self.assertEqual([(s['directory'], s.lc) for s in banovina],
+                         [('provider', 235)])
+        self.assertEqual(banovina[0].url,
+                         TuneInTestProvider().url_by_id('1645968'))
+        self.assertEqual(list(provider.failures), [])
+
+    def test_same_name(self):
+        class RelayProvider(TuneInTestProvider):
+            def iter_search_results(self, params, limit=0, predicate=None):
+                return iter([Station('Relay', id=self.name + '1', lc=5),
+                             Station('Relay', id=self.name + '2', lc=3)])
+
+        class OtherProvider(RelayProvider):
+            name = 'other'
+
+        provider = FederatedProvider([RelayProvider(), OtherProvider()])
+        stations = provider.get_search_results({'search': 'relay'})
+        self.assertEqual([s.id for s in stations],
+                         ['provider1', 'provider2'])
+
+    def test_partial_results(self):
+        class SlowProvider(IcecastTestProvider):
+            name = 'slow'
+
+            def iter_search_results(self, params, limit=0, predicate=None):
+                time.sleep(2)
+                return IcecastTestProvider.iter_search_results(self, params)
+
+        class BrokenProvider(IcecastTestProvider):
+            name = 'broken'
+            search_url = 'file:///nonexistent/yp.xml'
+
+        provider = FederatedProvider([TestProvider(), SlowProvider(),
+                                      BrokenProvider()],
+                                     timeouts={'slow': 0.1})
+        start = time.time()
+        stations = provider.get_search_results({'search': 'radio'})
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(stations)
+        self.assertEqual(set(s['directory'] for s in stations),
+                         set(['provider']))
+        self.assertEqual(sorted(name for name, error in provider.failures),
+                         ['broken', 'slow'])
+
+    def test_main(self):
+        sys.stdout = stdout = io.StringIO()
+        sys.stderr = stderr = io.StringIO()
+        try:
+            main(FederatedProvider([TestProvider(), IcecastTestProvider()]),
+                 ['--no-cache', '-n', '1', 'polska'])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        self.assertEqual(stdout.getvalue(),
+                         'http://stream.example.org:8000/jazz.ogg\n')
+        self.assertEqual(stderr.getvalue(), '')
+
+    def test_close(self):
+        class Pool(object):
+            cleared = 0
+
+            def clear(self):
+                self.cleared += 1
+
+        providers = [TestProvider(), IcecastTestProvider()]
+        for child in providers:
+            child.transport = Pool()
+        provider = FederatedProvider(providers, transport=Pool())
+        provider.resolver = resolver.Resolver(Pool())
+        provider.close()
+        self.assertEqual([p.transport.cleared for p in
+                          providers + [provider, provider.resolver]],
+                         [1, 1, 1, 1])
+
+
+class TransportTestCase(TestCase):
+
+    def setUp(self):
+        self.server = DirectoryServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keep_alive(self):
+        provider = HTTPTestProvider(self.server)
+        self.assertEqual(len(provider.get_genres()), 19)
+        self.assertEqual(len(provider.get_search_results({'search': 'a'})),
+                         len(provider.get_search_results({'search': 'b'})))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+        with provider:
+            pass
+        self.assertEqual(provider.transport._idle, {})
+
+    def test_pool_size(self):
+        pool = HTTPConnectionPool(maxsize=1, timeout=5)
+        self.addCleanup(pool.clear)
+        first = pool.urlopen(self.server.url + '/genres')
+        second = pool.urlopen(self.server.url + '/genres')
+        for resp in (first, second):
+            resp.read()
+            resp.close()
+        self.assertEqual(sum(len(c) for c in pool._idle.values()), 1)
+        pool.clear()
+        self.assertEqual(pool._idle, {})
+
+    def test_partial_read_not_reused(self):
+        pool = HTTPConnectionPool()
+        self.addCleanup(pool.clear)
+        with pool.urlopen(self.server.url + '/search') as resp:
+            resp.read(10)
+        with pool.urlopen(self.server.url + '/search') as resp:
+            resp.read()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_http_error(self):
+        import urllib.error
+        provider = HTTPTestProvider(self.server)
+        provider.genres_url = self.server.url + '/missing'
+        self.assertRaises(urllib.error.HTTPError, provider.get_genres)
+
+    def test_iter_search_results_limit(self):
+        provider = HTTPTestProvider(self.server)
+        stations = list(provider.iter_search_results({}, limit=2))
+        self.assertEqual([s['id'] for s in stations], ['17082', '143775'])
+
+    def test_iter_search_results_predicate(self):
+        provider = HTTPTestProvider(self.server)
+        stations = provider.iter_search_results(
+            {}, limit=1, predicate=lambda s: s.br == 192)
+        self.assertEqual([s['id'] for s in stations], ['3026'])
+
+    def test_search_limit(self):
+        provider = HTTPTestProvider(self.server)
+        result = search(['a', 'b'], provider=provider, limit=3)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_shared_transport(self):
+        pool = HTTPConnectionPool()
+        self.addCleanup(pool.clear)
+        HTTPTestProvider(self.server, pool).get_genres()
+        HTTPTestProvider(self.server, pool).get_genres()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_compression(self):
+        provider = HTTPTestProvider(self.server)
+        expected = provider.get_search_results({'search': 'a'})
+        genres = provider.get_genres()
+        for encoding in ('gzip', 'deflate', 'deflate-raw'):
+            self.server.encoding = encoding
+            self.assertEqual(provider.get_search_results({'search': 'a'}),
+                             expected)
+            self.assertEqual(provider.get_genres(), genres)
+        self.assertEqual(set(self.server.accept_encodings),
+                         set([transport.ACCEPT_ENCODING]))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_compressed_reads(self):
+        self.server.encoding = 'gzip'
+        body = _read_test_data('search.xml')
+        pool = HTTPConnectionPool()
+        self.addCleanup(pool.clear)
+        with pool.urlopen(self.server.url + '/search') as resp:
+            chunks = []
+            while True:
+                chunk = resp.read(100)
+                if not chunk:
+                    break
+                self.assertLessEqual(len(chunk), 100)
+                chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), body)
+        with pool.urlopen(self.server.url + '/search') as resp:
+            self.assertEqual(resp.read(10) + resp.read(), body)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_no_compression(self):
+        self.server.encoding = 'gzip'
+        pool = HTTPConnectionPool(compress=False)
+        self.addCleanup(pool.clear)
+        with pool.urlopen(self.server.url + '/search') as resp:
+            self.assertEqual(resp.read(), _read_test_data('search.xml'))
+        self.assertEqual(self.server.accept_encodings, ['identity'])
+
+
+class FlakyHandler(DirectoryHandler):
+    """ Answers 503 until the server's failures are used up """
+
+    def do_GET(self):
+        with self.server.lock:
+            fail = self.server.failures > 0
+            self.server.failures -= 1
+        if not fail:
+            return DirectoryHandler.do_GET(self)
+        self.server.requests.append(self.path)
+        self.send_response(503)
+        if self.server.retry_after is not None:
+            self.send_header('Retry-After', self.server.retry_after)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class SlowHandler(DirectoryHandler):
+    """ Answers after the server's delay, chunked if server.chunked, then
+    waiting server.drip seconds before each chunk """
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if not self.server.chunked:
+            return DirectoryHandler.do_GET(self)
+        self.server.requests.append(self.path)
+        body = _read_test_data('search.xml')
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(body), 1000):
+            chunk = body[start:start + 1000]
+            time.sleep(self.server.drip)
+            self.wfile.write('{0:x}\r\n'.format(len(chunk)).encode() +
+                             chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class RetryTestCase(TestCase):
+
+    def setUp(self):
+        self.server = DirectoryServer(FlakyHandler)
+        self.server.lock = threading.Lock()
+        self.server.failures = 2
+        self.server.retry_after = None
+        self.provider = HTTPTestProvider(self.server)
+        self.provider.backoff = 0.01
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry(self):
+        self.assertEqual(len(self.provider.get_genres()), 19)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_give_up(self):
+        import urllib.error
+        self.provider.retries = 1
+        self.assertRaises(urllib.error.HTTPError, self.provider.get_genres)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_deadline(self):
+        import urllib.error
+        self.server.retry_after = '30'
+        self.provider.deadline = 5
+        start = time.time()
+        self.assertRaises(urllib.error.HTTPError, self.provider.get_genres)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_slow_body(self):
+        slow_server = DirectoryServer(SlowHandler)
+        self.addCleanup(slow_server.stop)
+        slow_server.delay = 0
+        slow_server.chunked = True
+        slow_server.drip = 0
+        provider = HTTPTestProvider(slow_server)
+        provider.retries = 0
+        expected = len(provider.get_search_results({}))
+        slow_server.drip = 0.2
+        provider.deadline = 0.3
+        start = time.time()
+        self.assertRaises(TimeoutError, provider.get_search_results, {})
+        self.assertLess(time.time() - start, 0.6)
+        provider.deadline = 5
+        self.assertEqual(len(provider.get_search_results({})), expected)
+
+    def test_retryable(self):
+        import socket
+        import urllib.error
+        self.assertTrue(transport.is_retryable(
+            urllib.error.HTTPError('u', 429, 'Too Many', {}, None)))
+        self.assertFalse(transport.is_retryable(
+            urllib.error.HTTPError('u', 404, 'Not Found', {}, None)))
+        self.assertTrue(transport.is_retryable(
+            urllib.error.URLError(ConnectionResetError())))
+        self.assertTrue(transport.is_retryable(socket.timeout()))
+        self.assertFalse(transport.is_retryable(
+            urllib.error.URLError(FileNotFoundError())))
+        self.assertEqual(transport.retry_after(urllib.error.HTTPError(
+            'u', 503, 'Unavailable', {'Retry-After': '2'}, None)), 2)
+
+    def test_backoff_delay(self):
+        delays = [transport.backoff_delay(attempt, 0.5, 3)
+                  for attempt in range(8) for i in range(20)]
+        self.assertTrue(all(0 <= d <= 3 for d in delays))
+        self.assertGreater(max(delays), 1)
+
+    def test_token_bucket(self):
+        now = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        bucket = transport.TokenBucket(2, 2, lambda: now[0], sleep)
+        for i in range(4):
+            self.assertTrue(bucket.acquire())
+        self.assertEqual(slept, [0.5, 0.5])
+        self.assertFalse(bucket.acquire(timeout=0.1))
+        now[0] += 1
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertIsNone(bucket.reserve(timeout=0.1))
+        self.assertEqual(bucket.reserve(), 0.5)  # taken, to wait for
+
+    def test_rate_limited_provider(self):
+        self.server.failures = 0
+        self.provider.limiter = transport.TokenBucket(20, 1)
+        start = time.time()
+        search(['a', 'b', 'c', 'd', 'e'], provider=self.provider,
+               max_workers=5)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_failed_keywords(self):
+        class HalfBrokenProvider(TestProvider):
+            def get_search_results(self, params):
+                if params['search'] == 'zam':
+                    import urllib.error
+                    raise urllib.error.URLError('connection refused')
+                return TestProvider.get_search_results(self, params)
+
+        failures = []
+        stations = search(['zam', 'polska'], provider=HalfBrokenProvider(),
+                          max_workers=2, failures=failures)
+        self.assertTrue(stations)
+        self.assertEqual([k for k, e in failures], ['zam'])
+        sys.stdout = stdout = io.StringIO()
+        sys.stderr = stderr = io.StringIO()
+        try:
+            # every station matching both keywords is found for "radio"
+            main(HalfBrokenProvider(), ['--no-cache', '-f', '%s', 'zam',
+                                        'radio'])
+            self.assertTrue(stdout.getvalue().startswith('ZaM Radio'))
+            self.assertRaises(SystemExit, main, HalfBrokenProvider(),
+                              ['--no-cache', 'zam'])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        self.assertIn('warning: search for "zam" failed', stderr.getvalue())
+        self.assertIn('network error', stderr.getvalue())
+
+    def test_timeout(self):
+        class TimingOutProvider(TestProvider):
+            def get_genres(self):
+                raise TimeoutError('timed out')
+
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as raised:
+                main(TimingOutProvider(), ['--no-cache', '--list-genres'])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(raised.exception.code, 1)
+        self.assertIn('network error: timed out', stderr.getvalue())
+
+
+class CacheTestCase(TestCase):
+
+    def setUp(self):
+        self.server = DirectoryServer()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def _make_one(self, **kwargs):
+        cache = ResponseCache(self.directory, **kwargs)
+        return HTTPTestProvider(self.server), cache
+
+    def test_fresh_hit(self):
+        provider, provider.cache = self._make_one()
+        self.assertEqual(provider.get_genres(), provider.get_genres())
+        provider.get_search_results({'search': 'x'})
+        provider.get_search_results({'search': 'x'})
+        provider.get_search_results({'search': 'y'})
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_revalidate(self):
+        provider, provider.cache = self._make_one(ttl={'genres': 0})
+        genres = provider.get_genres()
+        self.assertEqual(provider.get_genres(), genres)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_refresh(self):
+        provider, provider.cache = self._make_one(refresh=True)
+        provider.get_genres()
+        provider.get_genres()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_evict(self):
+        size = len(_read_test_data('genres.xml'))
+        provider, provider.cache = self._make_one(max_size=size * 3 // 2)
+        provider.get_genres()
+        provider.get_search_results({'search': 'x'})
+        provider.get_genres()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_streamed(self):
+        provider, cache = self._make_one()
+        url = self.server.url + '/search'
+        body = _read_test_data('search.xml')
+        with cache.urlopen(provider.transport, url) as resp:
+            self.assertEqual(resp.read(10), body[:10])
+        # Not read to its end, so not cached
+        self.assertEqual(os.listdir(self.directory), [])
+        with cache.urlopen(provider.transport, url) as resp:
+            self.assertEqual(resp.read(10) + resp.read(), body)
+        with cache.urlopen(provider.transport, url) as resp:
+            self.assertEqual(resp.read(), body)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_limit_not_cached(self):
+        provider, provider.cache = self._make_one()
+        self.assertEqual(len(list(provider.iter_search_results(
+            {'search': 'x'}, limit=1))), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_clear(self):
+        provider, provider.cache = self._make_one()
+        provider.get_genres()
+        provider.cache.clear()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_main_clear_cache(self):
+        provider, provider.cache = self._make_one()
+        provider.get_genres()
+        main(provider, ['--clear-cache', '--cache-dir', self.directory])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class FormatTestCase(TestCase):
+
+    station = Station(name='Groove Salad', mt='audio/mpeg', id='42',
+                      br='128', genre='Ambient', ct='Bonobo', lc='310')
+
+    def _format(self, format):
+        return compile_format(format)(self.station, 'url{0}'.format)
+
+    def test_codes(self):
+        self.assertEqual(self._format('%s [%bkbps %t] %u %g %l %p'),
+                         'Groove Salad [128kbps audio/mpeg] url42 Ambient '
+                         '310 Bonobo')
+
+    def test_escapes(self):
+        self.assertEqual(self._format('%%s\\n\\t%x%'), '%s\n\t%x%')
+        self.assertEqual(self._format(''), '')
+
+    def test_values_not_interpreted(self):
+        station = Station(name='50%s off', genre='%p')
+        self.assertEqual(compile_format('%s|%g')(station, str), '50%s off|%p')
+        self.assertEqual(compile_format('%%A %U').codes, set(['%U']))
+
+    def test_station_text(self):
+        self.assertEqual(TestProvider().station_text(dict(self.station),
+                                                     '%s (%l)'),
+                         'Groove Salad (310)')
+
+    def test_write_stations(self):
+        out = io.StringIO()
+        stations = [Station(name=str(i)) for i in range(5)]
+        count = write_stations(stations, '%s', TestProvider(), out, 2)
+        self.assertEqual(count, 5)
+        self.assertEqual(out.getvalue(), '0\n1\n2\n3\n4\n')
+
+    def test_write_no_stations(self):
+        out = io.StringIO()
+        self.assertEqual(write_stations([], '%s', TestProvider(), out), 0)
+        self.assertEqual(out.getvalue(), '\n')
+
+
+class SnapshotTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, 'snapshot.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_crawl(self):
+        snapshot = Snapshot(self.path)
+        self.assertIsNone(snapshot.crawled)
+        self.assertEqual(snapshot.crawl(TestProvider()), 19)
+        self.assertEqual(len(snapshot), 19)
+        self.assertIsNotNone(snapshot.crawled)
+        snapshot.close()
+
+    def test_search_same_as_filter(self):
+        raw = bench.synthetic_stations(300)
+        snapshot = Snapshot(self.path)
+        snapshot.store(raw)
+        for criteria in FilterTestCase.criteria + [
+                {'mime_type': 'audio/aacp', 'search': ['rock']},
+                {'bitrate_fn': _Expression('>', 128),
+                 'listeners_fn': _Expression('==', 0)},
+                {'bitrate_fn': lambda x: x < 64, 'genre': ['jazz']}]:
+            expected = filter_results(raw, **dict(
+                (k, v) for k, v in criteria.items() if k != 'mime_type'))
+            if 'mime_type' in criteria:
+                expected = [r for r in expected
+                            if r.mt == criteria['mime_type']]
+            result = filter_results(snapshot.search(**criteria))
+            self.assertEqual([r.id for r in result],
+                             [r.id for r in expected], criteria)
+        snapshot.close()
+
+    def test_main_offline(self):
+        snapshot = Snapshot(self.path)
+        snapshot.store([{'id': '1', 'name': 'Groove Salad', 'lc': '3'},
+                        {'id': '2', 'name': 'Drone Zone', 'lc': '5'}])
+        snapshot.close()
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(TestProvider(), ['--offline', '--snapshot-db', self.path,
+                                  '-f', '%s', 'zone'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(stdout.getvalue(), 'Drone Zone\n')
+
+    def test_main_snapshot(self):
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(TestProvider(), ['snapshot', '--snapshot-db', self.path])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertIn('19 station(s)', stdout.getvalue())
+
+
+class ServerTestCase(TestCase):
+
+    def _serve(self, address, measured=None):
+        search_server = server.make_server(address, TestProvider(),
+                                           metrics=measured)
+        thread = threading.Thread(target=search_server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(search_server.server_close)
+        self.addCleanup(search_server.shutdown)
+        return search_server
+
+    def test_search(self):
+        search_server = self._serve('127.0.0.1:0')
+        address = '127.0.0.1:{0}'.format(search_server.server_address[1])
+        status, output, error = server.request(
+            address, ['-n', '2', '-f', '%s|%l', 'polska'])
+        self.assertEqual(status, 0)
+        self.assertEqual(output.count('\n'), 2)
+        self.assertIn('|360', output)
+        self.assertIsNone(error)
+
+    def test_errors(self):
+        search_server = self._serve('127.0.0.1:0')
+        address = 'http://127.0.0.1:{0}/'.format(
+            search_server.server_address[1])
+        status, output, error = server.request(address, ['-b', 'x'])
+        self.assertEqual(status, 2)
+        self.assertIn('invalid expression', error)
+        status, output, error = server.request(address, ['nothing-matches'])
+        self.assertEqual((status, output, error),
+                         (4, '\n', 'no station found\n'))
+        status, output, error = server.request(address, ['--help'])
+        self.assertEqual(status, 0)
+        self.assertIn('usage: shoutcast-search', output)
+
+    def test_refused(self):
+        import http.client
+        status, output, error = server.execute(
+            TestProvider(), ['--cache-dir', 'here', '--profile', 'polska'])
+        self.assertEqual(status, 2)
+        self.assertIn('not allowed by the server: --profile, --cache-dir',
+                      error)
+        self.assertIsNone(server.check(['-n', '2', '--output', 'csv', 'a']))
+        self.assertIn('--directory', server.check(['--directory', 'icecast',
+                                                   'a']))
+        search_server = self._serve('127.0.0.1:0')
+        address = '127.0.0.1:{0}'.format(search_server.server_address[1])
+        self.assertRaises(http.client.HTTPException, server.request,
+                          address, ['--clear-cache'])
+        self.assertFalse(server.forward(address, ['--offline', 'polska']))
+
+    def test_watch(self):
+        status, output, error = server.execute(TestProvider(),
+                                               ['--watch', '5', 'polska'])
+        self.assertEqual(status, 2)
+        self.assertIn('--watch runs until interrupted', error)
+        # Run locally, without contacting the server
+        directory_server = DirectoryServer()
+        self.addCleanup(directory_server.stop)
+        self.assertFalse(server.forward(directory_server.url,
+                                        ['--watch', '5', 'polska']))
+        self.assertEqual(directory_server.connections, 0)
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        address = 'unix:' + join(directory, 'socket')
+        search_server = self._serve(address)
+        self.assertEqual(server.request(address, ['--list-genres'])[0], 0)
+        search_server.shutdown()
+        search_server.server_close()
+        self.assertFalse(os.path.exists(join(directory, 'socket')))
+
+    def test_unix_socket_not_a_socket(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = join(directory, 'notes')
+        with open(path, 'w') as f:
+            f.write('keep me')
+        self.assertRaises(FileExistsError, server.make_server, 'unix:' + path,
+                          TestProvider())
+        sys.stderr = io.StringIO()
+        try:
+            self.assertRaises(SystemExit, server.main,
+                              ['--listen', 'unix:' + path, '--no-cache'],
+                              TestProvider())
+        finally:
+            sys.stderr = sys.__stderr__
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep me')
+
+    def test_forward(self):
+        search_server = self._serve('127.0.0.1:0')
+        address = '127.0.0.1:{0}'.format(search_server.server_address[1])
+        sys.stdout = stdout = io.StringIO()
+        try:
+            self.assertTrue(server.forward(address, ['-f', '%s', 'zamradio']))
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertTrue(stdout.getvalue().startswith('ZaM Radio'))
+        search_server.shutdown()
+        search_server.server_close()
+        self.assertFalse(server.forward(address, ['zamradio']))
+
+    def test_metrics(self):
+        from urllib.request import urlopen
+        search_server = self._serve('127.0.0.1:0', metrics.enable())
+        self.addCleanup(metrics.disable)
+        address = '127.0.0.1:{0}'.format(search_server.server_address[1])
+        server.request(address, ['-n', '2', 'polska'])
+        with urlopen('http://{0}/metrics'.format(address)) as resp:
+            text = resp.read().decode('UTF-8')
+        self.assertIn('shoutcast_search_searches_total 1\n', text)
+        self.assertIn('shoutcast_search_stage_calls_total{stage="sort"} 1',
+                      text)
+
+
+class CountingProvider(TestProvider):
+    """ TestProvider recording the parameters of every search request """
+
+    def __init__(self):
+        TestProvider.__init__(self)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get_search_results(self, params):
+        with self.lock:
+            self.requests.append(params)
+        return TestProvider.get_search_results(self, params)
+
+
+class BatchTestCase(TestCase):
+
+    lines = ['# saved searches',
+             '-s zam -n 1',
+             '',
+             '{"id": "polska", "keywords": ["polska"], "listeners": ">100", '
+             '"limit": 2}',
+             'polska --sort ^l',
+             '-b x',
+             '{"genre": ["Rock"], "bitrate": 128']
+
+    def run_batch(self, provider, max_workers=4):
+        out = io.StringIO()
+        queries = batch.read_queries(self.lines)
+        failed = batch.run_batch(queries, provider, out, max_workers)
+        lines = out.getvalue().splitlines()
+        return failed, [json.loads(line) for line in lines]
+
+    def test_records(self):
+        failed, records = self.run_batch(TestProvider())
+        self.assertEqual(failed, 2)
+        self.assertEqual([r['id'] for r in records], [2, 'polska', 5, 6, 7])
+        self.assertEqual(records[0]['count'], 1)
+        station = records[0]['stations'][0]
+        self.assertEqual(station['id'], '17082')
+        self.assertEqual(station['lc'], 455)
+        self.assertEqual(station['url'], TestProvider().url_by_id('17082'))
+        self.assertEqual(records[1]['count'], 2)
+        listeners = [s['lc'] for s in records[2]['stations']]
+        self.assertEqual(listeners, sorted(listeners))
+        self.assertEqual(records[3], {'id': 6,
+                                      'error': 'invalid expression: x'})
+        self.assertIn('error', records[4])
+
+    def test_shared_requests(self):
+        for max_workers in (1, 4):
+            provider = CountingProvider()
+            self.run_batch(provider, max_workers)
+            searched = sorted(p['search'] for p in provider.requests)
+            self.assertEqual(searched, ['polska', 'zam'])
+
+    def test_failed_request(self):
+        class FailingProvider(TestProvider):
+            def get_search_results(self, params):
+                if params['search'] == 'zam':
+                    raise IOError('connection refused')
+                return TestProvider.get_search_results(self, params)
+
+        failed, records = self.run_batch(FailingProvider())
+        self.assertEqual(failed, 3)
+        self.assertEqual(records[0], {'id': 2, 'error': 'search failed: '
+                                      'connection refused'})
+        self.assertEqual(records[2]['count'], 12)
+
+    def test_main(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = join(directory, 'searches')
+        with open(path, 'w') as f:
+            f.write('zam\n{"keywords": "polska", "limit": 3}\n')
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(TestProvider(), ['--batch', path, '--no-cache'])
+        finally:
+            sys.stdout = sys.__stdout__
+        counts = [json.loads(line)['count']
+                  for line in stdout.getvalue().splitlines()]
+        self.assertEqual(counts, [1, 3])
+
+    def test_not_combined(self):
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                main(TestProvider(), ['--batch', 'searches', '--no-cache',
+                                      '--watch', '5', '-f', '%s'])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('--batch cannot be combined with --watch, --format',
+                      stderr.getvalue())
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                main(TestProvider(), ['--list-genres', '--batch', 'searches',
+                                      '--offline', '--no-cache'])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertIn('--batch cannot be combined with --list-genres, '
+                      '--offline', stderr.getvalue())
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                main(TestProvider(), ['--batch', 'searches', '--no-cache',
+                                      '--probe-timeout', '1',
+                                      '--resolve-jobs', '2',
+                                      '--snapshot-db', 'stations.db'])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertIn('--batch cannot be combined with --probe-timeout, '
+                      '--resolve-jobs, --snapshot-db', stderr.getvalue())
+
+    def test_refused_options(self):
+        queries = batch.read_queries([
+            '-f %s zam', '--resolve -j 2 zam', '-r -n 2 zam',
+            '{"random": "no", "keywords": "zam"}',
+            '{"random": false, "keywords": "zam"}'])
+        self.assertEqual([q.error for q in queries], [
+            'only criteria, filters, sorters, --limit and --random are '
+            'allowed in a batch, not --format',
+            'only criteria, filters, sorters, --limit and --random are '
+            'allowed in a batch, not --jobs, --resolve',
+            None, '"random" must be true or false', None])
+
+    def test_failed_record(self):
+        class BrokenProvider(TestProvider):
+            def url_by_id(self, id):
+                if id == '17082':
+                    raise ValueError('no url')
+                return TestProvider.url_by_id(self, id)
+
+        failed, records = self.run_batch(BrokenProvider())
+        self.assertEqual(failed, 3)
+        self.assertEqual(records[0], {'id': 2,
+                                      'error': 'search failed: no url'})
+        self.assertEqual(records[1]['count'], 2)
+
+
+class ChangesTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = join(self.directory, 'state.gz')
+
+    def test_diff(self):
+        url_by_id = 'url{0}'.format
+        first = [Station('A', id='1', lc=5, ct='x'), Station('B', id='2')]
+        events, state = changes.diff({}, first, url_by_id)
+        self.assertEqual([(e['event'], e['id']) for e in events],
+                         [('add', '1'), ('add', '2')])
+        self.assertEqual(events[0]['station']['url'], 'url1')
+        second = [Station('A', id='1', lc=7, ct='y'), Station('C', id='3')]
+        events, state = changes.diff(state, second, url_by_id)
+        self.assertEqual(events, [
+            {'event': 'change', 'id': '1', 'fields': {'lc': 7, 'ct': 'y'}},
+            {'event': 'add', 'id': '3',
+             'station': changes.station_record(second[1], url_by_id)},
+            {'event': 'remove', 'id': '2'}])
+        self.assertEqual(changes.diff(state, second, url_by_id)[0], [])
+
+    def test_state_file(self):
+        feed = changes.ChangeFeed(self.path)
+        self.assertEqual(feed.state, {})
+        feed.update([Station('A', id='1', lc=5)], str)
+        self.assertEqual(changes.ChangeFeed(self.path).state,
+                         {'1': ['A', '', 0, '', '', 5, '1']})
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertEqual(changes.ChangeFeed(self.path).state, {})
+
+    def run_main(self, *argv):
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(TestProvider(), ['--no-cache', '--changes', self.path] +
+                 list(argv))
+        finally:
+            sys.stdout = sys.__stdout__
+        return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_main(self):
+        events = self.run_main('polska')
+        self.assertEqual(set(e['event'] for e in events), set(['add']))
+        self.assertEqual(self.run_main('polska'), [])
+        removed = self.run_main('polska', '-l', '>350')
+        self.assertTrue(removed)
+        self.assertEqual(set(e['event'] for e in removed), set(['remove']))
+        self.assertLess(len(removed), len(events))
+        self.assertEqual(self.run_main('polska', '-l', '>350'), [])
+
+    def test_not_combined(self):
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                self.run_main('-f', '%s', '--output', 'csv', '--resolve',
+                              '--probe', 'polska')
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('--changes cannot be combined with --format, --output, '
+                      '--resolve, --probe', stderr.getvalue())
+        self.assertFalse(os.path.exists(self.path))
+
+
+class WatchTestCase(TestCase):
+
+    def setUp(self):
+        self.answers = []
+        self.pauses = []
+
+    def watcher(self, *answers):
+        self.answers = list(answers)
+
+        def find():
+            answer = self.answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        return Watcher(find, 8, clock=lambda: 0, sleep=self.pauses.append)
+
+    def test_poll(self):
+        a, b = Station('A', id='1'), Station('B', id='2')
+        watcher = self.watcher(([a], None, False), ([a, b], None, False),
+                               ([b], None, False), ([b], None, False),
+                               (None, 'failed', False), ([a], None, False))
+        self.assertEqual(watcher.poll(), [a])
+        self.assertEqual(watcher.pause, 4)
+        self.assertEqual(watcher.poll(), [b])
+        self.assertEqual(watcher.pause, 2)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.pause, 2.5)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.pause, 5)
+        self.assertEqual(watcher.matching, set(['2']))
+        self.assertEqual(watcher.poll(), [a])
+        self.assertEqual(watcher.matching, set(['1']))
+
+    def test_pause_bounds(self):
+        watcher = self.watcher(*[(None, 'failed', False)] * 4)
+        for i in range(4):
+            watcher.poll()
+        self.assertEqual(watcher.pause, 32)
+        watcher = self.watcher(*[([Station('A', id=str(i))], None, False)
+                                 for i in range(4)])
+        for i in range(4):
+            watcher.poll()
+        self.assertEqual(watcher.pause, 2)
+
+    def test_run(self):
+        a, b = Station('A', id='1'), Station('B', id='2')
+        watcher = self.watcher(([a], None, False), ([a], None, False),
+                               ([a, b], None, False))
+        out = io.StringIO()
+        self.assertEqual(watcher.run('url{0}'.format, out, polls=3), 3)
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['station']['url'] for e in events],
+                         ['url1', 'url2'])
+        self.assertEqual(events[0]['event'], 'match')
+        self.assertEqual(events[0]['time'], '1970-01-01T00:00:00Z')
+        self.assertEqual(self.pauses, [4, 5])
+
+    def test_errors(self):
+        a = Station('A', id='1')
+        watcher = self.watcher(([a], None, False), (None, 'failed', False),
+                               OSError('network is down'),
+                               ([a], None, False))
+        out = io.StringIO()
+        self.assertEqual(watcher.run(str, out, polls=4), 4)
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(e['event'], e.get('error')) for e in events],
+                         [('match', None), ('error', 'failed'),
+                          ('error', 'network is down')])
+
+    def test_incomplete(self):
+        a, b = Station('A', id='1'), Station('B', id='2')
+        watcher = self.watcher(([a, b], None, False), ([a], None, True),
+                               ([a, b], None, False), ([a], None, False),
+                               ([a, b], None, False))
+        self.assertEqual(watcher.poll(), [a, b])
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.matching, set(['1', '2']))
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [b])
+
+    def test_interrupt(self):
+        def find():
+            raise KeyboardInterrupt()
+        self.assertEqual(Watcher(find, 1).run(str, io.StringIO()), 0)
+
+    def test_not_combined(self):
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                main(TestProvider(), ['--watch', '5', '--no-cache', '-f',
+                                      '%s', '--output', 'csv', '--changes',
+                                      'state', '--resolve', '--probe',
+                                      'polska'])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn('--watch cannot be combined with --changes, --format, '
+                      '--output, --resolve, --probe', stderr.getvalue())
+
+
+class OutputTestCase(TestCase):
+
+    stations = [Station('A', 'audio/mpeg', '1', '128', 'Pop', 'x', '5'),
+                Station('B, "b"', id='2', url='http://b/')]
+
+    def test_ndjson(self):
+        out = io.StringIO()
+        self.assertEqual(output.write_ndjson(self.stations, 'url{0}'.format,
+                                             out), 2)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(records[0], {'name': 'A', 'mt': 'audio/mpeg',
+                                      'id': '1', 'br': 128, 'genre': 'Pop',
+                                      'ct': 'x', 'lc': 5, 'url': 'url1'})
+        self.assertEqual(records[1]['url'], 'http://b/')
+
+    def test_csv(self):
+        out = io.StringIO()
+        self.assertEqual(output.write_csv(self.stations, 'url{0}'.format,
+                                          out), 2)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'name,mt,id,br,genre,ct,lc,url',
+            'A,audio/mpeg,1,128,Pop,x,5,url1',
+            '"B, ""b""",,2,0,,,0,http://b/'])
+
+    def test_csv_extra(self):
+        first = Station('A', id='1')
+        first.extra = {'stream': 'http://a/', 'alive': True}
+        second = Station('B', id='2')
+        second.extra = {'alive': None, 'directory': 'icecast'}
+        out = io.StringIO()
+        output.write_csv([first, second], 'url{0}'.format, out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'name,mt,id,br,genre,ct,lc,url,stream,alive',
+            'A,,1,0,,,0,url1,http://a/,True',
+            'B,,2,0,,,0,url2,,'])
+
+    def test_served_binary(self):
+        status, text, error = server.execute(
+            TestProvider(), ['--output', 'msgpack', 'polska'])
+        self.assertEqual(status, 2)
+        self.assertIn('--output msgpack writes bytes', error)
+        self.assertEqual(output.check_output('msgpack', io.StringIO()),
+                         '--output msgpack writes bytes, not text')
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_msgpack(self):
+        out = io.BytesIO()
+        output.write_msgpack(self.stations, 'url{0}'.format, out)
+        unpacker = msgpack.Unpacker(io.BytesIO(out.getvalue()), raw=False)
+        records = list(unpacker)
+        self.assertEqual(records[0]['br'], 128)
+        self.assertEqual(records[1]['url'], 'http://b/')
+
+    def test_missing_msgpack(self):
+        saved = sys.modules.get('msgpack')
+        sys.modules['msgpack'] = None  # makes the import fail
+        try:
+            self.assertIn('pip install msgpack',
+                          output.check_output('msgpack'))
+        finally:
+            if saved is None:
+                del sys.modules['msgpack']
+            else:
+                sys.modules['msgpack'] = saved
+        self.assertEqual(output.check_output('csv'), None)
+
+    def test_main(self):
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(TestProvider(), ['--no-cache', '--output', 'ndjson', '-n',
+                                  '3', 'polska'])
+        except SystemExit as e:
+            self.assertEqual(e.code, 0)
+        finally:
+            sys.stdout = sys.__stdout__
+        records = [json.loads(line) for line in
+                   stdout.getvalue().splitlines()]
+        self.assertEqual(len(records), 3)
+        self.assertTrue(all(isinstance(r['lc'], int) for r in records))
+        self.assertEqual(sorted(r['lc'] for r in records)[::-1],
+                         [r['lc'] for r in records])
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.measured = metrics.enable(
+            metrics.Metrics(lambda *event: self.events.append(event)))
+        self.addCleanup(metrics.disable)
+
+    def test_metrics(self):
+        measured = metrics.Metrics()
+        measured.count('requests')
+        measured.count('requests', 2)
+        with measured.timer('parse'):
+            pass
+        measured.add_time('custom', 0.5)
+        snapshot = measured.snapshot()
+        self.assertEqual(snapshot['counters'], {'requests': 3})
+        self.assertEqual(snapshot['timers']['parse']['calls'], 1)
+        lines = measured.report(1.0).splitlines()
+        self.assertEqual([line.split()[0] for line in lines],
+                         ['stage', 'parse', 'custom', 'total', 'requests'])
+        self.assertIn(' 50.0%', lines[2])
+        self.assertIn('shoutcast_search_requests_total 3',
+                      measured.prometheus())
+        measured.reset()
+        self.assertEqual(measured.snapshot(),
+                         {'counters': {}, 'timers': {}})
+
+    def test_pipeline(self):
+        provider = TestProvider()
+        results = filter_results(search(['polska', 'radio'],
+                                        provider=provider), ['polska'])
+        snapshot = self.measured.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(counters['requests'], 2)
+        self.assertEqual(counters['bytes'],
+                         2 * len(_read_test_data('search.xml')))
+        self.assertEqual(counters['matches'], len(results))
+        self.assertEqual(counters['stations'] - counters['duplicates'],
+                         len(search(['polska', 'radio'],
+                                    provider=provider)))
+        self.assertEqual(sorted(snapshot['timers']),
+                         ['download', 'filter', 'merge', 'parse', 'request',
+                          'sort'])
+        self.assertIn(('count', 'requests', 1), self.events)
+        genres = provider.get_genres()
+        self.assertEqual(self.measured.snapshot()['counters']['genres'],
+                         len(genres))
+
+    def test_profile(self):
+        metrics.disable()
+        sys.stdout = io.StringIO()
+        sys.stderr = stderr = io.StringIO()
+        try:
+            main(TestProvider(), ['--no-cache', '--profile', 'polska'])
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        report = stderr.getvalue()
+        for name in ('parse', 'filter', 'format', 'total', 'stations'):
+            self.assertIn('\n{0} '.format(name), report)
+        from shoutcast_search import shoutcast_search
+        self.assertIsNone(shoutcast_search._metrics)
+
+
+class StreamHandler(DirectoryHandler):
+    """ Serves tune-in playlists and streams answering like shoutcast """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        url = urllib.parse.urlsplit(self.path)
+        id = dict(urllib.parse.parse_qsl(url.query)).get('id')
+        if url.path == '/tunein.pls' and id != 'missing':
+            body = ('[playlist]\nNumberOfEntries=1\nFile1={0}/stream/{1}\n'
+                    'Title1=Station {1}\n').format(self.server.url, id)
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/x-scpls')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode('UTF-8'))
+        elif url.path.startswith('/stream/') and \
+                url.path[len('/stream/'):] not in self.server.dead:
+            self.close_connection = True
+            self.wfile.write(b'ICY 200 OK\r\nicy-name: test\r\n\r\n')
+        else:
+            self.send_error(404)
+
+
+class StreamTestProvider(TestProvider):
+
+    def __init__(self, server):
+        TestProvider.__init__(self)
+        self.by_id_url = server.url + '/tunein.pls?id={0}'
+
+
+class ResolverTestCase(TestCase):
+
+    def setUp(self):
+        self.server = DirectoryServer(StreamHandler)
+        self.server.dead = set(['2'])
+        self.addCleanup(self.server.stop)
+        self.now = 0
+        self.resolver = resolver.Resolver(clock=lambda: self.now, ttl=60)
+        self.addCleanup(self.resolver.transport.clear)
+        self.url_by_id = StreamTestProvider(self.server).url_by_id
+
+    def test_parse_playlist(self):
+        self.assertEqual(resolver.parse_playlist(
+            '[playlist]\nnumberofentries=2\nFile1=http://a:8000/\n'
+            'Title1=A\nfile2=http://b/;\nVersion=2\n'),
+            ['http://a:8000/', 'http://b/;'])
+        self.assertEqual(resolver.parse_playlist(
+            '#EXTM3U\n#EXTINF:-1,A\nhttp://a/stream\n\nnot a url\n'),
+            ['http://a/stream'])
+
+    def test_resolve_all(self):
+        stations = [Station('A', id='1'), Station('B', id='2'),
+                    Station('C', id='missing'),
+                    Station('D', id='4', url=self.server.url + '/stream/4')]
+        stations = self.resolver.resolve_all(stations, self.url_by_id, True)
+        self.assertEqual([(s['stream'], s['alive']) for s in stations], [
+            (self.server.url + '/stream/1', True),
+            (self.server.url + '/stream/2', False),
+            ('', False),
+            (self.server.url + '/stream/4', True)])
+        count = len(self.server.requests)
+        self.resolver.resolve_all(stations, self.url_by_id, True)
+        self.assertEqual(len(self.server.requests), count)
+        self.now = 61
+        self.resolver.resolve_all(stations[:1], self.url_by_id)
+        self.assertEqual(len(self.server.requests), count + 1)
+        self.assertEqual(self.resolver.resolve_all(
+            [Station('A', id='1')], self.url_by_id)[0].extra,
+            {'stream': self.server.url + '/stream/1'})
+
+    def test_failures_and_bound(self):
+        self.resolver.max_entries = 2
+        missing = [Station('C', id='missing')]
+        self.resolver.resolve_all(missing, self.url_by_id)
+        count = len(self.server.requests)
+        self.now = 29
+        self.resolver.resolve_all(missing, self.url_by_id)
+        self.assertEqual(len(self.server.requests), count)
+        self.now = 31  # failures are kept for failure_ttl only
+        self.resolver.resolve_all(missing, self.url_by_id)
+        self.assertEqual(len(self.server.requests), count + 1)
+        self.resolver.resolve_all([Station('A', id='1'), Station('B', id='3')],
+                                  self.url_by_id, max_workers=1)
+        self.assertEqual(len(self.resolver._streams), 2)
+        self.assertNotIn(self.url_by_id('missing'), self.resolver._streams)
+
+    def test_provider_requests(self):
+        class Limiter(object):
+            calls = 0
+
+            def acquire(self, timeout):
+                self.calls += 1
+                return True
+
+        provider = StreamTestProvider(self.server)
+        self.addCleanup(provider.close)
+        provider.limiter = Limiter()
+        stations = _resolve(provider, [Station('A', id='1'),
+                                       Station('B', id='3')], True, 1, 2)
+        self.assertEqual([s['stream'] for s in stations],
+                         [self.server.url + '/stream/1',
+                          self.server.url + '/stream/3'])
+        self.assertEqual(provider.limiter.calls, 2)
+        self.assertEqual((provider.resolver.max_workers,
+                          provider.resolver.probe_timeout), (16, 3))
+
+    def test_probe(self):
+        self.assertTrue(resolver.probe(self.server.url + '/stream/1'))
+        self.assertFalse(resolver.probe(self.server.url + '/stream/2'))
+        address = self.server.server_address
+        self.server.stop()
+        self.assertFalse(resolver.probe('http://{0}:{1}/stream/1'.format(
+            *address), 1))
+
+    def test_main(self):
+        provider = StreamTestProvider(self.server)
+        self.addCleanup(provider.close)
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(provider,
+                 ['--no-cache', '-n', '3', '-f', '%U %A', 'polska'])
+        finally:
+            sys.stdout = sys.__stdout__
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            stream, alive = line.split()
+            self.assertTrue(stream.startswith(self.server.url + '/stream/'))
+            self.assertEqual(alive, 'up')
+
+
+class PagedProvider(Provider):
+    """ Directory of synthetic stations answering limit=offset,count """
+
+    by_id_url = 'http://example.com/tunein.pls?id={0}'
+
+    def __init__(self, fail=()):
+        Provider.__init__(self)
+        stations = [Station.from_attrib(r)
+                    for r in bench.synthetic_stations(60)]
+        # Every genre has 30 stations, half of them shared with the next
+        self.genres = dict((genre, stations[index * 15:index * 15 + 30])
+                           for index, genre in enumerate(['Rock', 'Pop',
+                                                          'Jazz']))
+        self.genres['Top500'] = stations[:7]
+        self.fail = set(fail)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get_genres(self):
+        return ['Rock', 'Pop', 'Jazz']
+
+    def get_search_results(self, params):
+        offset, count = map(int, params['limit'].split(','))
+        with self.lock:
+            self.requests.append((params['genre'], offset))
+            if (params['genre'], offset) in self.fail:
+                self.fail.discard((params['genre'], offset))
+                import urllib.error
+                raise urllib.error.URLError('unreachable')
+        return self.genres[params['genre']][offset:offset + count]
+
+
+class CrawlerTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = join(self.directory, 'stations.json')
+
+    def read(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_crawl(self):
+        provider = PagedProvider()
+        count = crawler.Crawler(provider, self.path, 10, 2).run()
+        self.assertEqual(count, 60)
+        ids = [r['id'] for r in self.read()]
+        self.assertEqual(sorted(ids, key=int), [str(i) for i in range(60)])
+        self.assertEqual(self.read()[0]['url'],
+                         'http://example.com/tunein.pls?id=0')
+        # Three full pages and an empty one per genre, one for Top500
+        self.assertEqual(len(provider.requests), 13)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def test_resume(self):
+        provider = PagedProvider(fail=[('Pop', 10)])
+        first = crawler.Crawler(provider, self.path, 10, 2)
+        self.assertEqual(first.run(), 60)
+        self.assertEqual([(g, o) for g, o, e in first.failures],
+                         [('Pop', 10)])
+        self.assertFalse(os.path.exists(self.path))
+        # An interrupted write leaves half a line
+        with open(self.path + '.part', 'a') as f:
+            f.write('{"id": "9')
+        provider.requests = []
+        self.assertEqual(crawler.Crawler(provider, self.path, 10, 2).run(),
+                         60)
+        self.assertEqual(sorted(provider.requests),
+                         [('Pop', 10), ('Pop', 20), ('Pop', 30)])
+        self.assertEqual(len(self.read()), 60)
+
+    def test_malformed_page(self):
+        class MalformedProvider(PagedProvider):
+            def get_search_results(self, params):
+                if params == {'genre': 'Jazz', 'limit': '10,10'}:
+                    from xml.etree.ElementTree import ParseError
+                    raise ParseError('not well-formed')
+                return PagedProvider.get_search_results(self, params)
+
+        first = crawler.Crawler(MalformedProvider(), self.path, 10, 2)
+        self.assertEqual(first.run(), 45)
+        self.assertEqual([(g, o) for g, o, e in first.failures],
+                         [('Jazz', 10)])
+        self.assertTrue(os.path.exists(self.path + '.checkpoint'))
+        provider = PagedProvider()
+        self.assertEqual(crawler.Crawler(provider, self.path, 10, 2).run(),
+                         60)
+        self.assertEqual(sorted(provider.requests),
+                         [('Jazz', 10), ('Jazz', 20), ('Jazz', 30)])
+
+    def test_offset_ignored(self):
+        count = crawler.Crawler(TestProvider(), self.path, 5).run()
+        self.assertEqual(count, 19)
+
+    def test_main(self):
+        sys.stdout = stdout = io.StringIO()
+        try:
+            main(PagedProvider(), ['crawl', '--page-size', '25', self.path])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(stdout.getvalue(), '60 station(s) written to '
+                         '{0}\n'.format(self.path))
+        sys.stderr = stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                main(PagedProvider(fail=[('Rock', 0)]),
+                     ['crawl', '--restart', self.path])
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertIn('Rock from 0 failed', stderr.getvalue())
+        self.assertIn('run again to resume', stderr.getvalue())
+
+
+@skipUnless(table, 'numpy is not installed')
+class TableTestCase(TestCase):
+
+    def setUp(self):
+        self.stations = [Station.from_attrib(r) for r in
+                         bench.synthetic_stations(500)]
+        self.table = table.StationTable.from_stations(self.stations)
+
+    def test_filter_equivalent(self):
+        numbers = [{}, {'bitrate_fn': _Expression('>', 64)},
+                   {'listeners_fn': _Expression('<', 100),
+                    'bitrate_fn': _Expression('==', 128)},
+                   {'listeners_fn': lambda x: x % 2 == 0}]
+        for criteria in FilterTestCase.criteria:
+            for number in numbers:
+                kwargs = dict(criteria, **number)
+                expected = [s.id for s in filter_results(self.stations,
+                                                         **kwargs)]
+                found = self.table.filter(**kwargs).order()
+                self.assertEqual(list(found.columns['id']), expected)
+
+    def test_order_equivalent(self):
+        for pattern, limit in (('', 0), ('', 10), ('ln10', 0),
+                               ('^bln5', 0), ('bl', 0), ('b^l', 3),
+                               ('n50^b', 0), ('n0', 0)):
+            sorters = _generate_list_sorters(pattern)[0]
+            expected = filter_results(self.stations, sorters=sorters,
+                                      limit=limit)
+            found = self.table.order(sorters, limit=limit).to_stations()
+            self.assertEqual([dict(s) for s in found],
+                             [dict(s) for s in expected])
+
+    def test_order_random(self):
+        found = self.table.order(_generate_list_sorters('rn10')[0])
+        self.assertEqual(len(found), 10)
+        found = self.table.order([], randomize=True, limit=5)
+        self.assertEqual(len(set(found.columns['id'])), 5)
+        # Any other sorter works on stations
+        found = self.table.order([lambda stations: stations[::-1]])
+        self.assertEqual(list(found.columns['id']),
+                         [s.id for s in filter_results(self.stations)][::-1])
+
+    def test_mime_type(self):
+        expected = [s.id for s in self.stations if s.mt == 'audio/mpeg']
+        self.assertEqual(sorted(self.table.filter(
+            mime_type='audio/mpeg').columns['id']), sorted(expected))
+        self.assertEqual(len(self.table.filter(mime_type='x/y')), 0)
+
+    def test_save_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = join(directory, 'stations.table')
+        self.table.save(path)
+        self.table.take([0, 1]).save(path)  # replaces the table
+        loaded = table.StationTable.load(path)
+        self.assertEqual(len(loaded), 2)
+        self.assertIsInstance(loaded.columns['lc'],
+                              table.numpy.memmap)
+        self.assertEqual([dict(s) for s in loaded.to_stations()],
+                         [dict(s) for s in self.stations[:2]])
+        self.assertEqual(os.listdir(directory), ['stations.table'])
+        with self.assertRaises(ValueError):
+            table.StationTable.load(directory)
+
+    def test_empty(self):
+        empty = table.StationTable.from_stations([])
+        self.assertEqual(len(empty.filter(['x'], genre=['y']).order()), 0)
+
+
+class AsyncTestCase(TestCase):
+
+    def setUp(self):
+        self.server = DirectoryServer(SlowHandler)
+        self.server.delay = 0
+        self.server.chunked = False
+        self.server.drip = 0
+        self.sync_provider = HTTPTestProvider(self.server)
+        self.sync_provider.backoff = 0.01
+
+    def tearDown(self):
+        self.server.stop()
+
+    def run_async(self, fn):
+        async def run():
+            async with aio.AsyncProvider(self.sync_provider) as provider:
+                return await fn(provider)
+        return asyncio.run(run())
+
+    def test_search(self):
+        expected = [s.id for s in search(['a', 'b'],
+                                         provider=self.sync_provider)]
+        self.server.connections = 0
+        found = self.run_async(lambda provider: aio.async_search(
+            ['a', 'b'], provider=provider))
+        self.assertEqual([s.id for s in found], expected)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_keep_alive(self):
+        async def fn(provider):
+            genres = await provider.get_genres()
+            stations = await provider.get_search_results({'search': 'a'})
+            return genres, stations
+        genres, stations = self.run_async(fn)
+        self.assertEqual(len(genres), 19)
+        self.assertEqual(len(stations), len(self.sync_provider.
+                                            get_search_results({})))
+        self.assertEqual(self.server.connections, 2)  # one is sync
+
+    def test_encodings(self):
+        expected = len(self.sync_provider.get_search_results({}))
+        for encoding, chunked in (('gzip', False), ('deflate-raw', False),
+                                  (None, True)):
+            self.server.encoding = encoding
+            self.server.chunked = chunked
+            stations = self.run_async(
+                lambda provider: provider.get_search_results({}))
+            self.assertEqual(len(stations), expected)
+
+    def test_limit_and_filter(self):
+        expected = filter_results(search(['a'], provider=self.sync_provider),
+                                  genre=['rock'], limit=3)
+        found = self.run_async(lambda provider: aio.async_filter_results(
+            aio.async_iter_search(['a'], provider=provider),
+            genre=['rock'], limit=3))
+        self.assertEqual([s.id for s in found], [s.id for s in expected])
+        found = self.run_async(lambda provider: aio.async_search(
+            ['a', 'b'], provider=provider, limit=2))
+        self.assertEqual(len(found), 2)
+
+    def test_retry(self):
+        self.server.RequestHandlerClass = FlakyHandler
+        self.server.lock = threading.Lock()
+        self.server.failures = 2
+        self.server.retry_after = None
+        genres = self.run_async(lambda provider: provider.get_genres())
+        self.assertEqual(len(genres), 19)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_timeout(self):
+        import urllib.error
+        self.server.delay = 0.5
+        start = time.time()
+        with self.assertRaises(urllib.error.URLError) as cm:
+            self.run_async(lambda provider: aio.async_search(
+                ['a'], provider=provider, timeout=0.1))
+        self.assertIsInstance(cm.exception.reason, TimeoutError)
+        failures = []
+        self.assertEqual(self.run_async(lambda provider: aio.async_search(
+            ['a', 'b'], provider=provider, timeout=0.1,
+            failures=failures)), [])
+        self.assertEqual(sorted(keyword for keyword, e in failures),
+                         ['a', 'b'])
+        self.assertLess(time.time() - start, 1)
+
+    def test_cached_timing(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.sync_provider.cache = ResponseCache(directory)
+        self.server.chunked = True
+        self.server.drip = 0.1
+        measured = metrics.enable()
+        self.addCleanup(metrics.disable)
+        self.sync_provider.get_search_results({})
+        timers = measured.snapshot()['timers']
+        self.assertLess(timers['request']['seconds'], 0.1)
+        self.assertGreater(timers['download']['seconds'], 0.3)
+        self.assertIn('cache', timers)
+        measured.reset()
+        self.sync_provider.get_search_results({})
+        snapshot = measured.snapshot()
+        self.assertEqual(snapshot['counters']['cache_hits'], 1)
+        self.assertNotIn('request', snapshot['timers'])
+
+    def test_cancel(self):
+        self.server.delay = 0.5
+
+        async def fn(provider):
+            task = asyncio.ensure_future(aio.async_search(
+                ['a', 'b', 'c'], provider=provider))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return provider.session
+        session = self.run_async(fn)
+        self.assertEqual(session._slots._value, session.limit)
+        self.assertEqual(session._idle, {})
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, aio.AsyncProvider,
+                          IcecastTestProvider())
+        with self.assertRaises(urllib.error.URLError):
+            self.run_async(lambda provider: provider.session.urlopen(
+                'file:///'))
+
+
+class StartupTestCase(TestCase):
+    ''' Guards the start up time of the command line: modules only needed
+    to fetch, parse or shuffle stations must not be imported before. '''
+
+    heavy = ('pkg_resources', 'importlib.metadata', 'xml.etree.ElementTree',
+             'urllib.request', 'urllib.error', 'http.client', 'random',
+             'tempfile', 'concurrent.futures')
+
+    def imported(self, code):
+        ''' Run code in a fresh interpreter with -X importtime and return
+        {module: cumulative microseconds} of the modules it imported. '''
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        modules = {}
+        for line in proc.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                fields = line.split('|')
+                if fields[1].strip().isdigit():
+                    modules[fields[2].strip()] = int(fields[1])
+        return modules
+
+    def assertLight(self, code):
+        modules = self.imported(code)
+        self.assertIn('shoutcast_search.shoutcast_search', modules)
+        self.assertEqual([m for m in self.heavy if m in modules], [])
+
+    def test_help(self):
+        self.assertLight('from shoutcast_search.shoutcast_search import main\n'
+                         'try:\n'
+                         '    main(argv=["--help"])\n'
+                         'except SystemExit:\n'
+                         '    pass\n')
+
+    def test_parse_arguments(self):
+        # What main() does before its first request
+        self.assertLight('from shoutcast_search.shoutcast_search import '
+                         'Shoutcast, _build_parser\n'
+                         'from shoutcast_search.cache import ResponseCache\n'
+                         'provider = Shoutcast()\n'
+                         'provider.cache = ResponseCache()\n'
+                         '_build_parser().parse_args(["-n", "5", "rock"])\n')
+
+
 class MainTestCase(TestCase):
 
     def test_main(self):
@@ -198,6 +2233,15 @@ class MainTestCase(TestCase):
         provider = TestProvider()
         main(provider)
 
+    def test_main_jobs(self):
+        stdout = io.StringIO()
+        sys.stdout = stdout
+        try:
+            main(TestProvider(), ['-j', '2', '-n', '1', 'test', 'zam'])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(stdout.getvalue().count('\n'), 1)
+
     def test_main_genres(self):
         sys.argv = ['shoutcast-search', '--list-genres']
         provider = TestProvider()
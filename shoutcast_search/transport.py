@@ -0,0 +1,365 @@
+#
+#   transport.py - pooled HTTP transport for shoutcast_search providers
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# http.client and urllib.request are imported on the first request, so
+# answering from the cache does not load them.
+import socket
+import threading
+import time
+import urllib.parse
+import zlib
+
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Content-Encodings asked for and decoded by HTTPConnectionPool
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Compressed bytes read at a time when decoding
+_CHUNK_SIZE = 16 * 1024
+
+
+class _Decoder(object):
+    ''' Streaming decoder for a gzip or deflate encoded body. deflate is
+    zlib wrapped data by the standard, raw deflate data from some servers;
+    both are accepted. '''
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        # 16 + MAX_WBITS expects a gzip header, MAX_WBITS a zlib header
+        wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+        self._decompressor = zlib.decompressobj(wbits)
+        self._started = False
+
+    def decode(self, data):
+        if not self._started and data and self.encoding == 'deflate':
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:  # raw deflate, without zlib header
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class PooledResponse(object):
+    ''' File-like HTTP response that hands its connection back to the pool.
+
+    The connection is only reused if the body was read completely and the
+    server did not ask to close it; otherwise it is closed on close().
+    Bodies sent with a gzip or deflate Content-Encoding are decompressed as
+    they are read. With a deadline (a time.monotonic() value) reads raise
+    TimeoutError once it has passed, however slowly the body arrives.
+    '''
+
+    def __init__(self, pool, key, conn, response, url, timeout=None,
+                 deadline=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        self._decoder = None
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            self._decoder = _Decoder('deflate' if encoding == 'deflate'
+                                     else 'gzip')
+        self._buffer = b''
+        self._eof = False
+        self._timeout = timeout
+        self._deadline = deadline
+
+    def _before_read(self):
+        ''' Raise TimeoutError if the deadline has passed, else let the
+        socket wait no longer than it. '''
+        if self._deadline is None:
+            return
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('deadline passed while reading {0}'.format(
+                self.url))
+        sock = self._conn.sock if self._conn is not None else None
+        if sock is not None:
+            if self._timeout is not None:
+                remaining = min(remaining, self._timeout)
+            sock.settimeout(remaining)
+
+    def _read_raw(self, amt=None):
+        ''' Read up to amt bytes of the body as sent, all of it if amt is
+        None. With a deadline the body is read a socket read at a time. '''
+        response = self._response
+        if self._deadline is None:
+            return response.read(amt)
+        data = []
+        size = 0
+        while amt is None or size < amt:
+            self._before_read()
+            try:
+                chunk = response.read1(_CHUNK_SIZE if amt is None
+                                       else amt - size)
+            except socket.timeout:  # not a TimeoutError before python 3.10
+                raise TimeoutError('deadline passed while reading {0}'
+                                   .format(self.url))
+            if not chunk:
+                break
+            data.append(chunk)
+            size += len(chunk)
+            if response.length == 0:
+                response.close()  # like read() does at the end
+        return b''.join(data)
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            return self._read_raw(amt)
+        if amt is None:
+            data = self._buffer
+            if not self._eof:
+                data += self._decoder.decode(self._read_raw())
+                data += self._decoder.flush()
+                self._eof = True
+            self._buffer = b''
+            return data
+        while len(self._buffer) < amt and not self._eof:
+            chunk = self._read_raw(max(amt, _CHUNK_SIZE))
+            if chunk:
+                self._buffer += self._decoder.decode(chunk)
+            else:
+                self._buffer += self._decoder.flush()
+                self._eof = True
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPConnectionPool(object):
+    ''' Keep-alive HTTP(S) connections, pooled per (scheme, host, port).
+
+      maxsize - maximum number of idle connections kept per host.
+      timeout - socket timeout in seconds for connecting and reading.
+      compress - ask for gzip or deflate compressed responses. They are
+                 decompressed while being read.
+
+    URLs with other schemes than http and https (e.g. file://) are passed on
+    to urllib.request.urlopen. Network failures are raised as
+    urllib.error.URLError and HTTP error codes as urllib.error.HTTPError, just
+    like urllib does.
+    '''
+
+    def __init__(self, maxsize=4, timeout=30, compress=True):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.compress = compress
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        import http.client
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        ''' Close all idle connections. '''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, key, path, headers, timeout):
+        ''' Send a GET request, retrying once if a reused connection turns
+        out to have been closed by the server in the meantime.
+        '''
+        import http.client
+        import urllib.error
+        while True:
+            conn, reused = self._acquire(key)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if not reused:
+                    raise urllib.error.URLError(e)
+
+    def urlopen(self, url, headers=None, redirects=5, timeout=None,
+                deadline=None):
+        ''' GET url and return a file-like response usable as a context
+        manager. The response must be closed to return the connection.
+        timeout, if given and shorter, replaces the pool's timeout for this
+        request. deadline, a time.monotonic() value, limits reading the
+        body too, see PooledResponse.
+        '''
+        headers = dict(headers or {})
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            from urllib import request
+            req = request.Request(url, headers=headers)
+            return request.urlopen(req, timeout=timeout)
+
+        if self.compress and not any(name.lower() == 'accept-encoding'
+                                     for name in headers):
+            headers['Accept-Encoding'] = ACCEPT_ENCODING
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        conn, response = self._request(key, path, headers, timeout)
+        resp = PooledResponse(self, key, conn, response, url, timeout,
+                              deadline)
+
+        location = resp.headers.get('Location')
+        if resp.status in _REDIRECT_CODES and location and redirects > 0:
+            resp.read()
+            resp.close()
+            return self.urlopen(urllib.parse.urljoin(url, location),
+                                headers, redirects - 1, timeout, deadline)
+        if resp.status >= 400:
+            from urllib.error import HTTPError
+            resp.read()
+            resp.close()
+            raise HTTPError(url, resp.status, response.reason, resp.headers,
+                            None)
+        return resp
+
+
+# Retries
+
+# HTTP answers telling to try again later
+RETRY_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def is_retryable(error):
+    ''' Might the request failing with error, an exception raised by
+    urlopen, succeed if it is simply made again? True for HTTP errors in
+    RETRY_CODES, timeouts, and connections refused, reset or closed.
+    '''
+    import http.client
+    if getattr(error, 'code', None) is not None:  # HTTPError
+        return error.code in RETRY_CODES
+    reason = getattr(error, 'reason', error)
+    return isinstance(reason, (ConnectionError, TimeoutError, socket.timeout,
+                               http.client.HTTPException))
+
+
+def retry_after(error):
+    ''' Seconds to wait as asked by the Retry-After header of an HTTP
+    error, or None. '''
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None  # absent, or an HTTP date
+
+
+def backoff_delay(attempt, base=0.5, cap=10, rnd=None):
+    ''' Seconds to wait before retry number attempt (0 for the first):
+    a random time up to base * 2 ** attempt, at most cap. The randomness
+    ("full jitter") keeps clients that failed together from retrying
+    together.
+    '''
+    import random
+    return (rnd or random).uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket(object):
+    ''' Thread-safe rate limiter allowing rate requests per second on
+    average and bursts of up to burst requests.
+
+    A limiter is shared by all threads using a provider, so concurrent
+    fetches are limited together.
+    '''
+
+    def __init__(self, rate, burst=1, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(self.burst)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, timeout=None):
+        ''' Take a token without waiting for it and return the seconds to
+        wait before using it, or None, taking no token, if that is more
+        than timeout. For callers waiting their own way, e.g. asyncio.
+        '''
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return None
+            self._tokens -= 1  # tokens owed are paid back while waiting
+        return wait
+
+    def acquire(self, timeout=None):
+        ''' Wait for, and take, a token. Returns False without waiting or
+        taking a token if none is available within timeout seconds.
+        '''
+        wait = self.reserve(timeout)
+        if wait is None:
+            return False
+        if wait:
+            self.sleep(wait)
+        return True
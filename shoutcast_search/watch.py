@@ -0,0 +1,112 @@
+#
+#   watch.py - poll a search and report stations as they start matching
+#
+#   Copyright (c) 2009-2010 by the Authors.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+''' "shoutcast-search --watch SECONDS ..." repeats a search until it is
+interrupted and prints a JSON line for every station that starts matching:
+
+    {"event": "match", "time": "2010-11-04T20:15:00Z", "station": {...}}
+
+e.g. for -p "Depeche Mode", when a station starts playing Depeche Mode.
+Stations matching on the first search are printed too. A failed search is
+printed as
+
+    {"event": "error", "time": "2010-11-04T20:15:00Z", "error": "..."}
+
+and the search is tried again after the next pause.
+'''
+
+import json
+import time
+
+from shoutcast_search.shoutcast_search import station_record
+
+
+class Watcher(object):
+    ''' Calls find() again and again, pausing in between.
+
+    find() returns (stations, error message or None, whether the stations
+    are incomplete, e.g. because a directory did not answer). Exceptions it
+    raises count as failed searches. The pause starts at interval seconds.
+    It is halved, down to a quarter of interval, after a search whose
+    result differs from the previous one, and grows by a quarter, up to four
+    times interval, after one that does not. It doubles after a failed
+    search. Only the ids of the stations matching the last search are kept,
+    so memory does not grow with time; an incomplete search only adds to
+    them, so that the stations it missed are not new when they come back.
+    '''
+
+    def __init__(self, find, interval, clock=time.time, sleep=time.sleep):
+        self.find = find
+        self.interval = interval
+        self.min_interval = interval / 4.0
+        self.max_interval = interval * 4.0
+        self.pause = interval
+        self.matching = set()  # ids found by the last search
+        self.error = None  # error message of the last search
+        self.clock = clock
+        self.sleep = sleep
+
+    def poll(self):
+        ''' Search once and return the stations that did not match the
+        previous search. error is set to the error message if it failed.
+        '''
+        try:
+            stations, self.error, incomplete = self.find()
+        except Exception as e:
+            self.error = str(e) or e.__class__.__name__
+        if self.error is not None:
+            self.pause = min(self.pause * 2, self.max_interval)
+            return []
+        ids = set(station['id'] for station in stations)
+        new = [station for station in stations
+               if station['id'] not in self.matching]
+        if ids != self.matching:
+            self.pause = max(self.pause / 2, self.min_interval)
+        else:
+            self.pause = min(self.pause * 1.25, self.max_interval)
+        if incomplete:
+            self.matching |= ids
+        else:
+            self.matching = ids
+        return new
+
+    def run(self, url_by_id, out, polls=None):
+        ''' Poll polls times, or until interrupted, writing a match event
+        to out for every new station and an error event for every failed
+        search. '''
+        count = 0
+        try:
+            while True:
+                stamp = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                      time.gmtime(self.clock()))
+                for station in self.poll():
+                    out.write(json.dumps({
+                        'event': 'match', 'time': stamp,
+                        'station': station_record(station, url_by_id)}) +
+                        '\n')
+                if self.error is not None:
+                    out.write(json.dumps({'event': 'error', 'time': stamp,
+                                          'error': self.error}) + '\n')
+                out.flush()
+                count += 1
+                if polls is not None and count >= polls:
+                    break
+                self.sleep(self.pause)
+        except KeyboardInterrupt:
+            pass
+        return count